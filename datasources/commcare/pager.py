@@ -0,0 +1,272 @@
+"""
+Fetching of CommCareHQ API pages.
+
+All the workers share one token bucket per CommCare domain, stored in
+MongoDB, so the number of requests sent to CommCareHQ stays below the
+configured rate however many page tasks run at the same time. Throttled and
+failed requests are retried with an exponential backoff that honours the
+Retry-After header, and the throughput of every fetch is recorded per domain.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import calendar
+import json
+import logging
+import random
+import time
+import urlparse
+from email.utils import parsedate
+
+import requests
+from django.conf import settings
+from django.utils import timezone
+from pymongo.errors import DuplicateKeyError
+from requests.auth import HTTPDigestAuth
+
+from silo.models import LabelValueStore
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_COLLECTION = 'commcare_rate_limits'
+METRICS_COLLECTION = 'commcare_fetch_metrics'
+
+# status codes worth retrying, anything else fails right away
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class CommCareFetchError(Exception):
+    pass
+
+
+class URLNotFoundError(CommCareFetchError):
+    pass
+
+
+def get_database():
+    return LabelValueStore._get_collection().database
+
+
+def get_domain(url):
+    """
+    Returns the CommCare domain of an API url
+    e.g. https://www.commcarehq.org/a/<domain>/api/v0.5/case/
+    """
+    parts = urlparse.urlparse(url).path.split('/')
+    try:
+        return parts[parts.index('a') + 1]
+    except (ValueError, IndexError):
+        return urlparse.urlparse(url).netloc
+
+
+def get_retry_after(response):
+    """
+    Returns the seconds to wait according to the Retry-After header of a
+    response, given either in seconds or as an HTTP date, or None
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    date = parsedate(value)
+    if date is None:
+        return None
+    return max(0, calendar.timegm(date) - time.time())
+
+
+def get_backoff(attempt, retry_after=None):
+    """
+    Returns the seconds to wait before retrying a request for the nth time
+    """
+    if retry_after is not None:
+        return min(retry_after, settings.COMMCARE_BACKOFF_MAX)
+    backoff = settings.COMMCARE_BACKOFF_BASE * 2 ** attempt
+    # the jitter keeps the workers that were throttled together apart
+    return min(backoff, settings.COMMCARE_BACKOFF_MAX) * random.uniform(0.5, 1)
+
+
+def get_cursor_url(url, meta):
+    """
+    Returns the absolute url of the next page if the API paginates with
+    cursors instead of offsets, None otherwise
+    """
+    next_url = meta.get('next')
+    if not next_url:
+        return None
+    query = urlparse.parse_qs(urlparse.urlparse(next_url).query)
+    if 'offset' in query:
+        return None
+    return urlparse.urljoin(url, next_url)
+
+
+class TokenBucket(object):
+    """
+    A token bucket shared by all the processes through MongoDB
+
+    The bucket is kept as the theoretical arrival time of the next request
+    (GCRA): every request moves it by 1/rate seconds, and a request has to
+    wait while it is more than `burst` requests ahead of the current time.
+    """
+
+    def __init__(self, key, rate, burst, collection=None):
+        self.key = key
+        self.interval = 1.0 / rate
+        self.burst = burst
+        if collection is None:
+            collection = get_database()[RATE_LIMIT_COLLECTION]
+        self.collection = collection
+
+    def reserve(self):
+        """
+        Takes a token and returns the seconds to wait before using it
+        """
+        while True:
+            now = time.time()
+            doc = self.collection.find_one({'_id': self.key})
+            if doc is None:
+                try:
+                    self.collection.insert_one({'_id': self.key,
+                                                'tat': now + self.interval})
+                    return 0
+                except DuplicateKeyError:
+                    continue
+            tat = max(doc['tat'], now) + self.interval
+            # only one process wins when several take the same token
+            result = self.collection.update_one(
+                {'_id': self.key, 'tat': doc['tat']}, {'$set': {'tat': tat}})
+            if result.matched_count:
+                return max(0, tat - self.burst * self.interval - now)
+
+    def acquire(self):
+        """
+        Waits for a token, returns the seconds waited
+        """
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class FetchMetrics(object):
+    """
+    Counters of one fetch, added to the daily totals of the domain
+    """
+    FIELDS = ('requests', 'pages', 'records', 'bytes', 'retries',
+              'throttled', 'seconds', 'waited')
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.started = time.time()
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def save(self):
+        self.seconds = round(time.time() - self.started, 3)
+        day = timezone.now().strftime('%Y-%m-%d')
+        try:
+            get_database()[METRICS_COLLECTION].update_one(
+                {'domain': self.domain, 'day': day},
+                {'$inc': self.as_dict(), '$set': {'updated': timezone.now()}},
+                upsert=True)
+        except Exception as e:
+            # metrics must never fail an import
+            logger.warning("Failed to record the CommCare metrics: %s" % e)
+        logger.info("CommCare fetch %s: %s" % (self.domain, self.as_dict()))
+
+
+def get_fetch_metrics(domain):
+    """
+    Returns the daily fetch totals of a domain with the records per second
+    """
+    metrics = []
+    for doc in get_database()[METRICS_COLLECTION].find(
+            {'domain': domain}, {'_id': 0}).sort('day', -1):
+        fetch_time = doc.get('seconds', 0) - doc.get('waited', 0)
+        doc['records_per_second'] = (
+            round(doc.get('records', 0) / fetch_time, 2)
+            if fetch_time > 0 else None)
+        metrics.append(doc)
+    return metrics
+
+
+class CommCarePager(object):
+    """
+    Fetches pages of the CommCareHQ API within the shared rate limit
+    """
+
+    def __init__(self, url, auth, auth_header):
+        """
+        url -- any url of the domain being fetched
+        auth -- the authorization required
+        auth_header -- True = use Header, False = use Digest authorization
+        """
+        self.domain = get_domain(url)
+        self.session = requests.Session()
+        if auth_header:
+            self.session.headers.update(auth)
+        else:
+            self.session.auth = HTTPDigestAuth(auth['u'], auth['p'])
+        self.bucket = TokenBucket('commcare:%s' % self.domain,
+                                  settings.COMMCARE_RATE_LIMIT,
+                                  settings.COMMCARE_RATE_BURST)
+        self.metrics = FetchMetrics(self.domain)
+
+    def get_page(self, url):
+        """
+        Returns the decoded JSON of a page, retrying throttled and failed
+        requests up to settings.COMMCARE_MAX_RETRIES times
+        """
+        attempt = 0
+        while True:
+            self.metrics.waited += self.bucket.acquire()
+            self.metrics.requests += 1
+            retry_after = None
+            try:
+                response = self.session.get(
+                    url, timeout=settings.COMMCARE_REQUEST_TIMEOUT)
+            except requests.RequestException as e:
+                error = e
+            else:
+                if response.status_code == 200:
+                    self.metrics.pages += 1
+                    self.metrics.bytes += len(response.content)
+                    data = json.loads(response.content)
+                    self.metrics.records += len(data.get('objects', []))
+                    return data
+                if response.status_code == 404:
+                    raise URLNotFoundError(url)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    raise CommCareFetchError("%s %s: %s" % (
+                        response.status_code, url, response.text[:200]))
+                if response.status_code == 429:
+                    self.metrics.throttled += 1
+                retry_after = get_retry_after(response)
+                error = "%s %s" % (response.status_code, url)
+
+            if attempt >= settings.COMMCARE_MAX_RETRIES:
+                raise CommCareFetchError("Giving up on %s after %s retries: %s"
+                                         % (url, attempt, error))
+            backoff = get_backoff(attempt, retry_after)
+            logger.warning("Retrying %s in %.1fs: %s" % (url, backoff, error))
+            self.metrics.retries += 1
+            self.metrics.waited += backoff
+            time.sleep(backoff)
+            attempt += 1
+
+    def iter_pages(self, url):
+        """
+        Yields the pages starting at url, following the meta.next cursors
+        """
+        while url:
+            data = self.get_page(url)
+            yield data
+            url = get_cursor_url(url, data.get('meta', {}))
+
+    def close(self):
+        self.session.close()
+        self.metrics.save()
@@ -3,24 +3,23 @@ from __future__ import absolute_import, unicode_literals
 from celery import shared_task, group, chain
 from django.utils import timezone
 
-from requests.auth import HTTPDigestAuth
-
 from django.conf import settings
-from pymongo import MongoClient
-from pymongo.operations import UpdateMany
-
-from tola.util import getColToTypeDict
-from silo.models import Silo
+from pymongo.operations import UpdateMany, UpdateOne
 
-import requests
-import json
-import time
+from tola.util import get_silo_columns
+from silo.models import (Silo, LabelValueStore, add_silo_rows,
+                         get_data_silo_id)
+from .pager import CommCarePager, get_cursor_url
 
 @shared_task(trail=True)
-def fetchCommCareData(url, auth, auth_header, start, end, step, silo_id, read_id, update=False) :
+def fetchCommCareData(url, auth, auth_header, start, end, step, silo_id, read_id, update=False, meta=None) :
     """
     This function will call the appointed functions to retrieve the commcare data
 
+    The pages are split over at most settings.COMMCARE_MAX_IN_FLIGHT tasks
+    that each fetch their pages one after the other. If the API paginates
+    with meta.next cursors a single task follows them instead of offsets.
+
     url -- the base url
     auth -- the authorization required
     auth_header -- True = use Header, False = use Digest authorization
@@ -28,9 +27,31 @@ def fetchCommCareData(url, auth, auth_header, start, end, step, silo_id, read_id
     end -- what record to end at
     step -- # of records to get in one request
     update -- if true use the update functioality instead of the regular store furnctionality
+    meta -- the meta of the response the caller already has from the API,
+        its next url tells whether the API paginates with cursors
     """
-    return group(requestCommCareData.s(url, offset, auth, auth_header, silo_id, read_id, update) \
-            for offset in xrange(start,end,step))
+    offsets = range(start, end, step)
+    if not offsets:
+        return group([])
+
+    if get_cursor_url(url, meta or {}):
+        # cursors can only be followed one page after the other
+        return group([requestCommCareCursor.s(getPageUrl(url, start), auth,
+                                              auth_header, silo_id, read_id,
+                                              update)])
+
+    lanes = min(settings.COMMCARE_MAX_IN_FLIGHT, len(offsets))
+    return group(requestCommCarePages.s(url, offsets[i::lanes], auth,
+                                        auth_header, silo_id, read_id, update)
+                 for i in xrange(lanes))
+
+
+COUNT_FIELDS = ('inserted', 'matched', 'modified', 'upserted')
+
+
+def getPageUrl(url, offset):
+    return url + "&offset=" + str(offset)
+
 
 @shared_task(trail=True)
 def requestCommCareData(url, offset, auth, auth_header, silo_id, read_id, update):
@@ -42,27 +63,58 @@ def requestCommCareData(url, offset, auth, auth_header, silo_id, read_id, update
     auth -- the authorization required
     auth_header -- True = use Header, False = use Digest authorization
     """
-    url = url + "&offset=" + str(offset)
-    if auth_header:
-        response = requests.get(url, headers=auth)
-    else:
-        response = requests.get(url, auth=HTTPDigestAuth(auth['u'],auth['p']))
-    if response.status_code == 200:
-        data = json.loads(response.content)
-    elif response.status_code == 429:
-        time.sleep(1)
-        return requestCommCareData(url, offset, auth, auth_header, silo_id, read_id, update)
-    elif response.status_code == 404:
-        raise URLNotFoundError(url)
-    else:
-        #add something to this future error code stopping everything with throw exception
-        time.sleep(1)
-        return requestCommCareData(url, offset, auth, auth_header, silo_id, read_id, update)
+    pager = CommCarePager(url, auth, auth_header)
+    try:
+        data = pager.get_page(getPageUrl(url, offset))
+    finally:
+        pager.close()
 
     #now get the properties of each data
     return parseCommCareData(data['objects'], silo_id, read_id, update)
 
 
+@shared_task(trail=True)
+def requestCommCarePages(url, offsets, auth, auth_header, silo_id, read_id, update):
+    """
+    Retrieves and stores the pages at the given offsets one after the other
+
+    returns the columns and the counts of the pages
+    """
+    results = []
+    pager = CommCarePager(url, auth, auth_header)
+    try:
+        for offset in offsets:
+            data = pager.get_page(getPageUrl(url, offset))
+            results.append(parseCommCareData(data['objects'], silo_id,
+                                             read_id, update))
+    finally:
+        pager.close()
+    result = mergeCommCareResults(results)
+    result['columns'] = list(result['columns'])
+    return result
+
+
+@shared_task(trail=True)
+def requestCommCareCursor(url, auth, auth_header, silo_id, read_id, update):
+    """
+    Retrieves and stores the page at url and every page after it by
+    following the meta.next cursors
+
+    returns the columns and the counts of the pages
+    """
+    results = []
+    pager = CommCarePager(url, auth, auth_header)
+    try:
+        for data in pager.iter_pages(url):
+            results.append(parseCommCareData(data['objects'], silo_id,
+                                             read_id, update))
+    finally:
+        pager.close()
+    result = mergeCommCareResults(results)
+    result['columns'] = list(result['columns'])
+    return result
+
+
 
 @shared_task()
 def parseCommCareData(data, silo_id, read_id, update):
@@ -74,15 +126,38 @@ def parseCommCareData(data, silo_id, read_id, update):
         except KeyError as e: pass
         data_properties[-1]["case_id"] = entry['case_id']
         data_columns.update(entry['properties'].keys())
-    storeCommCareData(data_properties, silo_id, read_id, update)
-    return list(data_columns)
+    counts = storeCommCareData(data_properties, silo_id, read_id, update)
+    return {'columns': list(data_columns), 'counts': counts}
+
+
+def mergeCommCareResults(results):
+    """
+    Adds up the results of the CommCare page tasks
+
+    returns a dict with the set of columns and the summed counts
+    """
+    columns = set()
+    counts = dict.fromkeys(COUNT_FIELDS, 0)
+    for result in results:
+        columns.update(result['columns'])
+        for field in COUNT_FIELDS:
+            counts[field] += result['counts'].get(field, 0)
+    return {'columns': columns, 'counts': counts}
+
 
 @shared_task()
 def storeCommCareData(data, silo_id, read_id, update):
+    """
+    Stores a page of cases. Updates are upserted on (silo_id, case_id) with
+    one unordered bulk write.
 
+    returns the counts of inserted, matched, modified and upserted cases
+    """
+    counts = dict.fromkeys(COUNT_FIELDS, 0)
     data_refined = []
+    data_id = get_data_silo_id(silo_id)
     try:
-        fieldToType = getColToTypeDict(Silo.objects.get(pk=silo_id))
+        fieldToType = get_silo_columns(silo_id).types
     except Silo.DoesNotExist as e:
         fieldToType = {}
     for row in data:
@@ -116,27 +191,36 @@ def storeCommCareData(data, silo_id, read_id, update):
         except KeyError as e: pass
         try: row["created_date"] = row.pop("create_date")
         except KeyError as e: pass
-        row["silo_id"] = silo_id
+        row["silo_id"] = data_id
         row["read_id"] = read_id
 
 
         data_refined.append(row)
 
-    client = MongoClient(settings.MONGO_URI)
-    db = client.get_database(settings.MONGODB_DATABASES['default']['name'])
+    if not data_refined:
+        return counts
+    collection = LabelValueStore._get_collection()
     if not update:
         for row in data_refined:
             row["create_date"] = timezone.now()
-        db.label_value_store.insert(data_refined)
+        result = collection.insert_many(data_refined, ordered=False)
+        counts['inserted'] = len(result.inserted_ids)
     else:
+        operations = []
         for row in data_refined:
             row['edit_date'] = timezone.now()
-            db.label_value_store.update(
-                {'silo_id' : silo_id,
+            operations.append(UpdateOne(
+                {'silo_id' : data_id,
                 'case_id' : row['case_id']},
                 {"$set" : row},
                 upsert=True
-            )
+            ))
+        result = collection.bulk_write(operations, ordered=False)
+        counts['matched'] = result.matched_count
+        counts['modified'] = result.modified_count
+        counts['upserted'] = result.upserted_count
+    add_silo_rows(silo_id, counts['inserted'] + counts['upserted'])
+    return counts
 
 # @shared_task()
 # def addExtraFields(columns, silo_id):
@@ -6,10 +6,12 @@ import json
 
 from celery import group
 
-from .tasks import fetchCommCareData, requestCommCareData, storeCommCareData
+from .tasks import fetchCommCareData, requestCommCareData, storeCommCareData, \
+    mergeCommCareResults
 
 from silo.models import LabelValueStore
 from tola.util import save_data_to_silo, addColsToSilo, hideSiloColumns
+from silo.indexes import ensure_silo_indexes
 from pymongo import MongoClient
 from django.conf import settings
 
@@ -22,7 +24,8 @@ def getProjects(user_id):
         projects.append(read.read_url.split('/')[4])
     return list(set(projects))
 
-def getCommCareCaseData(domain, auth, auth_header, total_cases, silo, read):
+def getCommCareCaseData(domain, auth, auth_header, total_cases, silo, read,
+                        meta=None):
     """
     Use fetch and request CommCareData to store all of the case data
 
@@ -32,20 +35,23 @@ def getCommCareCaseData(domain, auth, auth_header, total_cases, silo, read):
     total_cases -- total cases to get
     silo - silo to put the data into
     read -- read that the data is apart of
+    meta -- the meta of the response that counted the cases
     """
 
 
+    ensure_silo_indexes(silo)
+
     RECORDS_PER_REQUEST = 100
     base_url = "https://www.commcarehq.org/a/"+ domain\
                 +"/api/v0.5/case/?format=JSON&limit="+str(RECORDS_PER_REQUEST)
 
     data_raw = fetchCommCareData(base_url, auth, auth_header,\
-                    0, total_cases, RECORDS_PER_REQUEST, silo.id, read.id)
+                    0, total_cases, RECORDS_PER_REQUEST, silo.id, read.id,
+                    meta=meta)
     data_collects = data_raw.apply_async()
-    data_retrieval = [v.get() for v in data_collects]
-    columns = set()
-    for data in data_retrieval:
-        columns = columns.union(data)
+    data_retrieval = mergeCommCareResults([v.get() for v in data_collects])
+    columns = data_retrieval['columns']
+    counts = data_retrieval['counts']
     #correct the columns
     for column in columns:
         if "." in column:
@@ -82,4 +88,5 @@ def getCommCareCaseData(domain, auth, auth_header, total_cases, silo, read):
     addColsToSilo(silo, columns)
     hideSiloColumns(silo, ["case_id"])
 
-    return (messages.SUCCESS, "CommCare cases imported successfully", columns)
+    return (messages.SUCCESS, "%i CommCare cases imported successfully"
+            % counts['inserted'], columns)
@@ -99,7 +99,7 @@ def getCommCareAuth(request):
 
                     #get the actual data
                     authorization = {'Authorization': 'ApiKey %(u)s:%(a)s' % {'u' : commcare_token.username, 'a' : commcare_token.token}}
-                    ret = getCommCareCaseData(project, authorization, True, total_cases, silo, read)
+                    ret = getCommCareCaseData(project, authorization, True, total_cases, silo, read, response_data.get('meta'))
                     messages.add_message(request,ret[0],ret[1])
                     #need to impliment if import faluire
                     cols = ret[2]
@@ -181,7 +181,7 @@ def getCommCareFormPass(request):
 
                 #get the actual data
                 auth = {"u" : request.POST['username'], "p" : request.POST['password']}
-                ret = getCommCareCaseData(project, auth, False, total_cases, silo, read)
+                ret = getCommCareCaseData(project, auth, False, total_cases, silo, read, response_data.get('meta'))
                 #need to impliment if import faluire
                 messages.add_message(request,ret[0],ret[1])
                 cols = ret[2]
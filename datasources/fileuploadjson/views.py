@@ -1,4 +1,3 @@
-import json
 import requests
 import datetime
 
@@ -7,6 +6,7 @@ from django.http import HttpResponseRedirect
 from django.utils import timezone
 from django.shortcuts import render
 from tola.util import save_data_to_silo
+from tola.json_stream import iter_json_records
 from django.core.urlresolvers import reverse, reverse_lazy
 
 from django.contrib import messages
@@ -60,7 +60,7 @@ def file(request, id):
             # try:
             silo.reads.add(read_obj)
             silo_id = silo.id
-            data = json.load(read_obj.file_data)
+            data = iter_json_records(read_obj.file_data, read_obj.json_path)
             save_data_to_silo(silo, data, read_obj)
             return HttpResponseRedirect('/silo_detail/%s/' % silo_id)
             # except Exception as e:
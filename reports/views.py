@@ -1,5 +1,6 @@
 from django.shortcuts import render
-from silo.models import Country, Silo, User, TolaUser, LabelValueStore, UniqueFields
+from silo.models import Country, Silo, User, TolaUser, LabelValueStore, UniqueFields, \
+    get_data_silo_id
 from django.db.models import Q
 from django.utils.safestring import SafeString
 from collections import Counter
@@ -43,7 +44,7 @@ def table_dashboard(request,id=0):
         get_init_fields = UniqueFields.objects.get(silo__id=id)
     except UniqueFields.DoesNotExist:
         get_init_fields = None
-    doc = LabelValueStore.objects(silo_id=id).to_json()
+    doc = LabelValueStore.objects(silo_id=get_data_silo_id(id)).to_json()
 
     try:
         data = ast.literal_eval(doc)
@@ -1,13 +1,18 @@
+import hashlib
 import json
 import django_filters
 from urlparse import urljoin
 from urllib import urlencode
 from datetime import datetime
 
-from django.http import HttpResponseBadRequest, JsonResponse, HttpResponse
+from bson import SON
+
+from django.http import (HttpResponseBadRequest, HttpResponse,
+                         StreamingHttpResponse)
 from django.db.models import Q
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse
 
@@ -23,12 +28,24 @@ from rest_framework import mixins, status
 
 from .serializers import *
 from .models import (Silo, LabelValueStore, Country, WorkflowLevel1,
-                     WorkflowLevel2, TolaUser, Read, ReadType)
+                     WorkflowLevel2, TolaUser, Read, ReadType,
+                     get_silo_row_count)
 from silo.permissions import (IsOwnerOrReadOnly, ReadIsOwnerViewOrWrite,
                           SiloIsOwnerOrCanRead)
+from silo import query_cache
+from silo.export import iter_bulk_export
+from silo.query_compiler import (InvalidQuery, parse_json_param,
+                                 parse_json_list_param, compile_match, compile_group, compile_sort,
+                                 check_field, get_index_hint, aggregate,
+                                 explain)
+from silo.pagination import (InvalidCursor, KeysetPage, get_keyset_sort,
+                             get_keyset_match, decode_cursor)
+from tola.json_stream import iter_json_array
 from tola.util import (getSiloColumnNames, getCompleteSiloColumnNames,
                        save_data_to_silo, JSONEncoder)
 
+FILTERED_COUNT_CACHE_KEY = 'silo_filtered_count_{}_{}'
+
 
 class TolaUserViewSet(viewsets.ModelViewSet):
     """
@@ -113,7 +130,14 @@ class PublicSiloViewSet(viewsets.ReadOnlyModelViewSet):
             return redirect(u'{}?{}'.format(url, request.GET))
 
         query = request.GET.get('query',"{}")
-        filter_fields = json.loads(query)
+        sort = str(request.GET.get('sort', ''))
+        try:
+            match = compile_match(silo.data_id,
+                                  parse_json_param(query, 'query'))
+            if sort:
+                check_field(sort.lstrip('+-'))
+        except InvalidQuery as e:
+            return HttpResponseBadRequest(str(e))
 
         shown_cols = set(
             json.loads(
@@ -122,19 +146,27 @@ class PublicSiloViewSet(viewsets.ReadOnlyModelViewSet):
 
         # workaround until the problem of javascript
         # not increasing the value of length is fixed
-        data = LabelValueStore.objects(
-            silo_id=id,
-            **filter_fields).exclude('create_date', 'edit_date',
-                                     'silo_id', 'read_id')
+        data = LabelValueStore.objects(__raw__=match).exclude(
+            'create_date', 'edit_date', 'silo_id', 'read_id')
 
         for col in getCompleteSiloColumnNames(id):
             if col not in shown_cols:
                 data = data.exclude(col)
 
-        sort = str(request.GET.get('sort', ''))
-        data = data.order_by(sort)
-        json_data = json.loads(data.to_json())
-        return JsonResponse(json_data, safe=False)
+        cache_key = None
+        if query_cache.is_enabled():
+            cache_key = query_cache.get_cache_key(
+                id, 'public', query, sorted(shown_cols), sort)
+            body = query_cache.get_cached(cache_key)
+            if body is not None:
+                return StreamingHttpResponse([body],
+                                             content_type='application/json')
+
+        data = data.order_by(sort).as_pymongo()
+        body = iter_json_array(data, JSONEncoder())
+        if cache_key is not None:
+            body = query_cache.cache_chunks(cache_key, body)
+        return StreamingHttpResponse(body, content_type='application/json')
 
 
 class CustomFormViewSet(mixins.CreateModelMixin,
@@ -313,13 +345,62 @@ class SilosByUser(viewsets.ReadOnlyModelViewSet):
     renderer_classes = (JSONRenderer,)
 
     def get_queryset(self):
-        silos = Silo.objects.all()
+        silos = Silo.objects.prefetch_related('silo_columns')
         user_id = self.request.query_params.get("user_id", None)
         if user_id:
             silos = silos.filter(owner__id=user_id)
         return silos
 
 
+def iter_data_body(fields, rows, page=None):
+    """
+    Yields the JSON object of a page of the data API, but for its opening
+    brace and the draw counter of the request, while the rows are read from
+    the cursor. The token of the next page is written after the rows as it
+    is only known once they have been read.
+    """
+    encoder = JSONEncoder()
+    yield encoder.encode(fields)[1:-1] + ', "data": '
+    for chunk in iter_json_array(rows, encoder):
+        yield chunk
+    if page is not None:
+        yield ', "next": ' + encoder.encode(page.next_cursor)
+    yield '}'
+
+
+def iter_data_response(draw, body):
+    """
+    Yields the page of the data API made of its draw counter and its body,
+    which can be shared by the requests of another draw
+    """
+    yield '{"draw": %d, ' % draw
+    for chunk in body:
+        yield chunk
+
+
+def get_filtered_count(collection, silo_id, pipeline, query, group,
+                       hint=None):
+    """
+    Returns the number of rows of a filtered query, cached for a few seconds
+    so that paging through the results does not count them again every time
+    """
+    digest = hashlib.md5(u'{}|{}'.format(query, group).encode('utf-8'))
+    key = FILTERED_COUNT_CACHE_KEY.format(silo_id, digest.hexdigest())
+    count = cache.get(key)
+    if count is None:
+        result = list(aggregate(collection, pipeline + [{'$count': 'count'}],
+                                hint))
+        count = result[0]['count'] if result else 0
+        cache.set(key, count, settings.SILO_FILTERED_COUNT_TIMEOUT)
+    return count
+
+
+def explain_response(collection, match, sort, skip, limit, hint):
+    result = explain(collection, match, sort, skip, limit, hint)
+    return HttpResponse(JSONEncoder().encode(result),
+                        content_type='application/json')
+
+
 class SiloViewSet(viewsets.ReadOnlyModelViewSet):
     """
     This viewset automatically provides `list` and `retrieve` actions.
@@ -334,30 +415,40 @@ class SiloViewSet(viewsets.ReadOnlyModelViewSet):
     filter_backends = (filters.DjangoFilterBackend,)
 
     def get_queryset(self):
+        # the serializer lists the columns of every silo
+        silos = Silo.objects.prefetch_related('silo_columns')
         user_uuid = self.request.GET.get('user_uuid')
         if user_uuid is not None:
             try:
                 tola_user = TolaUser.objects.get(tola_user_uuid=user_uuid)
             except TolaUser.DoesNotExist:
-                return Silo.objects.filter(owner=None)
+                return silos.filter(owner=None)
             else:
                 user = tola_user.user
-                return Silo.objects.filter(
+                return silos.filter(
                     Q(owner=user) | Q(public=True) | Q(shared=user)
                     | Q(owner__tola_user__organization=tola_user.organization))
         else:
             user = self.request.user
             if user.is_superuser:
-                return Silo.objects.all()
+                return silos
 
-            return Silo.objects.filter(Q(owner=user) | Q(public=True) |
-                                       Q(owner__tola_user__organization=\
-                                             user.tola_user.organization))
+            return silos.filter(Q(owner=user) | Q(public=True) |
+                                Q(owner__tola_user__organization=\
+                                      user.tola_user.organization))
 
     @detail_route()
     def data(self, request, id):
+        """
+        Returns the rows of a silo. The rows are paginated by offset with the
+        DataTables parameters (draw, start, length), or by keyset when the
+        cursor parameter is given: an empty cursor requests the first page
+        and the next token of the response requests the following one.
+        The query, group and sort are checked by silo.query_compiler, and
+        explain=1 returns the plan of the query instead of its rows.
+        """
         # calling get_object applies the permission classes to this query
-        self.get_object()
+        silo = self.get_object()
 
         # get the mongo collection
         collection = LabelValueStore._get_collection()
@@ -365,54 +456,155 @@ class SiloViewSet(viewsets.ReadOnlyModelViewSet):
         draw = int(request.GET.get("draw", 1))
         offset = int(request.GET.get('start', -1))
         length = int(request.GET.get('length', 10))
+        cursor = request.GET.get('cursor')
+        show_plan = request.GET.get('explain') == '1'
 
         # filtering syntax is the mongodb syntax
         query = request.GET.get('query', '{}')
         group = request.GET.get('group', '{}')
         sort = str(request.GET.get('sort', '{}'))
-        query_fields = json.loads(query)
-        group_fields = json.loads(group)
-        sort_fields = json.loads(sort)
+
+        cache_key = None
+        if query_cache.is_enabled() and not show_plan:
+            cache_key = query_cache.get_cache_key(
+                id, 'data', query, group, sort, offset, length, cursor)
+            body = query_cache.get_cached(cache_key)
+            if body is not None:
+                return StreamingHttpResponse(
+                    iter_data_response(draw, [body]),
+                    content_type='application/json')
+
+        try:
+            query_fields = parse_json_param(query, 'query')
+            match_query = compile_match(silo.data_id, query_fields)
+            group_fields = compile_group(parse_json_param(group, 'group'))
+            sort_fields = compile_sort(parse_json_param(sort, 'sort',
+                                                        ordered=True))
+        except InvalidQuery as e:
+            return HttpResponseBadRequest(str(e))
+        hint = get_index_hint(silo, match_query, sort_fields)
 
         # creating the aggregation pipeline
-        pipeline = [
-            {'$match': {'$and': [{'silo_id': int(id)}, query_fields]}},
-            {'$project': {
-                'create_date': 0,
-                'edit_date': 0,
-                'silo_id': 0,
-                'read_id': 0
-            }}
-        ]
+        match = {'$match': match_query}
+        project = {'$project': {
+            'create_date': 0,
+            'edit_date': 0,
+            'silo_id': 0,
+            'read_id': 0
+        }}
+        pipeline = [match, project]
         if group_fields:
             pipeline.append({'$group': group_fields})
+
+        if show_plan:
+            records_total = None
+        elif query_fields or group_fields:
+            records_total = get_filtered_count(collection, id, pipeline,
+                                               query, group, hint)
+        else:
+            records_total = get_silo_row_count(int(id))
+
         if sort_fields:
             pipeline.append({'$sort': sort_fields})
 
-        count_pipeline = pipeline + [{'$count': 'count'}]
-        count_cur = collection.aggregate(pipeline=count_pipeline)
-        list_count = list(count_cur)
-        if list_count:
-            count_result = list_count[0]
-            records_total = count_result['count']
+        page = None
+        if cursor is not None:
+            if group_fields:
+                return HttpResponseBadRequest(
+                    "A cursor can't be used with a group")
+            if length < 1:
+                return HttpResponseBadRequest(
+                    "The length must be positive with a cursor")
+            try:
+                keyset_sort = get_keyset_sort(sort_fields)
+                if cursor:
+                    match_query.setdefault('$and', []).append(
+                        get_keyset_match(keyset_sort,
+                                         decode_cursor(cursor, keyset_sort)))
+            except InvalidCursor as e:
+                return HttpResponseBadRequest(str(e))
+
+            if show_plan:
+                return explain_response(collection, match_query,
+                                        SON(keyset_sort), 0, length + 1,
+                                        hint)
+
+            # one more row than asked tells if there is a next page. A sort
+            # key the projection drops is kept for the position of the rows
+            # and removed from them once it has been read
+            sort_keys = set(key.split('.')[0] for key, direction in
+                            keyset_sort)
+            hidden_fields = [field for field in project['$project']
+                             if field in sort_keys]
+            pipeline = [match,
+                        {'$sort': SON(keyset_sort)},
+                        {'$limit': length + 1},
+                        {'$project': {field: 0 for field in project['$project']
+                                      if field not in sort_keys}}]
+            page = KeysetPage(aggregate(collection, pipeline, hint),
+                              keyset_sort, length, hidden_fields)
+            rows = page
         else:
-            records_total = 0
-
-        # workaround until the problem of javascript not increasing
-        # the value of length is fixed
-        if offset >= 0:
-            length = offset + length
-            pipeline.append({'$skip': offset})
-            pipeline.append({'$limit': length})
-
-        pipeline_cur = collection.aggregate(pipeline=pipeline)
-        pipeline_result = list(pipeline_cur)
-        data = JSONEncoder().encode(pipeline_result)
-        json_data = json.loads(data)
-
-        return JsonResponse({"data": json_data, "draw": draw,
-                             "recordsTotal": records_total,
-                             "recordsFiltered": records_total},  safe=False)
+            if show_plan:
+                return explain_response(collection, match_query, sort_fields,
+                                        max(offset, 0),
+                                        length if offset >= 0 else 0, hint)
+            if offset >= 0:
+                pipeline.append({'$skip': offset})
+                pipeline.append({'$limit': length})
+            rows = aggregate(collection, pipeline, hint)
+
+        fields = {"recordsTotal": records_total,
+                  "recordsFiltered": records_total}
+        body = iter_data_body(fields, rows, page)
+        if cache_key is not None:
+            body = query_cache.cache_chunks(cache_key, body)
+        return StreamingHttpResponse(iter_data_response(draw, body),
+                                     content_type='application/json')
+
+    @list_route()
+    def cache_stats(self, request):
+        """
+        Returns the hits, misses and hit rate of the cache of the data reads
+        """
+        if not request.user.is_superuser:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        return Response(query_cache.get_stats())
+
+
+    @detail_route()
+    def export(self, request, id):
+        """
+        Exports all the rows of a silo as gzipped NDJSON (output=ndjson) or
+        CSV (output=csv) in _id order. The query and shown_cols parameters
+        filter the rows and columns as for the data route, and after=<_id>
+        resumes an interrupted export after the last row received.
+        """
+        silo = self.get_object()
+        output = request.GET.get('output', 'ndjson')
+        compress = request.GET.get('compress', '1') != '0'
+        try:
+            query = parse_json_param(request.GET.get('query', '{}'), 'query')
+            cols = getSiloColumnNames(silo.pk)
+            if 'shown_cols' in request.GET:
+                cols = parse_json_list_param(request.GET['shown_cols'],
+                                             'shown_cols')
+            chunks = iter_bulk_export(silo, cols, query,
+                                      request.GET.get('after'), output,
+                                      compress)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        content_type = {'ndjson': 'application/x-ndjson',
+                        'csv': 'text/csv'}[output]
+        filename = 'silo_%s.%s' % (silo.pk, output)
+        if compress:
+            content_type = 'application/gzip'
+            filename += '.gz'
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="%s"' % \
+            filename
+        return response
 
 
 class TagViewSet(viewsets.ModelViewSet):
@@ -0,0 +1,188 @@
+"""
+Streaming exports of the rows of a silo.
+
+The rows are read through a batched cursor that only returns the exported
+columns and are written out a batch at a time, so an export of any size runs
+in constant memory. Bulk exports are ordered by _id and compressed on the
+fly, an interrupted transfer is resumed from the last _id received.
+"""
+import calendar
+import csv
+import json
+import time
+import zlib
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from datetime import datetime
+from django.utils.encoding import smart_text
+
+from silo.models import LabelValueStore, get_data_silo_id
+from silo.query_compiler import compile_filter
+from tola.util import JSONEncoder, makeQueryForHiddenRow
+
+# number of rows fetched from mongo and written to the response at a time
+EXPORT_BATCH_SIZE = 500
+
+
+BULK_EXPORT_FORMATS = ('ndjson', 'csv')
+
+
+class Echo(object):
+    """
+    A file-like object that returns what is written to it, so the output of
+    csv.writer can be yielded instead of buffered
+    """
+    def write(self, value):
+        return value
+
+
+def get_sort(sort):
+    """
+    Returns the pymongo sort of a mongoengine order_by key e.g. '-name'
+    """
+    if not sort:
+        return None
+    if sort[0] in '+-':
+        return [(sort[1:], -1 if sort[0] == '-' else 1)]
+    return [(sort, 1)]
+
+
+def get_export_cursor(silo_id, query, cols, sort=None,
+                      batch_size=EXPORT_BATCH_SIZE):
+    """
+    Returns a cursor over the rows of a silo matching the query, with only
+    the given columns
+
+    query -- a filter in the syntax of LabelValueStore.objects()
+    sort -- a column name, prefixed with - for descending order
+    """
+    # mongoengine translates the filter to its raw mongo form
+    queryset = LabelValueStore.objects(silo_id=get_data_silo_id(silo_id),
+                                       **query)
+    projection = {col: 1 for col in cols}
+    if '_id' not in projection:
+        projection['_id'] = 0
+    return LabelValueStore._get_collection().find(
+        queryset._query, projection, sort=get_sort(sort),
+        batch_size=batch_size)
+
+
+def format_export_value(val):
+    """
+    Formats a value for a CSV cell: dates as local time, ObjectIds as their
+    hex string
+    """
+    if isinstance(val, datetime):
+        timestamp = calendar.timegm(val.utctimetuple())
+        val = smart_text(time.strftime('%Y-%m-%d %H:%M:%S',
+                                       time.localtime(timestamp)))
+    elif isinstance(val, ObjectId):
+        val = smart_text(val)
+    elif isinstance(val, dict):
+        val = val.popitem() if val else val
+    return smart_text(val).decode("latin-1").encode("utf8")
+
+
+def iter_csv(rows, cols, batch_size=EXPORT_BATCH_SIZE, header=True):
+    """
+    Yields the CSV of the rows, a batch of rows at a time. The header is only
+    written if there is at least one row.
+    """
+    writer = csv.writer(Echo())
+    header = writer.writerow(cols) if header else None
+    batch = []
+    for row in rows:
+        if header is not None:
+            batch.append(header)
+            header = None
+        batch.append(writer.writerow(
+            [format_export_value(row.get(col, '')) for col in cols]))
+        if len(batch) >= batch_size:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def iter_ndjson(rows, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields the rows as newline delimited JSON, a batch of rows at a time
+    """
+    encoder = JSONEncoder()
+    batch = []
+    for row in rows:
+        batch.append(encoder.encode(row))
+        if len(batch) >= batch_size:
+            yield '\n'.join(batch) + '\n'
+            batch = []
+    if batch:
+        yield '\n'.join(batch) + '\n'
+
+
+def iter_gzip(chunks, compresslevel=6):
+    """
+    Yields the gzip compression of the chunks as they come
+    """
+    # 16 + MAX_WBITS makes zlib write the gzip header and trailer
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def get_bulk_export_filter(silo, query=None, after=None):
+    """
+    Returns the raw mongo filter of a bulk export: the rows of the silo that
+    pass its row filters and the query, after the given _id
+
+    query -- a mongo filter, checked and rewritten by
+        silo.query_compiler.compile_filter, or a list of row filters like
+        silo.rows_to_hide
+    after -- the hex string of the last _id already exported
+
+    raises InvalidQuery if the filter is not allowed
+    """
+    conditions = [{'silo_id': silo.data_id}]
+    row_filter = json.loads(makeQueryForHiddenRow(
+        json.loads(silo.rows_to_hide)))
+    if isinstance(query, list):
+        query = json.loads(makeQueryForHiddenRow(query))
+    elif query:
+        query = compile_filter(query)
+    for condition in (row_filter, query):
+        if condition:
+            conditions.append(condition)
+    if after:
+        try:
+            conditions.append({'_id': {'$gt': ObjectId(after)}})
+        except (InvalidId, TypeError):
+            raise ValueError("Invalid _id: %s" % after)
+    return {'$and': conditions}
+
+
+def iter_bulk_export(silo, cols, query=None, after=None, output='ndjson',
+                     compress=True, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields the rows of a silo in _id order as NDJSON or CSV, gzip compressed
+    unless compress is False. Every row carries its _id, the first column of
+    the CSV, so an export can be resumed with after set to the last one. A
+    resumed CSV has no header so that it can be appended to the first part.
+    """
+    if output not in BULK_EXPORT_FORMATS:
+        raise ValueError("Unknown export format: %s" % output)
+    cols = ['_id'] + [col for col in cols if col != '_id']
+    projection = {col: 1 for col in cols}
+    rows = LabelValueStore._get_collection().find(
+        get_bulk_export_filter(silo, query, after), projection,
+        sort=[('_id', 1)], batch_size=batch_size)
+    if output == 'csv':
+        chunks = iter_csv(rows, cols, batch_size, header=not after)
+    else:
+        chunks = iter_ndjson(rows, batch_size)
+    if compress:
+        chunks = iter_gzip(chunks)
+    return chunks
@@ -189,6 +189,25 @@ class EditColumnForm(forms.Form):
                     label="delete " + item, initial=False, required=False,
                     widget="")
 
+    def clean(self):
+        """
+        Rejects renaming a column to the name of another column, or two
+        columns to the same name, before anything is written to mongo
+        """
+        cleaned_data = super(EditColumnForm, self).clean()
+        columns = [name for name in self.fields
+                   if name + "_delete" in self.fields]
+        new_names = set()
+        for name in columns:
+            new_name = cleaned_data.get(name)
+            if not new_name or new_name == name:
+                continue
+            if new_name in self.fields or new_name in new_names:
+                raise forms.ValidationError(
+                    "A column named %s already exists" % new_name)
+            new_names.add(new_name)
+        return cleaned_data
+
 
 class MongoEditForm(forms.Form):
     """
@@ -17,7 +17,8 @@ from .models import GoogleCredentialsModel
 from apiclient.discovery import build
 #import gdata.spreadsheets.client
 
-from .models import Silo, Read, ReadType, ThirdPartyTokens, LabelValueStore, Tag
+from .models import Silo, Read, ReadType, ThirdPartyTokens, LabelValueStore, Tag, \
+    get_data_silo_id
 
 
 ########################################################################################
@@ -73,7 +74,7 @@ def export_to_google_spreadsheet(credential_json, silo_id, spreadsheet_key):
     worksheet_key = worksheets_feed.entry[0].id.text.rsplit("/", 1)[1]
     #print("worksheet_key: %s" % worksheet_key)
 
-    silo_data = LabelValueStore.objects(silo_id=silo_id)
+    silo_data = LabelValueStore.objects(silo_id=get_data_silo_id(silo_id))
 
     # Create a CellBatchUpdate object so that all cells update is sent as one http request
     batch = gdata.spreadsheets.data.BuildBatchCellsUpdate(spreadsheet_key, worksheet_key)
@@ -243,7 +244,7 @@ def import_from_google_spreadsheet(credential_json, silo, spreadsheet_key):
         for key, val in row_data.iteritems():
             #if the value of unique column is already in existing_silo_data then skip the row
             for unique_field in silo.unique_fields.all():
-                filter_criteria = {'silo_id': silo.id, unique_field.name: val}
+                filter_criteria = {'silo_id': silo.data_id, unique_field.name: val}
                 if LabelValueStore.objects.filter(**filter_criteria).count() > 0:
                     skip_row = True
                     continue
@@ -257,7 +258,7 @@ def import_from_google_spreadsheet(credential_json, silo, spreadsheet_key):
             setattr(lvs, key, val)
         if skip_row == True:
             continue
-        lvs.silo_id = silo.id
+        lvs.silo_id = silo.data_id
         lvs.create_date = timezone.now()
         lvs.save()
         lvs = LabelValueStore()
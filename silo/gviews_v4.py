@@ -22,8 +22,9 @@ from oauth2client.contrib import xsrfutil
 from oauth2client.client import AccessTokenCredentialsError
 
 from .models import GoogleCredentialsModel
-from .models import Silo, Read, ReadType, LabelValueStore
-from tola.util import (addColsToSilo, calculateFormulaCell, clean_data_obj,
+from .models import Silo, Read, ReadType, LabelValueStore, add_silo_rows, \
+    get_data_silo_id
+from tola.util import (addColsToSilo, get_formula_plan, clean_data_obj,
                        cleanKey, getSiloColumnNames, makeQueryForHiddenRow,
                        parseMathInstruction)
 
@@ -228,9 +229,11 @@ def import_from_gsheet_helper(user, silo_id, silo_name, spreadsheet_id,
         return msgs
 
     unique_fields = silo.unique_fields.all()
+    formula_plan = get_formula_plan(silo)
     skipped_rows = set()
     headers = []
     lvss = []
+    new_rows = 0
 
     # get the column names
     header = values.pop(0)
@@ -252,7 +255,7 @@ def import_from_gsheet_helper(user, silo_id, silo_name, spreadsheet_id,
             except AttributeError as e:
                 logger.warning(e)
         if filter_criteria:
-            filter_criteria.update({'silo_id': silo.id})
+            filter_criteria.update({'silo_id': silo.data_id})
             try:
                 lvs = LabelValueStore.objects.get(**filter_criteria)
                 lvs.edit_date = timezone.now()
@@ -271,14 +274,17 @@ def import_from_gsheet_helper(user, silo_id, silo_name, spreadsheet_id,
             val = smart_str(val, strings_only=True)
             setattr(lvs, key, val)
 
-        lvs.silo_id = silo.id
+        lvs.silo_id = silo.data_id
         lvs.read_id = gsheet_read.id
         lvs.create_date = timezone.now()
-        lvs = calculateFormulaCell(lvs, silo)
+        lvs = formula_plan.apply(lvs)
         if partialcomplete:
             lvss.append(lvs)
         else:
-            lvs.save()
+            new_rows += lvs.pk is None
+            lvs.save(record_write=False)
+    if not partialcomplete:
+        add_silo_rows(silo.id, new_rows)
     addColsToSilo(silo, headers)
 
     if skipped_rows:
@@ -380,8 +386,8 @@ def export_to_gsheet_helper(user, spreadsheet_id, silo_id, query, headers):
 
     # the first element in the array is a placeholder for column names
     rows = [{"values": []}]
-    silo_data = json.loads(LabelValueStore.objects(silo_id=silo_id,
-                                                   **query).to_json())
+    silo_data = json.loads(LabelValueStore.objects(
+        silo_id=get_data_silo_id(silo_id), **query).to_json())
     repeat_headers = []
     repeat_data = {}
     repeat_cells = {}
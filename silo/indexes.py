@@ -0,0 +1,224 @@
+"""
+Management of the indexes of the label_value_store collection.
+
+Every silo stores its rows in the same collection, so any lookup that is not
+backed by an index scans all the documents of a silo. Besides the base
+indexes on silo_id, a compound index on (silo_id, <unique fields>) is kept
+for every set of unique fields in use. The indexes are partial, only rows
+having the unique fields are indexed, and silos sharing the same unique
+fields share the index.
+"""
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+from silo.models import LabelValueStore, UniqueFields, Silo
+
+logger = logging.getLogger("silo")
+
+BASE_INDEXES = (
+    ('silo_id_1__id_1', [('silo_id', ASCENDING), ('_id', ASCENDING)]),
+    ('silo_id_1_create_date_-1', [('silo_id', ASCENDING),
+                                  ('create_date', DESCENDING)]),
+    # the rows changed since the last merge of a silo
+    ('silo_id_1_edit_date_-1', [('silo_id', ASCENDING),
+                                ('edit_date', DESCENDING)]),
+)
+
+# prefix of the names of the indexes handled by this module
+MANAGED_INDEX_PREFIX = 'silo_uf_'
+
+# CommCare cases are upserted on (silo_id, case_id)
+COMMCARE_FIELDS = ('case_id',)
+
+
+def get_collection():
+    return LabelValueStore._get_collection()
+
+
+def get_index_name(fields):
+    """
+    Returns the name of the managed index for a tuple of field names. A hash
+    is used as field names can exceed the maximum length of an index name.
+    """
+    digest = hashlib.md5(json.dumps(list(fields))).hexdigest()[:16]
+    return MANAGED_INDEX_PREFIX + digest
+
+
+def ensure_base_indexes(collection=None):
+    """
+    Creates the indexes every silo relies on, if they do not exist yet
+    """
+    collection = collection or get_collection()
+    for name, keys in BASE_INDEXES:
+        collection.create_index(keys, name=name, background=True)
+
+
+def ensure_fields_index(fields, collection=None):
+    """
+    Creates the partial compound index on (silo_id, *fields)
+
+    returns the name of the index or None if it could not be created
+    """
+    collection = collection or get_collection()
+    name = get_index_name(fields)
+    keys = [('silo_id', ASCENDING)] + [(f, ASCENDING) for f in fields]
+    partial_filter = {f: {'$exists': True} for f in fields}
+    try:
+        collection.create_index(keys, name=name, background=True,
+                                partialFilterExpression=partial_filter)
+    except OperationFailure as e:
+        # e.g. the collection reached the maximum number of indexes
+        logger.warning("Failed to create the index %s on %s: %s"
+                       % (name, fields, e))
+        return None
+    return name
+
+
+def get_silo_index_fields(silo):
+    """
+    Returns the list of field tuples that should be indexed for a silo,
+    capped at settings.SILO_MAX_INDEXES
+    """
+    index_fields = []
+    uf_names = tuple(sorted(set(
+        silo.unique_fields.values_list('name', flat=True))))
+    if uf_names:
+        index_fields.append(uf_names)
+    if (COMMCARE_FIELDS not in index_fields and
+            silo.reads.filter(type__read_type='CommCare').exists()):
+        index_fields.append(COMMCARE_FIELDS)
+
+    max_indexes = getattr(settings, 'SILO_MAX_INDEXES', 2)
+    if len(index_fields) > max_indexes:
+        logger.warning("Silo %s needs %s indexes, only %s are created"
+                       % (silo.pk, len(index_fields), max_indexes))
+        index_fields = index_fields[:max_indexes]
+    return index_fields
+
+
+def get_wanted_indexes():
+    """
+    Returns a dict of index name -> field tuple for all the silos according
+    to the metadata stored in the SQL database
+    """
+    uf_by_silo = {}
+    for silo_id, name in UniqueFields.objects.values_list('silo_id', 'name'):
+        uf_by_silo.setdefault(silo_id, set()).add(name)
+
+    commcare_silos = set(Silo.objects.filter(
+        reads__type__read_type='CommCare').values_list('id', flat=True))
+
+    max_indexes = getattr(settings, 'SILO_MAX_INDEXES', 2)
+    wanted = {}
+    for silo_id in set(uf_by_silo).union(commcare_silos):
+        index_fields = []
+        if silo_id in uf_by_silo:
+            index_fields.append(tuple(sorted(uf_by_silo[silo_id])))
+        if silo_id in commcare_silos and COMMCARE_FIELDS not in index_fields:
+            index_fields.append(COMMCARE_FIELDS)
+        for fields in index_fields[:max_indexes]:
+            wanted[get_index_name(fields)] = fields
+    return wanted
+
+
+def get_managed_indexes(collection=None):
+    """
+    Returns a dict of index name -> field tuple of the managed indexes that
+    exist in the collection
+    """
+    collection = collection or get_collection()
+    managed = {}
+    for name, info in collection.index_information().iteritems():
+        if name.startswith(MANAGED_INDEX_PREFIX):
+            managed[name] = tuple(k for k, _ in info['key'] if k != 'silo_id')
+    return managed
+
+
+def drop_unused_indexes(collection=None, wanted=None):
+    """
+    Drops the managed indexes no silo needs anymore
+
+    returns the list of dropped index names
+    """
+    collection = collection or get_collection()
+    if wanted is None:
+        wanted = get_wanted_indexes()
+    dropped = []
+    for name in get_managed_indexes(collection):
+        if name not in wanted:
+            try:
+                collection.drop_index(name)
+                dropped.append(name)
+            except OperationFailure as e:
+                logger.warning("Failed to drop the index %s: %s" % (name, e))
+    return dropped
+
+
+def ensure_silo_indexes(silo, collection=None):
+    """
+    Creates the indexes a silo needs, if they do not exist yet. Called
+    before the imports and merges, which leave the other indexes alone.
+
+    returns the list of index names of the silo
+    """
+    collection = collection or get_collection()
+    ensure_base_indexes(collection)
+    names = []
+    for fields in get_silo_index_fields(silo):
+        name = ensure_fields_index(fields, collection)
+        if name:
+            names.append(name)
+    return names
+
+
+def sync_silo_indexes(silo):
+    """
+    Creates the indexes a silo needs and drops the ones that became unused.
+    Has to be called whenever the UniqueFields of a silo change, as it reads
+    the unique fields of every silo.
+
+    returns the list of index names of the silo
+    """
+    collection = get_collection()
+    names = ensure_silo_indexes(silo, collection)
+    drop_unused_indexes(collection)
+    return names
+
+
+def reconcile_indexes(drop=True):
+    """
+    Makes the indexes of the collection match the SQL metadata
+
+    returns a dict with the created, dropped and missing index names
+    """
+    collection = get_collection()
+    ensure_base_indexes(collection)
+    wanted = get_wanted_indexes()
+    existing = get_managed_indexes(collection)
+
+    created = []
+    missing = []
+    for name, fields in wanted.iteritems():
+        if name in existing:
+            continue
+        if ensure_fields_index(fields, collection):
+            created.append(name)
+        else:
+            missing.append(name)
+
+    dropped = drop_unused_indexes(collection, wanted) if drop else []
+    return {'created': created, 'dropped': dropped, 'missing': missing}
+
+
+def get_index_sizes(collection=None):
+    """
+    Returns a dict of index name -> size in bytes
+    """
+    collection = collection or get_collection()
+    stats = collection.database.command('collstats', collection.name)
+    return stats.get('indexSizes', {})
@@ -0,0 +1,64 @@
+import cgi
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from tola.util import clean_data_obj, _clean_key
+
+
+def legacy_clean_data_obj(obj):
+    """
+    clean_data_obj as it was before the key cache and the flat row fast path,
+    kept to compare against
+    """
+    if not isinstance(obj, (dict, list)):
+        try:
+            obj = json.loads(obj)
+        except (ValueError, TypeError):
+            if isinstance(obj, str) or isinstance(obj, unicode):
+                obj = cgi.escape(obj)
+        return obj
+
+    if isinstance(obj, list):
+        return [legacy_clean_data_obj(v) for v in obj]
+
+    return {_clean_key(k): legacy_clean_data_obj(v) for k, v in obj.items()}
+
+
+def make_rows(num_rows, num_columns):
+    headers = ['Column %s.name' % i for i in range(num_columns)]
+    values = ['some text', '42', '3.14', '', 'Yes', 'A & B', '2018-05-09']
+    return [{h: values[(r + c) % len(values)] for c, h in enumerate(headers)}
+            for r in range(num_rows)]
+
+
+class Command(BaseCommand):
+    """
+    Usage: python manage.py benchmark_clean_data [--rows 10000] [--columns 50]
+    """
+    help = 'Measures the per row cost of clean_data_obj on a flat CSV-like ' \
+           'dataset, before and after the key cache and the flat row fast path'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10000)
+        parser.add_argument("--columns", type=int, default=50)
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        rows = make_rows(options['rows'], options['columns'])
+        for row in rows[:10]:
+            if legacy_clean_data_obj(row) != clean_data_obj(row):
+                self.stderr.write("The results differ for %s" % row)
+                return
+
+        results = {}
+        for name, func in (('before', legacy_clean_data_obj),
+                           ('after', clean_data_obj)):
+            seconds = min(timeit.repeat(lambda: [func(row) for row in rows],
+                                        repeat=options['repeat'], number=1))
+            results[name] = seconds
+            self.stdout.write("%-7s %10.2f us/row" % (
+                name, seconds * 1000000 / len(rows)))
+        self.stdout.write("speedup %10.2fx" % (
+            results['before'] / results['after']))
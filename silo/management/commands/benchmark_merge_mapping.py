@@ -0,0 +1,121 @@
+import timeit
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand
+from django.utils.encoding import smart_str
+
+from silo.merge import MappingError, RowMapping
+
+
+def legacy_map_row(mappings, unmapped_cols, row):
+    """
+    The mapping of a left row as merge_two_silos and appendTwoSilos applied
+    it before the mapping was compiled, kept to compare against
+    """
+    merged_row = OrderedDict()
+    for k, v in mappings.iteritems():
+        merge_type = v['merge_type']
+        left_cols = v['left_table_cols']
+        right_col = v['right_table_col']
+
+        if merge_type:
+            mapped_value = ''
+            for col in left_cols:
+                if merge_type == 'Sum' or merge_type == 'Avg':
+                    try:
+                        if mapped_value == '':
+                            mapped_value = float(row[col])
+                        else:
+                            mapped_value = float(mapped_value) \
+                                           + float(row[col])
+                    except Exception as e:
+                        raise MappingError(
+                            'Failed to apply %s to column, %s : %s '
+                            % (merge_type, col, e.message))
+                else:
+                    mapped_value += ' ' + smart_str(row[col])
+
+            if merge_type == 'Avg':
+                mapped_value = mapped_value / len(left_cols)
+        else:
+            col = str(left_cols[0])
+            if col == "silo_id": continue
+            try:
+                mapped_value = row[col]
+            except KeyError:
+                continue
+
+        merged_row[right_col] = mapped_value
+
+    for col in unmapped_cols:
+        if col in row:
+            merged_row[col] = row[col]
+    return merged_row
+
+
+def make_mapping(num_columns):
+    """
+    Returns a mapping of num_columns mapped columns, a quarter of each merge
+    type, and the left columns it reads
+    """
+    merge_types = ['', 'Sum', 'Avg', 'Concatenate']
+    mappings = OrderedDict()
+    for i in range(num_columns):
+        merge_type = merge_types[i % len(merge_types)]
+        left_cols = ['col %s' % i]
+        if merge_type:
+            left_cols.append('col %s b' % i)
+        mappings[str(i)] = {'left_table_cols': left_cols,
+                            'right_table_col': 'merged %s' % i,
+                            'merge_type': merge_type}
+    return mappings
+
+
+def make_rows(mappings, num_rows):
+    rows = []
+    for r in range(num_rows):
+        row = {}
+        for v in mappings.itervalues():
+            for c, col in enumerate(v['left_table_cols']):
+                row[col] = str(r + c) if v['merge_type'] else 'text %s' % r
+        row['unmapped'] = r
+        rows.append(row)
+    return rows
+
+
+class Command(BaseCommand):
+    """
+    Usage: python manage.py benchmark_merge_mapping [--rows 2000]
+        [--columns 200]
+    """
+    help = 'Measures the per row cost of the column mapping of a merge on ' \
+           'a wide mapping, before and after the mapping is compiled'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=2000)
+        parser.add_argument("--columns", type=int, default=200)
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        mappings = make_mapping(options['columns'])
+        unmapped_cols = ['unmapped']
+        rows = make_rows(mappings, options['rows'])
+        row_mapping = RowMapping(mappings, unmapped_cols)
+        for row in rows[:10]:
+            if legacy_map_row(mappings, unmapped_cols, row) != \
+                    row_mapping(row):
+                self.stderr.write("The results differ for %s" % row)
+                return
+
+        results = {}
+        for name, func in (
+                ('before', lambda row: legacy_map_row(mappings,
+                                                      unmapped_cols, row)),
+                ('after', row_mapping)):
+            seconds = min(timeit.repeat(lambda: [func(row) for row in rows],
+                                        repeat=options['repeat'], number=1))
+            results[name] = seconds
+            self.stdout.write("%-7s %10.2f us/row" % (
+                name, seconds * 1000000 / len(rows)))
+        self.stdout.write("speedup %10.2fx" % (
+            results['before'] / results['after']))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from commcare.pager import get_database, get_fetch_metrics, METRICS_COLLECTION
+
+
+class Command(BaseCommand):
+    """
+    Usage: python manage.py commcare_fetch_metrics [--domain <domain>]
+    """
+    help = 'Reports the daily CommCare fetch throughput of every domain'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--domain", type=str, default=None)
+
+    def handle(self, *args, **options):
+        if options['domain']:
+            domains = [options['domain']]
+        else:
+            domains = sorted(get_database()[METRICS_COLLECTION].distinct(
+                'domain'))
+        for domain in domains:
+            for day in get_fetch_metrics(domain):
+                self.stdout.write(
+                    "%-30s %s %6d pages %8d records %6d retries %6d throttled "
+                    "%8.1fs waited %s records/s" % (
+                        domain, day['day'], day.get('pages', 0),
+                        day.get('records', 0), day.get('retries', 0),
+                        day.get('throttled', 0), day.get('waited', 0),
+                        day['records_per_second']))
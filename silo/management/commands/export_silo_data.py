@@ -0,0 +1,60 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from silo.export import iter_bulk_export, BULK_EXPORT_FORMATS
+from silo.models import Silo
+from tola.util import getSiloColumnNames
+
+
+class Command(BaseCommand):
+    """
+    Usage: python manage.py export_silo_data <silo_id> [--output ndjson|csv]
+                [--file silo.ndjson.gz] [--query '{}'] [--after <_id>]
+                [--no-compress]
+    """
+    help = 'Exports all the rows of a silo as gzipped NDJSON or CSV, in _id ' \
+           'order so that an interrupted export can be resumed with --after'
+
+    def add_arguments(self, parser):
+        parser.add_argument("silo_id", type=int)
+        parser.add_argument("--output", choices=BULK_EXPORT_FORMATS,
+                            default='ndjson')
+        parser.add_argument("--file", help="Defaults to the standard output")
+        parser.add_argument("--query", default='{}',
+                            help="A mongo filter in JSON")
+        parser.add_argument("--columns", help="A JSON list of the columns, "
+                                              "defaults to all of them")
+        parser.add_argument("--after", help="Only export the rows after "
+                                            "this _id")
+        parser.add_argument("--no-compress", action='store_false',
+                            dest='compress')
+
+    def handle(self, *args, **options):
+        try:
+            silo = Silo.objects.get(pk=options['silo_id'])
+        except Silo.DoesNotExist:
+            raise CommandError("Silo %s does not exist" % options['silo_id'])
+
+        if options['columns']:
+            cols = json.loads(options['columns'])
+        else:
+            cols = getSiloColumnNames(silo.pk)
+        try:
+            chunks = iter_bulk_export(silo, cols, json.loads(options['query']),
+                                      options['after'], options['output'],
+                                      options['compress'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        # gzip members can be concatenated, so a resumed export can be
+        # appended to the file of the interrupted one
+        if options['file']:
+            mode = 'ab' if options['after'] else 'wb'
+            with open(options['file'], mode) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        else:
+            for chunk in chunks:
+                sys.stdout.write(chunk)
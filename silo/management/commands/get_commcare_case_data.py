@@ -7,8 +7,9 @@ from django.contrib.auth.models import User
 
 from silo.models import LabelValueStore, Read, Silo, ThirdPartyTokens, ColumnOrderMapping, siloHideFilter, ReadType
 from tola.util import getNewestDataDate
+from silo.indexes import ensure_silo_indexes
 
-from commcare.tasks import fetchCommCareData, addExtraFields
+from commcare.tasks import fetchCommCareData, addExtraFields, mergeCommCareResults
 
 class Command(BaseCommand):
     """
@@ -48,15 +49,15 @@ class Command(BaseCommand):
                 if metadata['meta']['total_count'] == 0:
                     self.stdout.write('No new commcare data for READ_ID, "%s"' % read.pk)
 
+                # the updates are upserts on (silo_id, case_id)
+                ensure_silo_indexes(silo)
                 #Now call the update data function in commcare tasks
                 auth = {'Authorization': 'ApiKey %(u)s:%(a)s' % {'u' : commcare_token.username, 'a' : commcare_token.token}}
                 url += "50"
-                data_raw = fetchCommCareData(url, auth, True, 0, metadata['meta']['total_count'], 50, silo.id, read.id, True)
+                data_raw = fetchCommCareData(url, auth, True, 0, metadata['meta']['total_count'], 50, silo.id, read.id, True, metadata['meta'])
                 data_collects = data_raw.apply_async()
-                data_retrieval = [v.get() for v in data_collects]
-                columns = set()
-                for data in data_retrieval:
-                    columns = columns.union(data)
+                data_retrieval = mergeCommCareResults([v.get() for v in data_collects])
+                columns = data_retrieval['columns']
                 #correct the columns
                 try: columns.remove("")
                 except KeyError as e: pass
@@ -105,4 +106,4 @@ class Command(BaseCommand):
                     silo_hide_filter.save()
                 except siloHideFilter.DoesNotExist as e:
                     siloHideFilter.objects.create(silo_id=silo.id, hiddenColumns=json.dumps(["case_id"]), hiddenRows="[]")
-                self.stdout.write('Successfully fetched the READ_ID, "%s", from CommCare' % read.pk)
+                self.stdout.write('Successfully fetched the READ_ID, "%s", from CommCare: %s' % (read.pk, data_retrieval['counts']))
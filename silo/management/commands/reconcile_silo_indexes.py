@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from silo.indexes import (reconcile_indexes, get_index_sizes,
+                          get_managed_indexes, get_wanted_indexes)
+
+
+class Command(BaseCommand):
+    """
+    Usage: python manage.py reconcile_silo_indexes [--dry-run] [--keep]
+    """
+    help = 'Makes the indexes of label_value_store match the unique fields ' \
+           'of the silos and reports the size of every index'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action='store_true', dest='dry_run',
+                            help="Only report the differences")
+        parser.add_argument("--keep", action='store_true', dest='keep',
+                            help="Do not drop indexes no silo needs anymore")
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            wanted = get_wanted_indexes()
+            existing = get_managed_indexes()
+            for name in sorted(set(wanted) - set(existing)):
+                self.stdout.write("missing: %s %s" % (name, list(wanted[name])))
+            for name in sorted(set(existing) - set(wanted)):
+                self.stdout.write("unused: %s %s" % (name,
+                                                     list(existing[name])))
+        else:
+            result = reconcile_indexes(drop=not options['keep'])
+            for name in result['created']:
+                self.stdout.write("created: %s" % name)
+            for name in result['dropped']:
+                self.stdout.write("dropped: %s" % name)
+            for name in result['missing']:
+                self.stderr.write("could not create: %s" % name)
+
+        managed = get_managed_indexes()
+        total = 0
+        for name, size in sorted(get_index_sizes().iteritems()):
+            total += size
+            fields = managed.get(name)
+            self.stdout.write("%-40s %12d bytes %s" % (
+                name, size, list(fields) if fields else ''))
+        self.stdout.write("%-40s %12d bytes" % ('total', total))
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+
+from silo.models import (Silo, LabelValueStore, get_row_count_collection,
+                         set_silo_rows, reset_silo_rows)
+
+
+class Command(BaseCommand):
+    """
+    Usage: python manage.py repair_silo_row_counts [--silo_id 1 --silo_id 2]
+                                                   [--dry-run]
+    """
+    help = 'Recounts the rows of the silos and fixes the row counters that ' \
+           'drifted from the actual number of rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--silo_id", type=int, action='append',
+                            dest='silo_ids', help="Only repair these silos")
+        parser.add_argument("--dry-run", action='store_true', dest='dry_run',
+                            help="Only report the drifted counters")
+
+    def handle(self, *args, **options):
+        silo_ids = options['silo_ids']
+        if silo_ids is None:
+            silo_ids = list(Silo.objects.values_list('id', flat=True))
+
+        # one pass over the rows counts all the silos at once
+        actual = {}
+        for doc in LabelValueStore._get_collection().aggregate([
+                {'$match': {'silo_id': {'$in': silo_ids}}},
+                {'$group': {'_id': '$silo_id', 'count': {'$sum': 1}}}]):
+            actual[doc['_id']] = doc['count']
+
+        counters = {}
+        for doc in get_row_count_collection().find():
+            counters[doc['_id']] = doc.get('count')
+
+        repaired = 0
+        for silo_id in silo_ids:
+            count = actual.get(silo_id, 0)
+            counter = counters.get(silo_id)
+            if counter is None or counter == count:
+                continue
+            self.stdout.write("silo %s: counter %s, actual %s" % (
+                silo_id, counter, count))
+            if not options['dry_run']:
+                set_silo_rows(silo_id, count)
+            repaired += 1
+
+        # counters of silos that no longer exist
+        if not options['silo_ids']:
+            for silo_id in set(counters) - set(silo_ids):
+                self.stdout.write("silo %s: deleted" % silo_id)
+                if not options['dry_run']:
+                    reset_silo_rows(silo_id)
+
+        self.stdout.write("%s of %s counters %s" % (
+            repaired, len(silo_ids),
+            'drifted' if options['dry_run'] else 'repaired'))
@@ -5,7 +5,7 @@ import pymongo
 from bson.objectid import ObjectId
 import json
 import random
-from silo.models import LabelValueStore, Silo
+from silo.models import LabelValueStore, Silo, bump_silo_version
 
 
 class Command(BaseCommand):
@@ -77,6 +77,10 @@ class Command(BaseCommand):
 
             counter += 1
 
+        if options['write']:
+            for silo_id in found_silos:
+                bump_silo_version(silo_id)
+
         print '\n#########################################'
         print '#########################################'
         print ''
@@ -0,0 +1,382 @@
+"""
+Bulk writes of the rows of merged silos.
+
+A merge upserts every row of its source silos into the merged silo, keyed on
+the unique fields. The upserts are buffered and sent as unordered bulk
+writes, and the source rows are read with a projection of the columns the
+merge uses.
+
+A merge records a high-water mark of each source silo: the time it started,
+the last _id of the silo and its number of rows up to that _id. The next
+merge only reads the rows inserted or stamped with a create_date or
+edit_date since then, and finds the rows deleted meanwhile by counting the
+rows up to the _id again. The writes that change rows without stamping them
+bump the rewrite counter of the silo, which makes the next merge read all
+its rows.
+
+The column mapping of a merge is compiled once into a RowMapping, one
+function per mapped column with its columns and merge type resolved, which
+is applied to every row of the left silo.
+
+An append that rebuilds its merged silo writes the new rows under a staging
+silo_id, the merged silo keeps its rows until the new ones are complete.
+The new rows are then published by pointing the data_silo_id of the silo to
+the staging silo_id, and the old rows are deleted. The readers of a silo
+find its rows under Silo.data_id, the functions taking the id of a silo
+resolve it, the others are given the silo_id of the rows.
+"""
+from bson import ObjectId
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_text, smart_str
+from pymongo import DESCENDING, DeleteMany, UpdateOne
+
+from silo.models import (Silo, bump_silo_version, get_data_silo_id,
+                         get_silo_rewrites)
+
+# the mark of a silo without rows, lower than any _id
+FIRST_ID = ObjectId('0' * 24)
+
+
+def iter_silo_rows(collection, silo_id, columns, batch_size=None,
+                   query=None):
+    """
+    Yields the rows of a silo as plain dicts with only the given columns
+
+    query -- further conditions on the rows
+    """
+    projection = dict.fromkeys(columns, 1)
+    projection['_id'] = 0
+    condition = dict(query or {}, silo_id=silo_id)
+    return collection.find(
+        condition, projection,
+        batch_size=batch_size or settings.SILO_MERGE_BATCH_SIZE)
+
+
+def get_key(row, fields):
+    return tuple(row.get(field) for field in fields)
+
+
+def iter_keys(collection, query, fields):
+    """
+    Yields the values of the fields of the rows matching the query
+    """
+    projection = dict.fromkeys(fields, 1)
+    projection['_id'] = 0
+    for row in collection.find(query, projection,
+                               batch_size=settings.SILO_MERGE_BATCH_SIZE):
+        yield get_key(row, fields)
+
+
+def iter_rows_by_keys(collection, silo_id, columns, fields, keys,
+                      batch_size=None):
+    """
+    Yields the rows of a silo whose fields have one of the values in keys,
+    querying a batch of keys at a time
+    """
+    batch_size = batch_size or settings.SILO_MERGE_BATCH_SIZE
+    keys = list(keys)
+    for i in xrange(0, len(keys), batch_size):
+        batch = keys[i:i + batch_size]
+        if len(fields) == 1:
+            query = {fields[0]: {'$in': [key[0] for key in batch]}}
+        else:
+            query = {'$or': [dict(zip(fields, key)) for key in batch]}
+        for row in iter_silo_rows(collection, silo_id, columns, batch_size,
+                                  query):
+            yield row
+
+
+def get_watermark(collection, silo_id):
+    """
+    Returns the high-water mark of a silo, to be taken before its rows are
+    read for a merge
+    """
+    date = timezone.now()
+    data_id = get_data_silo_id(silo_id)
+    last = collection.find_one({'silo_id': data_id}, {'_id': 1},
+                               sort=[('_id', DESCENDING)])
+    last_id = last['_id'] if last is not None else FIRST_ID
+    return {
+        'date': date.isoformat(),
+        'id': str(last_id),
+        'rows': collection.count({'silo_id': data_id,
+                                  '_id': {'$lte': last_id}}),
+        'rewrites': get_silo_rewrites(silo_id),
+    }
+
+
+def get_changes(silo_id, mark):
+    """
+    Returns the filter of the rows of a silo inserted or changed since its
+    mark, or None if all the rows have to be read: there is no mark, or the
+    rows were rewritten since
+    """
+    if not mark or mark['rewrites'] != get_silo_rewrites(silo_id):
+        return None
+    since = parse_datetime(mark['date'])
+    return {'silo_id': get_data_silo_id(silo_id), '$or': [
+        {'_id': {'$gt': ObjectId(mark['id'])}},
+        {'create_date': {'$gte': since}},
+        {'edit_date': {'$gte': since}},
+    ]}
+
+
+def get_insertions(collection, silo_id, mark):
+    """
+    Returns the filter of the rows inserted in a silo since its mark, or None
+    if the silo had other changes since, or has no mark
+    """
+    changes = get_changes(silo_id, mark)
+    if changes is None or has_deletions(collection, silo_id, mark):
+        return None
+    last_id = ObjectId(mark['id'])
+    changes['_id'] = {'$lte': last_id}
+    if collection.find_one(changes, {'_id': 1}) is not None:
+        return None
+    return {'silo_id': changes['silo_id'], '_id': {'$gt': last_id}}
+
+
+def has_deletions(collection, silo_id, mark):
+    """
+    Returns whether rows of a silo were deleted since its mark
+    """
+    rows = collection.count({'silo_id': get_data_silo_id(silo_id),
+                             '_id': {'$lte': ObjectId(mark['id'])}})
+    return rows < mark['rows']
+
+
+def delete_orphan_rows(collection, silo_id, fields, source_ids):
+    """
+    Deletes the rows of a merged silo whose fields match no row of its
+    source silos, returns the number of rows deleted
+    """
+    keys = set()
+    for source_id in source_ids:
+        keys.update(iter_keys(collection, {'silo_id': source_id}, fields))
+
+    orphans = []
+    for row in collection.find({'silo_id': silo_id},
+                               dict.fromkeys(fields, 1),
+                               batch_size=settings.SILO_MERGE_BATCH_SIZE):
+        if get_key(row, fields) not in keys:
+            orphans.append(row['_id'])
+
+    batch_size = settings.SILO_MERGE_BATCH_SIZE
+    requests = [DeleteMany({'_id': {'$in': orphans[i:i + batch_size]}})
+                for i in xrange(0, len(orphans), batch_size)]
+    if not requests:
+        return 0
+    return collection.bulk_write(requests, ordered=False).deleted_count
+
+
+def get_staging_id(silo):
+    """
+    Returns the silo_id to rebuild the rows of a silo under: the one of its
+    two negative ids its rows are not under. Negative ids are never those of
+    a silo.
+    """
+    staging_id = -2 * silo.pk
+    if silo.data_id == staging_id:
+        staging_id -= 1
+    return staging_id
+
+
+def publish_silo_rows(collection, silo, staging_id):
+    """
+    Replaces the rows of a silo by the rows written under staging_id, and
+    deletes the replaced rows
+
+    The silo is pointed to the new rows by one update of its data_silo_id,
+    the readers see either all the old rows or all the new ones. A reader
+    still reading the old rows once they are deleted sees a part of them.
+    """
+    old_id = silo.data_id
+    Silo.objects.filter(pk=silo.pk).update(data_silo_id=staging_id)
+    silo.data_silo_id = staging_id
+    collection.delete_many({'silo_id': old_id})
+    bump_silo_version(silo.pk)
+
+
+class InsertBuffer(object):
+    """
+    Buffers rows and writes them with one insert_many per batch
+
+    progress -- called with the number of rows of every batch written
+    """
+
+    def __init__(self, collection, batch_size=None, progress=None):
+        self.collection = collection
+        self.batch_size = batch_size or settings.SILO_MERGE_BATCH_SIZE
+        self.progress = progress
+        self.rows = []
+        self.inserted = 0
+
+    def insert(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        result = self.collection.insert_many(self.rows, ordered=False)
+        self.inserted += len(result.inserted_ids)
+        if self.progress is not None:
+            self.progress(len(self.rows))
+        self.rows = []
+
+
+class UpsertBuffer(object):
+    """
+    Buffers upserts and writes them as unordered bulk writes
+
+    The operations of an unordered bulk write may be applied in any order,
+    so the buffer is written out before an upsert of a filter it already
+    holds, for the later row to still win as with one write per row.
+
+    progress -- called with the number of rows of every batch written
+    """
+
+    def __init__(self, collection, batch_size=None, progress=None):
+        self.collection = collection
+        self.batch_size = batch_size or settings.SILO_MERGE_BATCH_SIZE
+        self.progress = progress
+        self.requests = []
+        self.keys = set()
+        self.upserted = 0
+        self.matched = 0
+
+    def upsert(self, criteria, row):
+        key = tuple(sorted((name, force_text(value))
+                           for name, value in criteria.iteritems()))
+        if key in self.keys:
+            self.flush()
+        self.keys.add(key)
+        self.requests.append(UpdateOne(criteria, {'$set': row}, upsert=True))
+        if len(self.requests) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.requests:
+            return
+        result = self.collection.bulk_write(self.requests, ordered=False)
+        self.upserted += result.upserted_count
+        self.matched += result.matched_count
+        if self.progress is not None:
+            self.progress(len(self.requests))
+        self.requests = []
+        self.keys = set()
+
+
+class MappingError(ValueError):
+    """
+    A value of a row can't be mapped, e.g. a text in a Sum
+    """
+
+
+def _rename(pairs):
+    def rename(row, merged_row):
+        for left_col, right_col in pairs:
+            # a column removed from the left silo since the mapping was made
+            # is skipped
+            if left_col in row:
+                merged_row[right_col] = row[left_col]
+    return rename
+
+
+def _failed(merge_type, left_cols, row):
+    """
+    Returns the MappingError of the first column of a Sum or Avg that is
+    not a number
+    """
+    for col in left_cols:
+        try:
+            float(row[col])
+        except (KeyError, TypeError, ValueError) as e:
+            return MappingError('Failed to apply %s to column, %s : %s '
+                                % (merge_type, col, e.message))
+
+
+def _sum(left_cols, right_col):
+    def total(row, merged_row):
+        try:
+            merged_row[right_col] = sum([float(row[col]) for col in left_cols])
+        except (KeyError, TypeError, ValueError):
+            raise _failed('Sum', left_cols, row)
+    return total
+
+
+def _avg(left_cols, right_col):
+    count = len(left_cols)
+
+    def average(row, merged_row):
+        try:
+            merged_row[right_col] = sum(
+                [float(row[col]) for col in left_cols]) / count
+        except (KeyError, TypeError, ValueError):
+            raise _failed('Avg', left_cols, row)
+    return average
+
+
+def _join(left_cols, right_col):
+    def join(row, merged_row):
+        merged_row[right_col] = ''.join([' ' + smart_str(row[col])
+                                         for col in left_cols])
+    return join
+
+
+class RowMapping(object):
+    """
+    The column mapping of a merge compiled into the functions writing the
+    mapped columns of a row of the left silo, in the order of the mapping
+
+    The mapped value of a column is, by merge type, the value of its left
+    column, the Sum or Avg of its left columns as floats, or else the left
+    columns joined by spaces. The unmapped columns are then copied.
+    """
+
+    def __init__(self, mappings, unmapped_cols):
+        self.steps = []
+        self.columns = set(unmapped_cols)
+        # the consecutive renames are done by one step
+        pairs = None
+        for v in mappings.itervalues():
+            merge_type = v['merge_type']
+            left_cols = list(v['left_table_cols'])
+            right_col = v['right_table_col']
+            self.columns.update(left_cols)
+            if not merge_type:
+                if left_cols[0] == 'silo_id':
+                    continue
+                if pairs is None:
+                    pairs = []
+                    self.steps.append(_rename(pairs))
+                pairs.append((left_cols[0], right_col))
+                continue
+            pairs = None
+            if merge_type == 'Sum':
+                self.steps.append(_sum(left_cols, right_col))
+            elif merge_type == 'Avg':
+                self.steps.append(_avg(left_cols, right_col))
+            else:
+                self.steps.append(_join(left_cols, right_col))
+        self.unmapped_cols = list(unmapped_cols)
+
+    def __call__(self, row):
+        """
+        Returns the mapped row, raises MappingError if a value can't be
+        mapped
+
+        The row is a plain dict, the merged silo does not keep the order of
+        the fields of its rows: the rows of the right silo are copied from
+        the dicts read from MongoDB.
+        """
+        merged_row = {}
+        for step in self.steps:
+            step(row, merged_row)
+        for col in self.unmapped_cols:
+            if col in row:
+                merged_row[col] = row[col]
+        return merged_row
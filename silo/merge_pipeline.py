@@ -0,0 +1,240 @@
+"""
+Merges and appends of silos run inside MongoDB.
+
+The column mapping of a merge is compiled into the expressions of an
+aggregation pipeline reshaping the rows of a source silo the way
+merge_two_silos and appendTwoSilos do in Python, and the pipeline writes the
+reshaped rows into the merged silo with $merge. On merges, the rows sharing
+the same unique fields are combined by a $group and matched to the row of
+the merged silo having these unique fields by a $lookup, so that they update
+it like the upserts of the Python path.
+
+The pipelines are only run if they give the same result as the Python path:
+the server supports them, every name is a plain field path and no row has
+a value the expressions would read differently than Python, e.g. a Sum of
+a column with text or a merged silo row without its unique fields. Anything
+else is left to the Python path.
+"""
+import logging
+from collections import OrderedDict
+
+from django.utils import timezone
+from pymongo.errors import OperationFailure
+
+from tola.util import get_mongo_version
+
+logger = logging.getLogger("silo")
+
+# $merge into the collection being aggregated needs 4.4, the $lookup of the
+# merged rows uses the indexes of the unique fields from 5.0
+SERVER_MERGE_VERSION = (5, 0)
+
+# temporary fields holding the result of the checks of a row and the _id of
+# the first row of a group, cleanKey never lets a column start with an
+# underscore
+CHECK_FIELD = '_merge_check'
+ORDER_FIELD = '_merge_order'
+
+# the fields the merge sets itself
+MERGED_FIELDS = frozenset(['silo_id', 'create_date'])
+
+
+def _is_field_path(name):
+    return isinstance(name, basestring) and bool(name) and \
+        name[0] != '$' and '.' not in name and name != '_id'
+
+
+def _field(name):
+    return '$' + name
+
+
+def _if_present(name, default):
+    """
+    Returns the expression of a column, or of default if the row does not
+    have the column, as the Python path leaves the value already mapped
+    """
+    return {'$cond': [{'$eq': [{'$type': _field(name)}, 'missing']},
+                      default, _field(name)]}
+
+
+def _to_double(name):
+    return {'$convert': {'input': _field(name), 'to': 'double',
+                         'onError': None, 'onNull': None}}
+
+
+def get_copy_fields(columns):
+    """
+    Returns the fields of the rows copied as they are, the rows of the right
+    silo, or None if a column can't be copied by a pipeline
+    """
+    fields = OrderedDict()
+    for name in columns:
+        if name in MERGED_FIELDS:
+            continue
+        if not _is_field_path(name):
+            return None
+        fields[name] = _field(name)
+    return fields
+
+
+def compile_mapping(mappings, unmapped_cols):
+    """
+    Returns the fields of the rows of the left silo reshaped by the column
+    mapping and the checks of the values the Python path would reject or
+    convert differently, or (None, None) if the mapping can't be compiled
+    """
+    fields = OrderedDict()
+    checks = []
+    for v in mappings.itervalues():
+        merge_type = v['merge_type']
+        left_cols = v['left_table_cols']
+        right_col = v['right_table_col']
+        if not left_cols or not _is_field_path(right_col) or \
+                not all(_is_field_path(col) for col in left_cols):
+            return None, None
+
+        if merge_type == 'Sum' or merge_type == 'Avg':
+            values = [_to_double(col) for col in left_cols]
+            checks.extend({'$eq': [value, None]} for value in values)
+            expression = {'$add': values}
+            if merge_type == 'Avg':
+                expression = {'$divide': [expression, len(left_cols)]}
+        elif merge_type:
+            # Python writes the values with smart_str, only text is written
+            # the same way by $concat
+            parts = []
+            for col in left_cols:
+                checks.append({'$ne': [{'$type': _field(col)}, 'string']})
+                parts.extend([' ', _field(col)])
+            expression = {'$concat': parts}
+        else:
+            col = left_cols[0]
+            if col == 'silo_id':
+                continue
+            if right_col in fields:
+                expression = _if_present(col, fields[right_col])
+            else:
+                expression = _field(col)
+        fields[right_col] = expression
+
+    for col in unmapped_cols:
+        if not _is_field_path(col):
+            return None, None
+        if col in fields:
+            fields[col] = _if_present(col, fields[col])
+        else:
+            fields[col] = _field(col)
+
+    for name in MERGED_FIELDS:
+        fields.pop(name, None)
+    return fields, checks
+
+
+def _needs_python(collection, silo_id, fields, checks, key_fields):
+    """
+    Returns whether a row of the silo fails the checks or has no value for
+    one of the unique fields
+    """
+    conditions = [{name: None} for name in key_fields]
+    project = {'_id': 0}
+    for name in key_fields:
+        project[name] = fields[name]
+    if checks:
+        project[CHECK_FIELD] = {'$or': checks}
+        conditions.append({CHECK_FIELD: True})
+    if not conditions:
+        return False
+    pipeline = [
+        {'$match': {'silo_id': silo_id}},
+        {'$project': project},
+        {'$match': {'$or': conditions}},
+        {'$limit': 1},
+    ]
+    return any(True for _ in collection.aggregate(pipeline,
+                                                  allowDiskUse=True))
+
+
+def get_pipeline(collection, silo_id, merged_silo_id, fields, key_fields):
+    """
+    Returns the pipeline writing the reshaped rows of a silo into the merged
+    silo, updating the rows having the same unique fields if key_fields is
+    given, else inserting them
+    """
+    project = dict(fields, _id=0)
+    if key_fields:
+        project[ORDER_FIELD] = '$_id'
+    pipeline = [
+        {'$match': {'silo_id': silo_id}},
+        {'$sort': {'_id': 1}},
+        {'$project': project},
+        {'$addFields': {'silo_id': {'$literal': merged_silo_id},
+                        'create_date': {'$literal': timezone.now()}}},
+    ]
+    if key_fields:
+        keys = OrderedDict(('k%d' % i, _field(name))
+                           for i, name in enumerate(key_fields))
+        match = {name: {'$exists': True} for name in key_fields}
+        match['silo_id'] = merged_silo_id
+        match['$expr'] = {'$and': [
+            {'$eq': [_field(name), '$$k%d' % i]}
+            for i, name in enumerate(key_fields)]}
+        pipeline += [
+            # the rows with the same unique fields are merged in _id order,
+            # the last one wins as with one upsert per row
+            {'$group': {'_id': keys, 'row': {'$mergeObjects': '$$ROOT'},
+                        ORDER_FIELD: {'$min': _field(ORDER_FIELD)}}},
+            # the groups are written in the order of their first row
+            {'$sort': {ORDER_FIELD: 1}},
+            {'$lookup': {
+                'from': collection.name,
+                'let': {var: '$_id.' + var for var in keys},
+                'pipeline': [{'$match': match}, {'$project': {'_id': 1}},
+                             {'$limit': 1}],
+                'as': 'merged',
+            }},
+            {'$replaceRoot': {'newRoot': {'$mergeObjects': [
+                '$row', {'_id': {'$arrayElemAt': ['$merged._id', 0]}}]}}},
+            {'$unset': ORDER_FIELD},
+        ]
+    pipeline.append({'$merge': {
+        'into': collection.name, 'on': '_id', 'whenMatched': 'merge',
+        'whenNotMatched': 'insert'}})
+    return pipeline
+
+
+def merge_on_server(collection, merged_silo_id, sources, upsert=True,
+                    progress=None):
+    """
+    Writes the rows of the sources into the merged silo, in the order of the
+    sources, with one pipeline each
+
+    sources -- a list of (silo_id, fields, checks, key_fields) where fields
+        is None if they can't be compiled
+    upsert -- updates the merged rows having the same key_fields, else the
+        rows are inserted
+    progress -- called with the number of rows of every source written
+
+    returns False if the rows have to be merged by the Python path, which
+    has to delete what was inserted if upsert is False
+    """
+    try:
+        if get_mongo_version(collection) < SERVER_MERGE_VERSION:
+            return False
+        for silo_id, fields, checks, key_fields in sources:
+            key_fields = key_fields if upsert else []
+            if not fields or not set(key_fields).issubset(fields) or \
+                    _needs_python(collection, silo_id, fields, checks,
+                                  key_fields):
+                return False
+        for silo_id, fields, checks, key_fields in sources:
+            pipeline = get_pipeline(collection, silo_id, merged_silo_id,
+                                    fields, key_fields if upsert else None)
+            for _ in collection.aggregate(pipeline, allowDiskUse=True):
+                pass
+            if progress is not None:
+                progress(collection.count({'silo_id': silo_id}))
+    except OperationFailure as e:
+        logger.warning("The merge into silo %s failed on the server: %s"
+                       % (merged_silo_id, e))
+        return False
+    return True
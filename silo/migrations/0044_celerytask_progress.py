@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silo', '0043_auto_20180509_0153'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='celerytask',
+            name='rows_processed',
+            field=models.PositiveIntegerField(default=0, verbose_name='Rows processed'),
+        ),
+        migrations.AddField(
+            model_name='celerytask',
+            name='bytes_processed',
+            field=models.BigIntegerField(default=0, verbose_name='Bytes processed'),
+        ),
+        migrations.AddField(
+            model_name='celerytask',
+            name='bytes_total',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Total bytes'),
+        ),
+        migrations.AddField(
+            model_name='celerytask',
+            name='rows_per_second',
+            field=models.FloatField(blank=True, null=True, verbose_name='Rows per second'),
+        ),
+        migrations.AddField(
+            model_name='celerytask',
+            name='progress_updated',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
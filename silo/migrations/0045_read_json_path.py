@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silo', '0044_celerytask_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='read',
+            name='json_path',
+            field=models.CharField(blank=True, help_text=b'Dot separated keys leading to the list of records if the JSON data wraps it, e.g. data.results', max_length=200, null=True, verbose_name=b'JSON path'),
+        ),
+    ]
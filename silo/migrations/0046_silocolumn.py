@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def columns_to_rows(apps, schema_editor):
+    Silo = apps.get_model('silo', 'Silo')
+    SiloColumn = apps.get_model('silo', 'SiloColumn')
+    for silo in Silo.objects.only('columns', 'hidden_columns').iterator():
+        hidden = set(json.loads(silo.hidden_columns or '[]'))
+        rows = []
+        seen = set()
+        for col in json.loads(silo.columns or '[]'):
+            if isinstance(col, basestring):
+                name, type = col, 'string'
+            else:
+                name, type = col['name'], col.get('type') or 'string'
+            if name in seen:
+                continue
+            seen.add(name)
+            rows.append(SiloColumn(silo_id=silo.pk, name=name, type=type,
+                                   position=len(rows), hidden=name in hidden))
+        SiloColumn.objects.bulk_create(rows)
+
+
+def rows_to_columns(apps, schema_editor):
+    Silo = apps.get_model('silo', 'Silo')
+    SiloColumn = apps.get_model('silo', 'SiloColumn')
+    for silo in Silo.objects.all().iterator():
+        columns = list(SiloColumn.objects.filter(silo_id=silo.pk).order_by(
+            'position'))
+        silo.columns = json.dumps([{'name': col.name, 'type': col.type}
+                                   for col in columns])
+        silo.hidden_columns = json.dumps([col.name for col in columns
+                                          if col.hidden])
+        silo.save(update_fields=['columns', 'hidden_columns'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silo', '0045_read_json_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiloColumn',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField()),
+                ('type', models.CharField(default=b'string', max_length=30)),
+                ('position', models.IntegerField()),
+                ('hidden', models.BooleanField(default=False)),
+                ('silo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='silo_columns', to='silo.Silo')),
+            ],
+            options={
+                'ordering': ('position',),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='silocolumn',
+            unique_together=set([('silo', 'name')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='silocolumn',
+            index_together=set([('silo', 'position')]),
+        ),
+        migrations.RunPython(columns_to_rows, rows_to_columns),
+        migrations.RemoveField(
+            model_name='silo',
+            name='columns',
+        ),
+        migrations.RemoveField(
+            model_name='silo',
+            name='hidden_columns',
+        ),
+    ]
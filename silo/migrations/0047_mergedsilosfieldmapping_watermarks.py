@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silo', '0046_silocolumn'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mergedsilosfieldmapping',
+            name='watermarks',
+            field=models.TextField(default=b'{}'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silo', '0047_mergedsilosfieldmapping_watermarks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='celerytask',
+            name='rows_total',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Total rows'),
+        ),
+    ]
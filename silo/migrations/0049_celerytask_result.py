@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silo', '0048_celerytask_rows_total'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='celerytask',
+            name='result',
+            field=models.TextField(blank=True, null=True, verbose_name='Result'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silo', '0049_celerytask_result'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='silo',
+            name='data_silo_id',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
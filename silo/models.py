@@ -1,11 +1,13 @@
+import json
 import uuid
 
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models.signals import (post_save, pre_delete, post_delete,
+                                      m2m_changed)
 from django.dispatch import receiver
 from django.utils import timezone
 from mongoengine import DynamicDocument, IntField, DateTimeField
@@ -33,6 +35,15 @@ class CeleryTask(models.Model):
     task_id = models.CharField(max_length=50, blank=True, null=True, default=None, verbose_name='Celery task id')
     task_status = models.CharField(max_length=25, choices=TASK_STATUS_CHOICES, null=True, blank=True,
                                    verbose_name='Celery task status')
+    # progress of the task, updated after every committed chunk of rows
+    rows_processed = models.PositiveIntegerField(default=0, verbose_name='Rows processed')
+    bytes_processed = models.BigIntegerField(default=0, verbose_name='Bytes processed')
+    bytes_total = models.BigIntegerField(null=True, blank=True, verbose_name='Total bytes')
+    rows_total = models.PositiveIntegerField(null=True, blank=True, verbose_name='Total rows')
+    rows_per_second = models.FloatField(null=True, blank=True, verbose_name='Rows per second')
+    progress_updated = models.DateTimeField(null=True, blank=True)
+    # the JSON result of the task once it is done
+    result = models.TextField(null=True, blank=True, verbose_name='Result')
 
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = models.PositiveIntegerField()
@@ -298,6 +309,7 @@ class Read(models.Model):
     username = models.CharField(max_length=20, null=True, blank=True, help_text="Enter username only if the data at this source is protected by a login")
     password = models.CharField(max_length=40, null=True, blank=True, help_text="Enter password only if the data at this source is protected by a login")
     token = models.CharField(max_length=254, null=True, blank=True)
+    json_path = models.CharField(max_length=200, null=True, blank=True, verbose_name='JSON path', help_text="Dot separated keys leading to the list of records if the JSON data wraps it, e.g. data.results")
     file_data = models.FileField("Upload CSV File", upload_to='uploads', blank=True, null=True)
     autopull_frequency = models.CharField(max_length=25, choices=FREQUENCY_CHOICES, null=True, blank=True)
     autopush_frequency = models.CharField(max_length=25, choices=FREQUENCY_CHOICES, null=True, blank=True)
@@ -343,6 +355,12 @@ class FormulaColumn(models.Model):
     column_name = models.TextField()
 
 
+@receiver(post_save, sender=FormulaColumn)
+@receiver(pre_delete, sender=FormulaColumn)
+def formula_column_changed(sender, instance, **kwargs):
+    invalidate_formula_plans(instance.silos.values_list('id', flat=True))
+
+
 # Create your models here.
 class Silo(models.Model):
     owner = models.ForeignKey(User)
@@ -360,10 +378,13 @@ class Silo(models.Model):
     create_date = models.DateTimeField(null=True, blank=True)
 
     formulacolumns = models.ManyToManyField(FormulaColumn, related_name='silos', blank=True)
-    columns = models.TextField(default = "[]") #stores a json string of json objects
-    # json objects stores in the format of  {'name' : <col_name>, 'type' : <col_type>}
-
-    hidden_columns = models.TextField(default = "[]") #stores a Json string
+    # the merge task of a merged silo
+    tasks = GenericRelation(CeleryTask, related_query_name='silos')
+    # the silo_id of the rows of the silo in label_value_store if it is not
+    # its id, see data_id
+    data_silo_id = models.IntegerField(null=True, blank=True)
+    # the columns are stored as SiloColumn rows, see the columns and
+    # hidden_columns properties for their former JSON form
     rows_to_hide = models.TextField(default = "[]")
     #Format of hidden rows:
     #   [{"logic":<or, and, defineblank>,
@@ -375,12 +396,70 @@ class Silo(models.Model):
     class Meta:
         ordering = ('create_date',)
 
+    # JSON assigned to the columns properties, written on save
+    _pending_columns = None
+    _pending_hidden_columns = None
+
     def save(self, *args, **kwargs):
+        # data_silo_id is only written by publish_silo_rows, a silo loaded
+        # before the rows were published must not point back to the old ones
+        if not self._state.adding and self.pk is not None and not args and \
+                not kwargs.get('force_insert') and \
+                kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'data_silo_id']
         super(Silo, self).save(*args, **kwargs)
+        if (self._pending_columns is not None or
+                self._pending_hidden_columns is not None):
+            set_silo_columns(self, self._pending_columns,
+                             self._pending_hidden_columns)
+            self._pending_columns = None
+            self._pending_hidden_columns = None
+            # drop the columns prefetched before they were replaced
+            getattr(self, '_prefetched_objects_cache', {}).pop(
+                'silo_columns', None)
 
     def __unicode__(self):
         return self.name
 
+    @property
+    def columns(self):
+        """
+        The JSON list of the columns in order, in the format of
+        {'name' : <col_name>, 'type' : <col_type>}. Assigning it replaces
+        all the columns on save, tola.util has functions changing only some.
+
+        The columns are read with silo_columns.all(), so querysets of silos
+        can load them with prefetch_related('silo_columns').
+        """
+        if self._pending_columns is not None:
+            return self._pending_columns
+        if self.pk is None:
+            return '[]'
+        return json.dumps([{'name': column.name, 'type': column.type}
+                           for column in self.silo_columns.all()])
+
+    @columns.setter
+    def columns(self, value):
+        self._pending_columns = value
+
+    @property
+    def hidden_columns(self):
+        """
+        The JSON list of the names of the hidden columns
+        """
+        if self._pending_hidden_columns is not None:
+            return self._pending_hidden_columns
+        if self.pk is None:
+            return '[]'
+        return json.dumps([column.name for column in self.silo_columns.all()
+                           if column.hidden])
+
+    @hidden_columns.setter
+    def hidden_columns(self, value):
+        self._pending_hidden_columns = value
+
     @property
     def tag_list(self):
         return ', '.join([x.name for x in self.tags.all()])
@@ -390,7 +469,176 @@ class Silo(models.Model):
 
     @property
     def data_count(self):
-        return LabelValueStore.objects(silo_id=self.id).count()
+        return get_silo_row_count(self.id)
+
+    @property
+    def data_id(self):
+        """
+        The silo_id of the rows of the silo in label_value_store. The rows of
+        a merged silo that is rebuilt are written under another silo_id and
+        published by pointing data_silo_id to it, see
+        silo.merge.publish_silo_rows
+        """
+        return self.data_silo_id or self.pk
+
+
+class SiloColumn(models.Model):
+    """
+    A column of a silo. The columns are shown in the order of their position.
+    """
+    silo = models.ForeignKey(Silo, related_name='silo_columns',
+                             on_delete=models.CASCADE)
+    # the names are the keys of the rows, e.g. long form question paths
+    name = models.TextField()
+    type = models.CharField(max_length=30, default='string')
+    position = models.IntegerField()
+    hidden = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ('position',)
+        unique_together = (('silo', 'name'),)
+        index_together = (('silo', 'position'),)
+
+    def __unicode__(self):
+        return self.name
+
+
+def parse_json_columns(columns):
+    """
+    Returns the (name, type) pairs of the JSON columns of a silo without
+    duplicates, the columns being {'name':, 'type':} objects or, in old
+    silos, plain names
+    """
+    pairs = []
+    seen = set()
+    for col in json.loads(columns):
+        if isinstance(col, basestring):
+            name, type = col, 'string'
+        else:
+            name, type = col['name'], col.get('type') or 'string'
+        if name not in seen:
+            seen.add(name)
+            pairs.append((name, type))
+    return pairs
+
+
+def set_silo_columns(silo, columns=None, hidden_columns=None):
+    """
+    Writes the columns given in their JSON form to the SiloColumns of a
+    silo, only updating the rows that differ
+
+    columns -- the JSON list of all the columns in order, None keeps them
+    hidden_columns -- the JSON list of the hidden names, None keeps them
+    """
+    with transaction.atomic():
+        existing = {col.name: col for col in silo.silo_columns.all()}
+        hidden = None
+        if hidden_columns is not None:
+            hidden = set(json.loads(hidden_columns))
+
+        if columns is None:
+            wanted = [(col.name, col.type) for col in
+                      sorted(existing.values(), key=lambda c: c.position)]
+        else:
+            wanted = parse_json_columns(columns)
+
+        new_columns = []
+        for position, (name, type) in enumerate(wanted):
+            col = existing.pop(name, None)
+            is_hidden = name in hidden if hidden is not None else (
+                col is not None and col.hidden)
+            if col is None:
+                new_columns.append(SiloColumn(silo=silo, name=name, type=type,
+                                              position=position,
+                                              hidden=is_hidden))
+            elif (col.type, col.position, col.hidden) != (type, position,
+                                                          is_hidden):
+                col.type = type
+                col.position = position
+                col.hidden = is_hidden
+                col.save(update_fields=['type', 'position', 'hidden'])
+        if existing:
+            SiloColumn.objects.filter(
+                pk__in=[old.pk for old in existing.values()]).delete()
+        SiloColumn.objects.bulk_create(new_columns)
+    invalidate_silo_columns(silo.pk)
+
+
+def _bump_silo_columns_version(silo_id):
+    get_version_collection().update_one(
+        {'_id': silo_id}, {'$inc': {'columns': 1}}, upsert=True)
+
+
+def invalidate_silo_columns(silo_id):
+    _bump_silo_columns_version(silo_id)
+    # once more on commit, as the old columns may have been read again by
+    # another process before the transaction writing them was committed
+    transaction.on_commit(lambda: _bump_silo_columns_version(silo_id))
+
+
+def invalidate_formula_plans(silo_ids):
+    """
+    Bumps the version of the formulas of the silos, see
+    tola.util.get_formula_plan
+    """
+    silo_ids = list(silo_ids)
+
+    def bump():
+        for silo_id in silo_ids:
+            get_version_collection().update_one(
+                {'_id': silo_id}, {'$inc': {'formulas': 1}}, upsert=True)
+    bump()
+    # once more on commit, as for the columns
+    transaction.on_commit(bump)
+
+
+def get_formula_plan_version(silo_id):
+    doc = get_version_collection().find_one({'_id': silo_id},
+                                            {'formulas': 1})
+    return doc.get('formulas', 0) if doc is not None else 0
+
+
+def get_silo_columns_version(silo_id):
+    """
+    Returns the version of the columns of a silo, see
+    tola.util.get_silo_columns. It is kept in MongoDB next to the version of
+    the data, where the web processes and the workers all see it.
+    """
+    doc = get_version_collection().find_one({'_id': silo_id},
+                                            {'columns': 1})
+    return doc.get('columns', 0) if doc is not None else 0
+
+
+@receiver(post_save, sender=Silo)
+def silo_created(sender, instance, created, **kwargs):
+    # a new silo starts with a fresh counter, in case rows were left behind
+    # under the same id
+    if created:
+        reset_silo_rows(instance.pk)
+
+
+@receiver(post_save, sender=Silo)
+@receiver(post_delete, sender=Silo)
+def silo_columns_changed(sender, instance, **kwargs):
+    invalidate_silo_columns(instance.pk)
+
+
+@receiver(post_delete, sender=Silo)
+def silo_deleted(sender, instance, **kwargs):
+    reset_silo_rows(instance.pk)
+
+
+@receiver(m2m_changed, sender=Silo.formulacolumns.through)
+def silo_formulacolumns_changed(sender, instance, action, reverse, pk_set,
+                                **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        invalidate_formula_plans([instance.pk])
+    elif pk_set is not None:
+        invalidate_formula_plans(pk_set)
+    else:
+        invalidate_formula_plans(instance.silos.values_list('id', flat=True))
 
 
 class Dashboard(models.Model):
@@ -459,6 +707,9 @@ class MergedSilosFieldMapping(models.Model):
     merged_silo = models.OneToOneField(Silo, related_name='merged_silo_mappings')
     merge_type = models.CharField(max_length=60, choices=MERGE_CHOICES, null=True, blank=True)
     mapping = models.TextField()
+    # stores a json document with the high-water marks of the source silos
+    # at the last merge, see silo.merge.get_watermark
+    watermarks = models.TextField(default="{}")
     create_date = models.DateTimeField(auto_now=False, auto_now_add=True)
 
     def __str__(self):
@@ -485,3 +736,138 @@ class LabelValueStore(DynamicDocument):
     read_id = IntField(default=-1)
     create_date = DateTimeField(help_text='date created')
     edit_date = DateTimeField(help_text='date editted')
+
+    def save(self, *args, **kwargs):
+        """
+        Saves the row and records the write with add_silo_rows, but with
+        record_write=False: the writers of many rows record them once
+        """
+        record_write = kwargs.pop('record_write', True)
+        created = self.pk is None
+        super(LabelValueStore, self).save(*args, **kwargs)
+        if record_write:
+            add_silo_rows(get_row_silo_id(self.silo_id), 1 if created else 0)
+
+    def delete(self, *args, **kwargs):
+        super(LabelValueStore, self).delete(*args, **kwargs)
+        add_silo_rows(get_row_silo_id(self.silo_id), -1)
+
+
+# the number of rows of every silo, kept next to the rows themselves so the
+# writers can update it right after their write is acknowledged
+SILO_ROW_COUNT_COLLECTION = 'silo_row_counts'
+# the version of the data of every silo, bumped by every write to its rows
+# so that the cached results of older versions are never read again, the
+# number of rewrites of its rows, the writes that don't stamp the edit_date
+# of the rows they change, and the versions of its columns and formulas
+SILO_VERSION_COLLECTION = 'silo_data_versions'
+
+
+def get_row_count_collection():
+    return LabelValueStore._get_collection().database[
+        SILO_ROW_COUNT_COLLECTION]
+
+
+def get_version_collection():
+    return LabelValueStore._get_collection().database[
+        SILO_VERSION_COLLECTION]
+
+
+def _bump_silo_version(silo_id):
+    get_version_collection().update_one(
+        {'_id': silo_id}, {'$inc': {'version': 1}}, upsert=True)
+
+
+def bump_silo_version(silo_id):
+    """
+    Records a rewrite of the rows of a silo, e.g. a column renamed or set to
+    a value: bumps its version and its number of rewrites. As the rows don't
+    get a new edit_date, the next merge of the silo reads all of them.
+    """
+    get_version_collection().update_one(
+        {'_id': silo_id}, {'$inc': {'version': 1, 'rewrites': 1}},
+        upsert=True)
+
+
+def get_silo_version(silo_id):
+    doc = get_version_collection().find_one({'_id': silo_id})
+    return doc['version'] if doc is not None else 0
+
+
+def get_silo_rewrites(silo_id):
+    doc = get_version_collection().find_one({'_id': silo_id})
+    return doc.get('rewrites', 0) if doc is not None else 0
+
+
+def add_silo_rows(silo_id, delta):
+    """
+    Records a write to the rows of a silo: adds delta to its row counter and
+    bumps its version. A counter that does not exist yet is left alone, it is
+    set by the next get_silo_row_count from the actual number of rows.
+    """
+    if silo_id is None:
+        return
+    if delta:
+        get_row_count_collection().update_one({'_id': silo_id},
+                                              {'$inc': {'count': delta}})
+    _bump_silo_version(silo_id)
+
+
+def set_silo_rows(silo_id, count):
+    get_row_count_collection().update_one(
+        {'_id': silo_id}, {'$set': {'count': count}}, upsert=True)
+    _bump_silo_version(silo_id)
+
+
+def reset_silo_rows(silo_id):
+    """
+    Drops the row counter of a silo, it is recounted on the next access
+    """
+    get_row_count_collection().delete_one({'_id': silo_id})
+    _bump_silo_version(silo_id)
+
+
+def get_data_silo_id(silo_id):
+    """
+    Returns the silo_id of the rows of a silo in label_value_store, see
+    Silo.data_id
+    """
+    data_silo_id = Silo.objects.filter(pk=silo_id).values_list(
+        'data_silo_id', flat=True).first()
+    return data_silo_id or int(silo_id)
+
+
+def get_row_silo_id(silo_id):
+    """
+    Returns the id of the silo of the rows under a silo_id, the other way
+    round from get_data_silo_id: the rows of a rebuilt silo are under one of
+    its two negative ids, see silo.merge.get_staging_id
+    """
+    if silo_id is None or silo_id >= 0:
+        return silo_id
+    return -silo_id // 2
+
+
+def delete_silo_rows(silo_id, **filters):
+    """
+    Deletes the rows of a silo matching the filters and updates its counter,
+    returns the number of rows deleted
+    """
+    deleted = LabelValueStore.objects(silo_id=get_data_silo_id(silo_id),
+                                      **filters).delete()
+    add_silo_rows(silo_id, -deleted)
+    return deleted
+
+
+def count_silo_rows(silo_id):
+    return LabelValueStore.objects(silo_id=get_data_silo_id(silo_id)).count()
+
+
+def get_silo_row_count(silo_id):
+    doc = get_row_count_collection().find_one({'_id': silo_id})
+    if doc is not None:
+        return doc['count']
+    count = count_silo_rows(silo_id)
+    get_row_count_collection().update_one(
+        {'_id': silo_id}, {'$setOnInsert': {'count': count}}, upsert=True)
+    return count
@@ -0,0 +1,172 @@
+"""
+Keyset (cursor) pagination of the rows of a silo.
+
+Instead of skipping the rows of the previous pages, every page starts right
+after the last row of the previous one, so the cost of a page does not depend
+on its position. The rows are ordered by the sort key and then by _id, which
+makes the order total, and the position is handed to the client as an opaque
+token holding the sort key and _id of the last row returned.
+"""
+import base64
+import binascii
+from datetime import datetime
+
+from bson import ObjectId, json_util
+
+# the BSON sort order of the types of value stored in the silos, rows whose
+# sort key holds another type are ordered by the rank of that type
+SORT_TYPES = (
+    ('null', (type(None),)),
+    ('number', (int, long, float)),
+    ('string', (basestring,)),
+    ('objectId', (ObjectId,)),
+    ('bool', (bool,)),
+    ('date', (datetime,)),
+)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def get_type_rank(value):
+    # bool is a subclass of int, so it has to be checked first
+    if isinstance(value, bool):
+        return 4
+    for rank, (alias, types) in enumerate(SORT_TYPES):
+        if isinstance(value, types):
+            return rank
+    raise InvalidCursor("Can't paginate on a value of type %s" %
+                        type(value).__name__)
+
+
+def get_keyset_sort(sort_fields):
+    """
+    Returns the (key, direction) pairs ordering the rows for a $sort stage
+    e.g. {"rank": -1} -> [('rank', -1), ('_id', -1)]
+
+    Only one sort key is supported besides _id. The _id follows the direction
+    of the sort key so a single index on (silo_id, key, _id) serves the query.
+    """
+    sort_fields = dict(sort_fields or {})
+    id_direction = sort_fields.pop('_id', 1)
+    if len(sort_fields) > 1:
+        raise InvalidCursor("Only one sort key can be used with a cursor")
+    sort = []
+    for key, direction in sort_fields.items():
+        if direction not in (1, -1):
+            raise InvalidCursor("The sort direction must be 1 or -1")
+        sort.append((key, direction))
+        id_direction = direction
+    if id_direction not in (1, -1):
+        raise InvalidCursor("The sort direction must be 1 or -1")
+    sort.append(('_id', id_direction))
+    return sort
+
+
+def get_row_value(row, key):
+    """
+    Returns the value of a sort key in a row, following dotted keys
+    """
+    value = row
+    for part in key.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def get_position(sort, row):
+    """
+    Returns the position of a row: its sort keys with their values
+    """
+    return [[key, direction, get_row_value(row, key)]
+            for key, direction in sort]
+
+
+def encode_position(position):
+    return base64.urlsafe_b64encode(json_util.dumps(position))
+
+
+def encode_cursor(sort, row):
+    """
+    Returns the token of the position right after row
+    """
+    return encode_position(get_position(sort, row))
+
+
+def decode_cursor(token, sort):
+    """
+    Returns the values of the sort keys stored in a token, checking that the
+    token was made for the same sort
+    """
+    try:
+        position = json_util.loads(base64.urlsafe_b64decode(str(token)))
+        keys = [(key, direction) for key, direction, value in position]
+        values = [value for key, direction, value in position]
+    except (TypeError, ValueError, binascii.Error):
+        raise InvalidCursor("The cursor is invalid")
+    if keys != sort:
+        raise InvalidCursor("The cursor was made for another sort")
+    return values
+
+
+class KeysetPage(object):
+    """
+    Iterates over the rows of a page fetched with one row more than its
+    length. Once the rows have been iterated, next_cursor holds the token of
+    the next page, or None on the last page.
+
+    hidden_fields -- fields read for the position of the rows, e.g. a sort
+        key the response does not show, which are removed from the rows
+    """
+
+    def __init__(self, rows, sort, length, hidden_fields=()):
+        self.rows = rows
+        self.sort = sort
+        self.length = length
+        self.hidden_fields = hidden_fields
+        self.next_cursor = None
+
+    def __iter__(self):
+        last = None
+        for i, row in enumerate(self.rows):
+            if i == self.length:
+                self.next_cursor = encode_position(last)
+                break
+            last = get_position(self.sort, row)
+            for field in self.hidden_fields:
+                row.pop(field, None)
+            yield row
+
+
+def get_keyset_match(sort, values):
+    """
+    Returns the filter matching the rows after the position given by the
+    values of the sort keys
+    """
+    id_key, id_direction = sort[-1]
+    id_op = '$gt' if id_direction == 1 else '$lt'
+    if len(sort) == 1:
+        return {'_id': {id_op: values[-1]}}
+
+    key, direction = sort[0]
+    value = values[0]
+    rank = get_type_rank(value)
+    # a null value matches both the rows holding null and the missing keys
+    conditions = [{key: value, '_id': {id_op: values[-1]}}]
+    if value is not None:
+        conditions.append({key: {'$gt' if direction == 1 else '$lt': value}})
+
+    # the comparison operators only match values of the same type, the rows
+    # holding a type ranked after this one come next
+    if direction == 1:
+        following = SORT_TYPES[rank + 1:]
+    else:
+        following = SORT_TYPES[:rank]
+    for alias, types in following:
+        if alias == 'null':
+            conditions.append({key: None})
+        else:
+            conditions.append({key: {'$type': alias}})
+    return {'$or': conditions}
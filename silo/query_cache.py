@@ -0,0 +1,84 @@
+"""
+Cache of the results of the silo data reads.
+
+The results are cached in the default cache under a key holding the version
+of the data of the silo, which every write to its rows bumps. A write thus
+invalidates all the cached results of a silo at once, the results of the
+older versions are never read again and are evicted by the cache backend.
+Results bigger than settings.SILO_QUERY_CACHE_MAX_BYTES are not cached.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+
+from silo.models import get_silo_version
+
+QUERY_CACHE_KEY = 'silo_query_{}_{}_{}'
+HITS_KEY = 'silo_query_cache_hits'
+MISSES_KEY = 'silo_query_cache_misses'
+
+
+def is_enabled():
+    return settings.SILO_QUERY_CACHE_TIMEOUT > 0
+
+
+def get_cache_key(silo_id, *params):
+    """
+    Returns the key of the result of a read of a silo, params being anything
+    the result depends on besides the data e.g. the query and the page
+    """
+    digest = hashlib.md5(json.dumps(params, sort_keys=True)).hexdigest()
+    return QUERY_CACHE_KEY.format(silo_id, get_silo_version(int(silo_id)),
+                                  digest)
+
+
+def _incr(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # the counter does not exist yet, or was evicted
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def get_cached(key):
+    """
+    Returns the cached result or None, counting the hits and misses
+    """
+    result = cache.get(key)
+    _incr(MISSES_KEY if result is None else HITS_KEY)
+    return result
+
+
+def cache_chunks(key, chunks):
+    """
+    Yields the chunks of a result and caches them once they have all been
+    yielded, unless they add up to more than the maximum size
+    """
+    max_bytes = settings.SILO_QUERY_CACHE_MAX_BYTES
+    parts = []
+    size = 0
+    for chunk in chunks:
+        if parts is not None:
+            size += len(chunk)
+            if size > max_bytes:
+                parts = None
+            else:
+                parts.append(chunk)
+        yield chunk
+    if parts is not None:
+        cache.set(key, ''.join(parts), settings.SILO_QUERY_CACHE_TIMEOUT)
+
+
+def get_stats():
+    hits = cache.get(HITS_KEY) or 0
+    misses = cache.get(MISSES_KEY) or 0
+    total = hits + misses
+    return {'hits': hits, 'misses': misses,
+            'hit_rate': round(float(hits) / total, 4) if total else None}
+
+
+def reset_stats():
+    cache.delete_many([HITS_KEY, MISSES_KEY])
@@ -0,0 +1,356 @@
+"""
+Compiler of the query, group and sort parameters of the silo data API.
+
+The parameters are MongoDB JSON written by the clients. They are checked
+against the operators allowed here, so that filters that can't use an index
+like $where or $regex are rejected, and the query is compiled into a $match
+whose leading predicate is the silo_id of the silo read. Equality and range
+conditions are rewritten to the plain forms the query planner turns into
+index bounds, and the index of the silo that serves the query best is
+returned as a hint.
+"""
+import json
+import logging
+
+from bson import SON
+from pymongo.errors import OperationFailure
+
+from silo.indexes import BASE_INDEXES, get_index_name, get_silo_index_fields
+
+logger = logging.getLogger("silo")
+
+LOGICAL_OPERATORS = frozenset(['$and', '$or', '$nor'])
+
+CONDITION_OPERATORS = frozenset([
+    '$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin', '$exists',
+    '$type', '$all', '$size', '$elemMatch', '$not',
+])
+
+GROUP_ACCUMULATORS = frozenset([
+    '$sum', '$avg', '$min', '$max', '$first', '$last', '$push', '$addToSet',
+])
+
+EXPRESSION_OPERATORS = frozenset([
+    '$add', '$subtract', '$multiply', '$divide', '$mod', '$abs', '$ceil',
+    '$floor', '$cond', '$ifNull', '$eq', '$ne', '$gt', '$gte', '$lt', '$lte',
+    '$and', '$or', '$not', '$concat', '$substr', '$toLower', '$toUpper',
+    '$year', '$month', '$dayOfMonth', '$dayOfWeek', '$week', '$hour',
+    '$literal', '$size',
+])
+
+# the compiler pins silo_id itself
+RESERVED_FIELDS = frozenset(['silo_id'])
+
+# index used when no index on the fields of the query applies
+SILO_ID_INDEX = BASE_INDEXES[0][0]
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def parse_json_param(value, name, ordered=False):
+    """
+    Returns the JSON object of a request parameter
+
+    ordered -- keeps the order of the keys, e.g. of a sort
+    """
+    try:
+        result = json.loads(value, object_pairs_hook=SON if ordered else None)
+    except ValueError:
+        raise InvalidQuery("The %s is not valid JSON" % name)
+    if not isinstance(result, dict):
+        raise InvalidQuery("The %s must be a JSON object" % name)
+    return result
+
+
+def parse_json_list_param(value, name):
+    """
+    Returns the JSON list of names of a request parameter, e.g. the columns
+    to return
+    """
+    try:
+        result = json.loads(value)
+    except ValueError:
+        raise InvalidQuery("The %s is not valid JSON" % name)
+    if not isinstance(result, list) or \
+            not all(isinstance(item, basestring) for item in result):
+        raise InvalidQuery("The %s must be a JSON list of names" % name)
+    return result
+
+
+def check_field(name):
+    if not isinstance(name, basestring) or not name or name[0] == '$' or \
+            '\0' in name:
+        raise InvalidQuery("Invalid field name: %s" % name)
+    if name in RESERVED_FIELDS:
+        raise InvalidQuery("The field %s can't be queried" % name)
+
+
+def _is_scalar(value):
+    return not isinstance(value, (dict, list))
+
+
+def _is_operator_dict(value):
+    if not isinstance(value, dict) or not value:
+        return False
+    operators = [key.startswith('$') for key in value]
+    if any(operators) and not all(operators):
+        raise InvalidQuery("Operators can't be mixed with fields: %s"
+                           % json.dumps(value))
+    return all(operators)
+
+
+def _compile_condition(value, simplify=True):
+    """
+    Returns the checked condition on a field, the equalities written as
+    plain values unless simplify is False
+    """
+    if not _is_operator_dict(value):
+        return value
+    result = {}
+    for op, arg in value.iteritems():
+        if op not in CONDITION_OPERATORS:
+            raise InvalidQuery("The operator %s is not allowed" % op)
+        if op == '$not':
+            if not _is_operator_dict(arg):
+                raise InvalidQuery("$not takes an operator expression")
+            arg = _compile_condition(arg, simplify=False)
+        elif op == '$elemMatch':
+            if _is_operator_dict(arg):
+                arg = _compile_condition(arg, simplify=False)
+            elif isinstance(arg, dict):
+                arg = compile_filter(arg)
+            else:
+                raise InvalidQuery("$elemMatch takes an object")
+        elif op in ('$in', '$nin', '$all'):
+            if not isinstance(arg, list):
+                raise InvalidQuery("%s takes a list" % op)
+            for item in arg:
+                if _is_operator_dict(item):
+                    raise InvalidQuery("%s takes a list of values" % op)
+        result[op] = arg
+
+    if simplify and len(result) == 1:
+        op, arg = result.items()[0]
+        if op == '$eq' and _is_scalar(arg):
+            return arg
+        if op == '$in' and len(arg) == 1 and _is_scalar(arg[0]):
+            return arg[0]
+    return result
+
+
+def _lift_and(query):
+    """
+    Moves the clauses of a $and up into the query where they don't conflict
+    with its conditions, merging the ranges on the same field, so that the
+    planner sees them as bounds of the fields
+    """
+    rest = []
+    for clause in query.pop('$and'):
+        for field, condition in clause.iteritems():
+            current = query.get(field)
+            if field not in query:
+                query[field] = condition
+            elif (field not in LOGICAL_OPERATORS and
+                    _is_operator_dict(current) and
+                    _is_operator_dict(condition) and
+                    not set(current).intersection(condition)):
+                merged = dict(current)
+                merged.update(condition)
+                query[field] = merged
+            else:
+                rest.append({field: condition})
+    if rest:
+        query['$and'] = rest
+
+
+def _or_to_in(query):
+    """
+    Rewrites a $or of equalities on the same field to a $in, which is a
+    single index scan instead of one per clause
+    """
+    field = None
+    values = []
+    for clause in query['$or']:
+        if len(clause) != 1:
+            return
+        key, value = clause.items()[0]
+        if key in LOGICAL_OPERATORS or (field is not None and key != field):
+            return
+        field = key
+        if _is_scalar(value):
+            values.append(value)
+        elif (isinstance(value, dict) and value.keys() == ['$in'] and
+                all(_is_scalar(item) for item in value['$in'])):
+            values.extend(value['$in'])
+        else:
+            return
+    if field is None or field in query:
+        return
+    del query['$or']
+    query[field] = values[0] if len(values) == 1 else {'$in': values}
+
+
+def compile_filter(query):
+    """
+    Returns the checked and rewritten copy of a filter
+    """
+    result = {}
+    for key, value in query.iteritems():
+        if key in LOGICAL_OPERATORS:
+            if not isinstance(value, list) or not value or \
+                    not all(isinstance(clause, dict) for clause in value):
+                raise InvalidQuery("%s takes a list of objects" % key)
+            result[key] = [compile_filter(clause) for clause in value]
+        elif key.startswith('$'):
+            raise InvalidQuery("The operator %s is not allowed" % key)
+        else:
+            check_field(key)
+            result[key] = _compile_condition(value)
+
+    if '$and' in result:
+        _lift_and(result)
+    if '$or' in result:
+        _or_to_in(result)
+    return result
+
+
+def compile_match(silo_id, query):
+    """
+    Returns the $match condition of a query on a silo: silo_id first, then
+    the equalities and then the other conditions
+    """
+    query = compile_filter(query)
+    match = SON([('silo_id', silo_id)])
+    fields = sorted(query, key=lambda field: (
+        field.startswith('$'), not _is_scalar(query[field]), field))
+    for field in fields:
+        match[field] = query[field]
+    return match
+
+
+def _check_expression(expression):
+    if isinstance(expression, list):
+        for item in expression:
+            _check_expression(item)
+    elif isinstance(expression, dict):
+        for key, value in expression.iteritems():
+            if key.startswith('$'):
+                if key not in EXPRESSION_OPERATORS:
+                    raise InvalidQuery("The operator %s is not allowed" % key)
+            else:
+                check_field(key)
+            _check_expression(value)
+    elif isinstance(expression, basestring) and expression.startswith('$$'):
+        raise InvalidQuery("Variables are not allowed: %s" % expression)
+
+
+def compile_group(group):
+    """
+    Returns the checked $group specification of the data API
+    """
+    if not group:
+        return group
+    if '_id' not in group:
+        raise InvalidQuery("The group needs an _id")
+    for field, value in group.iteritems():
+        if field == '_id':
+            _check_expression(value)
+            continue
+        check_field(field)
+        if '.' in field:
+            raise InvalidQuery("Invalid field name: %s" % field)
+        if not isinstance(value, dict) or len(value) != 1 or \
+                value.keys()[0] not in GROUP_ACCUMULATORS:
+            raise InvalidQuery("The group field %s needs one of %s" % (
+                field, ', '.join(sorted(GROUP_ACCUMULATORS))))
+        _check_expression(value.values()[0])
+    return group
+
+
+def compile_sort(sort):
+    """
+    Returns the checked $sort specification, keeping the order of its keys
+    """
+    for field, direction in sort.iteritems():
+        check_field(field)
+        if direction not in (1, -1):
+            raise InvalidQuery("The sort direction of %s must be 1 or -1"
+                               % field)
+    return sort
+
+
+def _is_equality(value):
+    if _is_scalar(value):
+        return value is not None
+    return isinstance(value, dict) and value.keys() == ['$in'] and \
+        None not in value['$in']
+
+
+def get_index_hint(silo, match, sort=None):
+    """
+    Returns the name of the index to hint for a $match on a silo: the index
+    of unique fields all compared for equality, else the (silo_id, _id)
+    index if the query has no condition on an indexed field and is not
+    sorted by another field, else None to let the planner choose
+    """
+    equalities = set(field for field, value in match.iteritems()
+                     if field != 'silo_id' and _is_equality(value))
+    index_fields = get_silo_index_fields(silo)
+    for fields in index_fields:
+        if equalities.issuperset(fields):
+            return get_index_name(fields)
+    if any(fields[0] in match for fields in index_fields):
+        return None
+    if sort and list(sort) != ['_id']:
+        return None
+    return SILO_ID_INDEX
+
+
+def aggregate(collection, pipeline, hint=None):
+    """
+    Runs the pipeline with the index hint, or without it if the server
+    refuses the hint, e.g. the index is missing or the server predates
+    hints on aggregate
+    """
+    if hint is not None:
+        try:
+            return collection.aggregate(pipeline, hint=hint)
+        except OperationFailure as e:
+            logger.info("The index hint %s was refused: %s" % (hint, e))
+    return collection.aggregate(pipeline)
+
+
+def explain(collection, match, sort=None, skip=0, limit=0, hint=None):
+    """
+    Returns the winning plan of a query with its execution statistics,
+    among which the ratio of the documents examined to the ones returned
+    """
+    def get_plan(hint):
+        cursor = collection.find(match, sort=list(sort.items()) or None,
+                                 skip=skip, limit=limit)
+        if hint is not None:
+            cursor = cursor.hint(hint)
+        return cursor.explain()
+
+    sort = sort or {}
+    try:
+        plan = get_plan(hint)
+    except OperationFailure:
+        hint = None
+        plan = get_plan(hint)
+
+    stats = plan.get('executionStats', {})
+    returned = stats.get('nReturned', 0)
+    examined = stats.get('totalDocsExamined', 0)
+    return {
+        'query': match,
+        'sort': sort,
+        'hint': hint,
+        'winningPlan': plan.get('queryPlanner', {}).get('winningPlan'),
+        'nReturned': returned,
+        'totalKeysExamined': stats.get('totalKeysExamined'),
+        'totalDocsExamined': examined,
+        'docsExaminedRatio': round(float(examined) / max(returned, 1), 2),
+    }
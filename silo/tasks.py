@@ -1,35 +1,465 @@
 from __future__ import absolute_import, unicode_literals
-from celery import shared_task
+import json
+import time
+from collections import OrderedDict
+from itertools import islice
 
+import requests
+from celery import chord, shared_task
+from pymongo.errors import PyMongoError
+
+from commcare.tasks import fetchCommCareData, mergeCommCareResults
 from silo.custom_csv_dict_reader import CustomDictReader
-from tola.util import save_data_to_silo
-from .models import Silo, Read, CeleryTask
+from silo.gviews_v4 import import_from_gsheet_helper
+from silo.indexes import ensure_silo_indexes
+from tola.util import (save_data_to_silo, importJSON, getNewestDataDate,
+                       addColsToSilo, hideSiloColumns)
+from .models import (Silo, Read, CeleryTask, ThirdPartyTokens,
+                     MergedSilosFieldMapping, add_silo_rows,
+                     delete_silo_rows, get_silo_row_count)
 
+from django.contrib import messages
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-@shared_task(bind=True, retry=False)
+class ByteCountingReader(object):
+    """
+    Iterates over the lines of a file and keeps count of the bytes consumed,
+    so the csv reader can stream the file while the progress is measured.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+        self._lines = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._lines is None:
+            self._lines = iter(self.f)
+        line = next(self._lines)
+        self.bytes_read += len(line)
+        return line
+
+
+class ImportProgress(object):
+    """
+    Records the progress of an import on its CeleryTask after every chunk
+    that was written to the silo
+    """
+
+    def __init__(self, task, source):
+        self.task = task
+        self.source = source
+        self.started = time.time()
+        self.start_rows = task.rows_processed
+
+    def __call__(self, rows):
+        task = self.task
+        task.rows_processed += rows
+        task.bytes_processed = self.source.bytes_read
+        elapsed = time.time() - self.started
+        if elapsed > 0:
+            task.rows_per_second = round(
+                (task.rows_processed - self.start_rows) / elapsed, 2)
+        task.progress_updated = timezone.now()
+        task.save(update_fields=['rows_processed', 'bytes_processed',
+                                 'rows_per_second', 'progress_updated'])
+
+
+class MergeProgress(object):
+    """
+    Records the progress of a merge on its CeleryTask after every batch of
+    rows written to the merged silo
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.started = time.time()
+
+    def __call__(self, rows):
+        task = self.task
+        task.rows_processed += rows
+        elapsed = time.time() - self.started
+        if elapsed > 0:
+            task.rows_per_second = round(task.rows_processed / elapsed, 2)
+        task.progress_updated = timezone.now()
+        task.save(update_fields=['rows_processed', 'rows_per_second',
+                                 'progress_updated'])
+
+
+def import_csv_to_silo(silo, read_obj, task):
+    """
+    Streams the csv file of a read into a silo in fixed-size chunks.
+
+    Rows already committed by a previous run of the task are skipped without
+    being written again, so a retried import resumes from its last chunk.
+    """
+    source = ByteCountingReader(read_obj.file_data)
+    reader = CustomDictReader(source)
+    if task.rows_processed:
+        # advance the reader past the committed rows; the fieldnames have to
+        # be read first, as save_data_to_silo relies on them
+        reader.fieldnames
+        for _ in islice(reader, task.rows_processed):
+            pass
+    return save_data_to_silo(silo, reader, read_obj,
+                             progress=ImportProgress(task, source))
+
+
+@shared_task(bind=True, retry=False, max_retries=3)
 def process_silo(self, silo_id, read_id):
     silo = Silo.objects.get(id=silo_id)
     read_obj = Read.objects.get(pk=read_id)
 
     ctype = ContentType.objects.get_for_model(Read)
     task = CeleryTask.objects.get(content_type=ctype, object_id=read_obj.id)
+    if task.task_status != CeleryTask.TASK_IN_PROGRESS:
+        # only a retried run keeps the progress of the previous one
+        task.rows_processed = 0
+        task.bytes_processed = 0
+        task.rows_per_second = None
     task.task_status = CeleryTask.TASK_IN_PROGRESS
+    try:
+        task.bytes_total = read_obj.file_data.size
+    except (OSError, ValueError) as e:
+        logger.warning(e)
     task.save()
 
     try:
-        reader = CustomDictReader(read_obj.file_data)
-        save_data_to_silo(silo, reader, read_obj)
+        import_csv_to_silo(silo, read_obj, task)
         task.task_status = CeleryTask.TASK_FINISHED
     except TypeError, e:
         logger.error(e)
         task.task_status = CeleryTask.TASK_FAILED
+    except PyMongoError as e:
+        logger.error(e)
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=2 ** self.request.retries)
+        task.task_status = CeleryTask.TASK_FAILED
 
     task.save()
     # Todo add notification when done
     return True
+
+
+#return tuple: (list of list of dictionaries[[{}]] data or the ids of the tasks when running in tasks, 0=falure 1=success 2=N/A 3=running in tasks, messages, columns to add and hide)
+def importDataFromRead(silo, read, user):
+    if read.type.read_type == "ONA":
+        ona_token = ThirdPartyTokens.objects.get(user=silo.owner.pk, name="ONA")
+        response = requests.get(read.read_url, headers={'Authorization': 'Token %s' % ona_token.token})
+        data = json.loads(response.content)
+        return ([data], 1, (messages.SUCCESS, "ONA has been successfully updated"),None)
+    elif read.type.read_type == "CSV":
+        return (None,2,(messages.INFO, "When updating data in a table, its CSV source is ignored."),None)
+    elif read.type.read_type == "JSON":
+        if read.read_url != "":
+            data = importJSON(read, user, None, None, silo.pk, None, True)
+            #messages.add_message(request, result[0], result[1])
+            if data:
+                return ([data],1,(messages.SUCCESS, "Your JSON feed has been successfully updated"),None)
+            return (None,0,(messages.ERROR, "Their was an error with updating yoru JSON feed data"),None)
+        else:
+            return (None,2,(messages.INFO, "When updating data in a table, its JSON file data is ignored."),None)
+    elif read.type.read_type == "GSheet Import":
+        #as the google sheet import already performs the update functionality so when its time to input the data again google spreadsheet update will be called
+        return (None,2,None,None)
+    elif read.type.read_type == "Google Spreadsheet":
+        #as the google sheet import already performs the update functionality so when its time to input the data again google spreadsheet update will be called
+        return (None,2,None,None)
+    elif read.type.read_type == "CommCare":
+        commcare_token = None
+        try:
+            commcare_token = ThirdPartyTokens.objects.get(user=silo.owner.pk, name="CommCare")
+        except Exception as e:
+            return (None,0,(messages.ERROR, "You need to login to commcare using an API Key to access this functionality"),None)
+        last_data_retrieved = str(getNewestDataDate(silo.id))[:10]
+        url = "/".join(read.read_url.split("/")[:8]) + "?date_modified_start=" + last_data_retrieved + "&" + "limit="
+        response = requests.get(url+ str(1), headers={'Authorization': 'ApiKey %(u)s:%(a)s' % {'u' : commcare_token.username, 'a' : commcare_token.token}})
+        if response.status_code == 401:
+            commcare_token.delete()
+            return (None,0,(messages.ERROR, "Your Commcare usernmane or API Key is incorrect"),None)
+        elif response.status_code != 200:
+            return (None,0,(messages.ERROR, "An error importing from commcare has occured: %s %s " % (response.status_code, response.text)),None)
+        metadata = json.loads(response.content)
+        if metadata['meta']['total_count'] == 0:
+            return (None, 2, (messages.SUCCESS, "Your commcare data was already up to date"),None)
+        # the updates are upserts on (silo_id, case_id)
+        ensure_silo_indexes(silo)
+        #Now call the update data function in commcare tasks
+        auth = {'Authorization': 'ApiKey %(u)s:%(a)s' % {'u' : commcare_token.username, 'a' : commcare_token.token}}
+        url += "50"
+        data_raw = fetchCommCareData(url, auth, True, 0, metadata['meta']['total_count'], 50, silo.id, read.id, True, metadata['meta'])
+        # this runs inside the refresh task of the read, which must not wait
+        # on the page tasks: the callback of the pages adds the columns and
+        # finishes the task of the read
+        callback = commcare_refresh_done.s(silo.id, read.id).on_error(
+            commcare_refresh_failed.s(read.id))
+        result = chord(data_raw)(callback)
+        return ([result.id],3,(messages.INFO, "Your commcare data is being updated"),None)
+    else:
+        return (None,0,(messages.ERROR,"%s does not support update data functionality. You will have to reinport the data manually" % read.type.read_type),None)
+
+
+def read_needs_refresh(read):
+    """
+    Whether updating a silo fetches new data for the read. The other reads
+    are answered right away by importDataFromRead.
+    """
+    read_type = read.type.read_type
+    if read_type == "JSON":
+        return bool(read.read_url)
+    return read_type in ("ONA", "GSheet Import", "CommCare")
+
+
+def refresh_gsheet_read(silo, read, user):
+    """
+    Re-imports a GSheet Import read, returns the list of messages
+    """
+    msgs = []
+    greturn = import_from_gsheet_helper(user, silo.id, None, read.resource_id,
+                                        None, True)
+    if type(greturn) == tuple:
+        greturn[1][:] = [d for d in greturn[1] if d.get('silo_id') == None]
+        for ret in greturn[1]:
+            msgs.append((ret.get('level'), ret.get('msg')))
+        #delete data associated with old read if there's no unique column
+        if not silo.unique_fields.exists():
+            delete_silo_rows(silo.pk, read_id=read.id)
+        #read the data
+        new_rows = 0
+        for lvs in greturn[0]:
+            new_rows += lvs.pk is None
+            lvs.save(record_write=False)
+        add_silo_rows(silo.id, new_rows)
+    else:
+        greturn[:] = [d for d in greturn if d.get('silo_id') == None]
+        for ret in greturn:
+            if ret.get('level') == messages.SUCCESS:
+                msgs.append((ret.get('level'),
+                             "Google spreadsheet has been successfully updated"))
+            else:
+                msgs.append((ret.get('level'), ret.get('msg')))
+    return msgs
+
+
+@shared_task
+def refresh_read(silo_id, read_id, user_id):
+    """
+    Fetches the data of one read of a silo and writes it to the silo. Runs in
+    the header of the chord started by updateSiloData, so it never raises.
+
+    returns a dict with the messages for the user, the columns to add and
+    the ids of the tasks still writing the data of the read
+    """
+    silo = Silo.objects.get(pk=silo_id)
+    read = Read.objects.get(pk=read_id)
+    user = User.objects.get(pk=user_id)
+
+    ctype = ContentType.objects.get_for_model(Read)
+    task = CeleryTask.objects.filter(content_type=ctype,
+                                     object_id=read.id).first()
+    if task:
+        task.task_status = CeleryTask.TASK_IN_PROGRESS
+        task.save(update_fields=['task_status'])
+
+    msgs = []
+    columns = []
+    task_ids = []
+    status = CeleryTask.TASK_FINISHED
+    try:
+        if read.type.read_type == "GSheet Import":
+            msgs = refresh_gsheet_read(silo, read, user)
+        else:
+            data, result, msg, columns = importDataFromRead(silo, read, user)
+            if msg:
+                msgs.append(msg)
+            if result == 1:
+                #Unique field means keep the data and update as necessary
+                if not silo.unique_fields.exists():
+                    delete_silo_rows(silo.pk, read_id=read.id)
+                for entry in data:
+                    save_data_to_silo(silo, entry, read, user)
+            elif result == 0:
+                status = CeleryTask.TASK_FAILED
+            elif result == 3:
+                # the task is finished by the callback of the tasks started
+                status = CeleryTask.TASK_IN_PROGRESS
+                task_ids = data
+    except Exception as e:
+        logger.exception(e)
+        msgs.append((messages.ERROR, "Updating the data of %s failed: %s"
+                     % (read.read_name, e)))
+        status = CeleryTask.TASK_FAILED
+
+    if task:
+        task.task_status = status
+        task.save(update_fields=['task_status'])
+    return {'read_id': read_id, 'messages': msgs, 'columns': columns or [],
+            'task_ids': task_ids}
+
+
+def clean_commcare_columns(columns):
+    """
+    Returns the columns of CommCare cases as they are stored by
+    storeCommCareData
+    """
+    renamed = {"id": "user_assigned_id", "_id": "user_assigned_id",
+               "edit_date": "editted_date", "create_date": "created_date"}
+    cleaned = set()
+    for column in columns:
+        if column in ("", "silo_id", "read_id"):
+            continue
+        column = column.replace(".", "_").replace("$", "USD")
+        cleaned.add(renamed.get(column, column))
+    return list(cleaned)
+
+
+def _set_read_task_status(read_id, status):
+    ctype = ContentType.objects.get_for_model(Read)
+    CeleryTask.objects.filter(content_type=ctype, object_id=read_id).update(
+        task_status=status)
+
+
+@shared_task
+def commcare_refresh_done(results, silo_id, read_id):
+    """
+    Callback of the CommCare page tasks started by refresh_read: adds and
+    hides the columns of the cases and finishes the task of the read
+
+    returns a dict with the messages for the user
+    """
+    data_retrieval = mergeCommCareResults(results)
+    counts = data_retrieval['counts']
+    columns = clean_commcare_columns(data_retrieval['columns'])
+    if columns:
+        silo = Silo.objects.get(pk=silo_id)
+        addColsToSilo(silo, columns)
+        hideSiloColumns(silo, columns)
+    _set_read_task_status(read_id, CeleryTask.TASK_FINISHED)
+    msg = "%i commcare records were successfully updated: %i new, " \
+          "%i changed" % (counts['matched'] + counts['upserted'],
+                          counts['upserted'], counts['modified'])
+    return {'read_id': read_id, 'messages': [(messages.SUCCESS, msg)]}
+
+
+@shared_task
+def commcare_refresh_failed(task, *args):
+    """
+    Errback of commcare_refresh_done, called with its id and the read id when
+    a page task failed, and with its request, the exception, the traceback
+    and the read id when commcare_refresh_done raised
+    """
+    read_id = args[-1]
+    logger.error("The CommCare pages of read %s failed, see task %s"
+                 % (read_id, getattr(task, 'id', task)))
+    _set_read_task_status(read_id, CeleryTask.TASK_FAILED)
+
+
+@shared_task
+def refresh_silo_done(results, silo_id):
+    """
+    Callback of the refresh chord: adds and hides the columns reported by the
+    reads once all of them are written and collects the messages and the ids
+    of the tasks still writing, whose messages come later.
+    """
+    silo = Silo.objects.get(pk=silo_id)
+    msgs = []
+    columns = []
+    task_ids = []
+    for result in results:
+        msgs.extend(result['messages'])
+        columns.extend(result['columns'])
+        task_ids.extend(result.get('task_ids', []))
+    columns = list(OrderedDict.fromkeys(columns))
+    if columns:
+        addColsToSilo(silo, columns)
+        hideSiloColumns(silo, columns)
+    return {'messages': msgs, 'task_ids': task_ids}
+
+
+def _finish_merge_task(task, status, res):
+    task.task_status = status
+    task.result = json.dumps(res)
+    task.save(update_fields=['task_status', 'result'])
+
+
+@shared_task(bind=True, acks_late=True, max_retries=3)
+def merge_silos(self, mapping_id, task_id, refresh=False):
+    """
+    Merges or appends the silos of a mapping into its merged silo, started
+    by do_merge. The merged silo is deleted if the merge fails, unless the
+    merge refreshes a merged silo that already existed (updateSiloData).
+
+    The progress and the result of the merge are kept on the CeleryTask
+    task_id of the user who started it, which outlives the merged silo.
+
+    A retried run starts over, which writes no row twice: merges are upserts
+    and appends are rebuilt under a staging id. The task is acknowledged once
+    done, so the run of a worker that crashed is retried too.
+
+    returns a dict with the status and the message of the merge
+    """
+    # the merges are done by functions of the views, which import this module
+    from silo.views import appendTwoSilos, merge_two_silos
+
+    mapping = MergedSilosFieldMapping.objects.get(pk=mapping_id)
+    silo = mapping.merged_silo
+    task = CeleryTask.objects.get(pk=task_id)
+    task.task_status = CeleryTask.TASK_IN_PROGRESS
+    task.rows_processed = 0
+    task.rows_per_second = None
+    task.rows_total = get_silo_row_count(mapping.from_silo_id) + \
+        get_silo_row_count(mapping.to_silo_id)
+    task.save()
+
+    if mapping.merge_type == MergedSilosFieldMapping.MERGE:
+        merge = merge_two_silos
+    else:
+        merge = appendTwoSilos
+    marks = json.loads(mapping.watermarks)
+    try:
+        res = merge(mapping.mapping, mapping.from_silo_id,
+                    mapping.to_silo_id, silo.pk, marks,
+                    progress=MergeProgress(task))
+    except PyMongoError as e:
+        logger.error(e)
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=2 ** self.request.retries)
+        res = {'status': "danger", 'message': "The merge failed: %s" % e}
+    except Exception as e:
+        logger.exception(e)
+        res = {'status': "danger", 'message': "The merge failed: %s" % e}
+
+    if res['status'] == "danger":
+        if not refresh:
+            # the mapping goes with the silo
+            delete_silo_rows(silo.pk)
+            silo.delete()
+        _finish_merge_task(task, CeleryTask.TASK_FAILED, res)
+        return res
+
+    mapping.watermarks = json.dumps(marks)
+    mapping.save(update_fields=['watermarks'])
+    _finish_merge_task(task, CeleryTask.TASK_FINISHED, res)
+    return res
+
+
+@shared_task
+def merge_silos_failed(request, exc, traceback, task_id):
+    """
+    Errback of merge_silos, called by the worker with the request, the
+    exception and the traceback of the merge when it raised
+    """
+    logger.error("The merge of task %s failed: %s" % (request.id, exc))
+    _finish_merge_task(
+        CeleryTask.objects.get(pk=task_id), CeleryTask.TASK_FAILED,
+        {'status': "danger", 'message': "The merge did not finish"})
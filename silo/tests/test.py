@@ -1,23 +1,33 @@
 # -*- coding: utf-8 -*-
 import os
 import json
+from StringIO import StringIO
 
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase
 from django.test import Client
 from django.test import RequestFactory
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.management import call_command
 
 from commcare.tasks import parseCommCareData
 from commcare.util import getProjects
-from silo.tasks import process_silo
+from silo.tasks import (commcare_refresh_done, commcare_refresh_failed,
+                        merge_silos, merge_silos_failed, process_silo,
+                        refresh_read, refresh_silo_done)
 from silo.forms import get_read_form
 from silo.models import (DeletedSilos, LabelValueStore, ReadType, Read, Silo,
-                         CeleryTask)
+                         CeleryTask, MergedSilosFieldMapping, SiloColumn,
+                         get_row_count_collection, get_version_collection,
+                         get_silo_version, add_silo_rows, delete_silo_rows,
+                         set_silo_rows)
 from silo.views import (addColumnFilter, editColumnOrder, newFormulaColumn,
                         showRead, edit_silo, uploadFile, silo_detail)
 from tola.util import (addColsToSilo, hideSiloColumns, getColToTypeDict,
-                       getSiloColumnNames, cleanKey)
+                       getSiloColumnNames, getCompleteSiloColumnNames,
+                       get_silo_columns, deleteSiloColumns, renameSiloColumn,
+                       reorderSiloColumns, cleanKey, save_data_to_silo)
 
 from django.contrib.contenttypes.models import ContentType
 from django.utils.encoding import smart_str
@@ -110,6 +120,55 @@ class UploadFileTest(TestCase):
                          ['First_Name', 'Last_Name', 'E-mail'])
         self.assertTrue(process_done)
 
+    def test_celery_progress(self):
+        silo = factories.Silo(owner=self.user, public=False)
+
+        read_type = factories.ReadType(read_type="CSV")
+        upload_file = open('silo/tests/sample_data/test.csv', 'rb')
+        read = factories.Read(
+            owner=self.user, type=read_type,
+            file_data=SimpleUploadedFile(upload_file.name, upload_file.read())
+        )
+        factories.CeleryTask(task_status=CeleryTask.TASK_CREATED,
+                             content_object=read)
+
+        process_silo(silo.id, read.id)
+
+        ctask = CeleryTask.objects.get(
+            object_id=read.id,
+            content_type=ContentType.objects.get_for_model(Read)
+        )
+        file_size = os.path.getsize('silo/tests/sample_data/test.csv')
+        self.assertEqual(ctask.task_status, CeleryTask.TASK_FINISHED)
+        self.assertEqual(ctask.rows_processed, 4)
+        self.assertEqual(ctask.bytes_processed, file_size)
+        self.assertEqual(ctask.bytes_total, file_size)
+        self.assertIsNotNone(ctask.progress_updated)
+
+    def test_celery_resume(self):
+        silo = factories.Silo(owner=self.user, public=False)
+
+        read_type = factories.ReadType(read_type="CSV")
+        upload_file = open('silo/tests/sample_data/test.csv', 'rb')
+        read = factories.Read(
+            owner=self.user, type=read_type,
+            file_data=SimpleUploadedFile(upload_file.name, upload_file.read())
+        )
+        # a previous run of the task already committed the first two rows
+        factories.CeleryTask(task_status=CeleryTask.TASK_IN_PROGRESS,
+                             rows_processed=2, content_object=read)
+
+        process_silo(silo.id, read.id)
+
+        ctask = CeleryTask.objects.get(
+            object_id=read.id,
+            content_type=ContentType.objects.get_for_model(Read)
+        )
+        self.assertEqual(ctask.task_status, CeleryTask.TASK_FINISHED)
+        self.assertEqual(ctask.rows_processed, 4)
+        self.assertEqual(LabelValueStore.objects(silo_id=silo.id).count(), 2)
+        LabelValueStore.objects(silo_id=silo.id).delete()
+
     def test_celery_failure(self):
         silo = factories.Silo(owner=self.user, public=False)
 
@@ -140,6 +199,178 @@ class UploadFileTest(TestCase):
             process_silo(silo.id, -1)
 
 
+class UpdateSiloDataTest(TestCase):
+    """
+    Tests the tasks refreshing the reads of a silo. Each read is refreshed
+    in its own task and the chord callback adds the columns.
+    """
+    def setUp(self):
+        self.user = factories.User()
+        self.silo = factories.Silo(owner=self.user)
+        read_type = factories.ReadType(read_type="JSON")
+        self.read = factories.Read(owner=self.user, type=read_type,
+                                   read_url="http://example.org/feed.json")
+        self.silo.reads.add(self.read)
+        self.task = CeleryTask.objects.create(
+            task_id=None, task_status=CeleryTask.TASK_CREATED,
+            content_object=self.read)
+
+    def tearDown(self):
+        LabelValueStore.objects(silo_id=self.silo.id).delete()
+
+    @patch('silo.tasks.importJSON')
+    def test_refresh_read(self, mock_import_json):
+        mock_import_json.return_value = [{'name': 'a'}, {'name': 'b'}]
+        result = refresh_read(self.silo.id, self.read.id, self.user.id)
+
+        self.assertEqual(result['read_id'], self.read.id)
+        self.assertEqual(len(result['messages']), 1)
+        self.assertEqual(LabelValueStore.objects(
+            silo_id=self.silo.id, read_id=self.read.id).count(), 2)
+        task = CeleryTask.objects.get(pk=self.task.pk)
+        self.assertEqual(task.task_status, CeleryTask.TASK_FINISHED)
+
+    @patch('silo.tasks.importJSON', side_effect=ValueError('bad feed'))
+    def test_refresh_read_failure(self, mock_import_json):
+        result = refresh_read(self.silo.id, self.read.id, self.user.id)
+
+        self.assertIn('bad feed', result['messages'][0][1])
+        task = CeleryTask.objects.get(pk=self.task.pk)
+        self.assertEqual(task.task_status, CeleryTask.TASK_FAILED)
+
+    def test_refresh_silo_done(self):
+        results = [
+            {'read_id': 1, 'messages': [(25, 'first')], 'columns': ['a']},
+            {'read_id': 2, 'messages': [(25, 'second')],
+             'columns': ['a', 'b'], 'task_ids': ['commcare-id']},
+        ]
+        result = refresh_silo_done(results, self.silo.id)
+
+        self.assertEqual(result['messages'], [(25, 'first'), (25, 'second')])
+        self.assertEqual(result['task_ids'], ['commcare-id'])
+        silo = Silo.objects.get(pk=self.silo.id)
+        self.assertEqual(getCompleteSiloColumnNames(silo.id), ['a', 'b'])
+        self.assertEqual(set(json.loads(silo.hidden_columns)), {'a', 'b'})
+
+    def test_commcare_refresh_done(self):
+        self.task.task_status = CeleryTask.TASK_IN_PROGRESS
+        self.task.save()
+        counts = {'matched': 2, 'modified': 1, 'upserted': 1}
+        results = [{'columns': ['name', 'id'], 'counts': counts},
+                   {'columns': ['a.b', 'silo_id'], 'counts': counts}]
+        result = commcare_refresh_done(results, self.silo.id, self.read.id)
+
+        self.assertIn('6 commcare records', result['messages'][0][1])
+        self.assertEqual(sorted(getCompleteSiloColumnNames(self.silo.id)),
+                         ['a_b', 'name', 'user_assigned_id'])
+        task = CeleryTask.objects.get(pk=self.task.pk)
+        self.assertEqual(task.task_status, CeleryTask.TASK_FINISHED)
+
+        # the errback of a failed page task
+        commcare_refresh_failed('task-id', self.read.id)
+        task = CeleryTask.objects.get(pk=self.task.pk)
+        self.assertEqual(task.task_status, CeleryTask.TASK_FAILED)
+
+    @patch('silo.tasks.mergeCommCareResults', side_effect=KeyError('counts'))
+    def test_commcare_refresh_done_failed(self, mock_merge_results):
+        # the errback is called by celery when the callback raises
+        self.task.task_status = CeleryTask.TASK_IN_PROGRESS
+        self.task.save()
+        result = commcare_refresh_done.apply(
+            args=([], self.silo.id, self.read.id),
+            link_error=commcare_refresh_failed.s(self.read.id))
+        self.assertTrue(result.failed())
+
+        task = CeleryTask.objects.get(pk=self.task.pk)
+        self.assertEqual(task.task_status, CeleryTask.TASK_FAILED)
+
+
+class MergeSilosTest(TestCase):
+    """
+    Tests the task merging the silos of a mapping, started by do_merge
+    """
+    def setUp(self):
+        self.user = factories.User()
+        self.left_silo = factories.Silo(owner=self.user)
+        self.right_silo = factories.Silo(owner=self.user)
+        self.merged_silo = factories.Silo(owner=self.user)
+        self.mapping = MergedSilosFieldMapping.objects.create(
+            from_silo=self.left_silo, to_silo=self.right_silo,
+            merged_silo=self.merged_silo, mapping='{}',
+            merge_type=MergedSilosFieldMapping.MERGE)
+        self.task = CeleryTask.objects.create(
+            task_id='task-id', task_status=CeleryTask.TASK_CREATED,
+            content_object=self.user)
+        LabelValueStore(silo_id=self.left_silo.id, a='1').save()
+        LabelValueStore(silo_id=self.right_silo.id, a='2').save()
+        get_row_count_collection().delete_many(
+            {'_id': {'$in': [self.left_silo.id, self.right_silo.id]}})
+
+    def tearDown(self):
+        for silo in (self.left_silo, self.right_silo, self.merged_silo):
+            LabelValueStore.objects(silo_id=silo.id).delete()
+
+    @patch('silo.views.merge_two_silos')
+    def test_merge_silos(self, mock_merge_two_silos):
+        def merge(mapping, left, right, merged, marks, progress=None):
+            progress(2)
+            marks[str(left)] = {'id': 'mark'}
+            return {'status': 'success',
+                    'message': 'Merged data successfully'}
+        mock_merge_two_silos.side_effect = merge
+
+        result = merge_silos(self.mapping.pk, self.task.pk)
+
+        self.assertEqual(result['status'], 'success')
+        task = CeleryTask.objects.get(pk=self.task.pk)
+        self.assertEqual(task.task_status, CeleryTask.TASK_FINISHED)
+        self.assertEqual(json.loads(task.result), result)
+        self.assertEqual(task.rows_total, 2)
+        self.assertEqual(task.rows_processed, 2)
+        mapping = MergedSilosFieldMapping.objects.get(pk=self.mapping.pk)
+        self.assertEqual(json.loads(mapping.watermarks),
+                         {str(self.left_silo.id): {'id': 'mark'}})
+
+    @patch('silo.views.merge_two_silos')
+    def test_merge_silos_danger(self, mock_merge_two_silos):
+        mock_merge_two_silos.return_value = {'status': 'danger',
+                                             'message': 'Failed'}
+
+        result = merge_silos(self.mapping.pk, self.task.pk)
+
+        self.assertEqual(result['status'], 'danger')
+        self.assertFalse(Silo.objects.filter(
+            pk=self.merged_silo.pk).exists())
+        task = CeleryTask.objects.get(pk=self.task.pk)
+        self.assertEqual(task.task_status, CeleryTask.TASK_FAILED)
+        self.assertEqual(json.loads(task.result), result)
+
+    @patch('silo.views.merge_two_silos')
+    def test_merge_silos_danger_refresh(self, mock_merge_two_silos):
+        # a merged silo that already existed is kept
+        mock_merge_two_silos.return_value = {'status': 'danger',
+                                             'message': 'Failed'}
+
+        result = merge_silos(self.mapping.pk, self.task.pk, refresh=True)
+
+        self.assertEqual(result['status'], 'danger')
+        self.assertTrue(Silo.objects.filter(
+            pk=self.merged_silo.pk).exists())
+        task = CeleryTask.objects.get(pk=self.task.pk)
+        self.assertEqual(task.task_status, CeleryTask.TASK_FAILED)
+
+    def test_merge_silos_failed(self):
+        # the errback is called by celery when the merge raises
+        result = merge_silos.apply(
+            args=(0, self.task.pk),
+            link_error=merge_silos_failed.s(self.task.pk))
+        self.assertTrue(result.failed())
+
+        task = CeleryTask.objects.get(pk=self.task.pk)
+        self.assertEqual(task.task_status, CeleryTask.TASK_FAILED)
+        self.assertEqual(json.loads(task.result)['status'], 'danger')
+
+
 class SiloDetailTest(TestCase):
     """
     Test Silo Detail in the following scenarios
@@ -173,6 +404,7 @@ class SiloDetailTest(TestCase):
 
         request = self.factory.get(self.silo_detail_url)
         request.user = self.user
+        request.session = {}
 
         response = silo_detail(request, silo.pk)
         self.assertContains(
@@ -202,6 +434,7 @@ class SiloDetailTest(TestCase):
         # Check view
         request = self.factory.get(self.silo_detail_url)
         request.user = self.user
+        request.session = {}
 
         response = silo_detail(request, silo.pk)
         self.assertContains(
@@ -231,6 +464,7 @@ class SiloDetailTest(TestCase):
         # Check view
         request = self.factory.get(self.silo_detail_url)
         request.user = self.user
+        request.session = {}
 
         response = silo_detail(request, silo.pk)
         self.assertContains(
@@ -354,6 +588,7 @@ class SiloTest(TestCase):
         silo = Silo.objects.get(name="Test CSV Import")
         request = self.factory.get(self.silo_detail_url)
         request.user = self.tola_user.user
+        request.session = {}
 
         response = silo_detail(request, silo.pk)
         self.assertEqual(response.status_code, 200)
@@ -898,3 +1133,139 @@ class TestCleanKeys(TestCase):
         }
         self.assertEqual(returned_data, expected_data)
         LabelValueStore.objects(silo_id=self.silo.id).delete()
+
+
+class SiloRowCountTest(TestCase):
+    def setUp(self):
+        self.silo = factories.Silo()
+        self.read = self.silo.reads.first()
+        LabelValueStore.objects(silo_id=self.silo.id).delete()
+
+    def tearDown(self):
+        LabelValueStore.objects(silo_id=self.silo.id).delete()
+
+    def _counter(self):
+        return get_row_count_collection().find_one(
+            {'_id': self.silo.id})['count']
+
+    def test_row_count_maintained(self):
+        self.assertEqual(self.silo.data_count, 0)
+
+        save_data_to_silo(self.silo, [{'a': 1}, {'a': 2}, {'a': 3}],
+                          self.read)
+        self.assertEqual(self._counter(), 3)
+
+        LabelValueStore.objects(silo_id=self.silo.id).first().delete()
+        self.assertEqual(self._counter(), 2)
+
+        delete_silo_rows(self.silo.id)
+        self.assertEqual(self._counter(), 0)
+        self.assertEqual(self.silo.data_count, 0)
+
+    def test_row_count_batch(self):
+        self.assertEqual(self.silo.data_count, 0)
+        version = get_silo_version(self.silo.id)
+
+        for value in (1, 2):
+            LabelValueStore(silo_id=self.silo.id, a=value).save(
+                record_write=False)
+        self.assertEqual(self._counter(), 0)
+        self.assertEqual(get_silo_version(self.silo.id), version)
+
+        add_silo_rows(self.silo.id, 2)
+        self.assertEqual(self._counter(), 2)
+        self.assertEqual(get_silo_version(self.silo.id), version + 1)
+
+    def test_repair_silo_row_counts(self):
+        save_data_to_silo(self.silo, [{'a': 1}, {'a': 2}], self.read)
+        set_silo_rows(self.silo.id, 42)
+        self.assertEqual(self.silo.data_count, 42)
+
+        call_command('repair_silo_row_counts', silo_ids=[self.silo.id],
+                     stdout=StringIO())
+        self.assertEqual(self.silo.data_count, 2)
+
+
+class SiloColumnsTest(TestCase):
+    def setUp(self):
+        self.silo = factories.Silo()
+
+    def test_get_silo_columns_cached(self):
+        addColsToSilo(self.silo, ['a', 'b'], {'b': 'int'})
+        columns = get_silo_columns(self.silo.pk)
+        self.assertIs(get_silo_columns(self.silo.pk), columns)
+        self.assertEqual(columns.names, ('a', 'b'))
+        self.assertEqual(columns.types, {'a': 'string', 'b': 'int'})
+
+    def test_get_silo_columns_invalidated(self):
+        addColsToSilo(self.silo, ['a', 'b', 'c'])
+        self.assertEqual(getSiloColumnNames(self.silo.pk), ['a', 'b', 'c'])
+
+        hideSiloColumns(self.silo, ['b'])
+        self.assertEqual(getSiloColumnNames(self.silo.pk), ['a', 'c'])
+        self.assertEqual(get_silo_columns(self.silo.pk).hidden, {'b'})
+
+        addColsToSilo(self.silo, ['d'])
+        self.assertEqual(getCompleteSiloColumnNames(self.silo.pk),
+                         ['a', 'b', 'c', 'd'])
+
+    def test_get_silo_columns_other_process(self):
+        addColsToSilo(self.silo, ['a', 'b'])
+        self.assertEqual(getSiloColumnNames(self.silo.pk), ['a', 'b'])
+
+        # the columns written by another process, e.g. a worker, are read
+        # once it bumps the version, whatever the default cache holds
+        SiloColumn.objects.filter(silo=self.silo, name='b').update(name='c')
+        cache.clear()
+        self.assertEqual(getSiloColumnNames(self.silo.pk), ['a', 'b'])
+        get_version_collection().update_one(
+            {'_id': self.silo.pk}, {'$inc': {'columns': 1}}, upsert=True)
+        self.assertEqual(getSiloColumnNames(self.silo.pk), ['a', 'c'])
+
+    def test_column_rows(self):
+        addColsToSilo(self.silo, ['a', 'b', 'c'], {'c': 'int'})
+        addColsToSilo(self.silo, ['b', 'd'])
+        self.assertEqual(list(self.silo.silo_columns.values_list(
+            'name', 'position')), [('a', 0), ('b', 1), ('c', 2), ('d', 3)])
+
+        reorderSiloColumns(self.silo, ['d', 'b'])
+        self.assertEqual(getCompleteSiloColumnNames(self.silo.pk),
+                         ['d', 'b', 'a', 'c'])
+
+        renameSiloColumn(self.silo, 'a', 'e')
+        deleteSiloColumns(self.silo, ['b'])
+        self.assertEqual(getCompleteSiloColumnNames(self.silo.pk),
+                         ['d', 'e', 'c'])
+        self.assertEqual(getColToTypeDict(self.silo)['c'], 'int')
+
+    def test_columns_json(self):
+        silo = factories.Silo(columns='[{"name": "a", "type": "int"}, "b"]',
+                              hidden_columns='["b"]')
+        self.assertEqual(json.loads(silo.columns),
+                         [{'name': 'a', 'type': 'int'},
+                          {'name': 'b', 'type': 'string'}])
+        self.assertEqual(getSiloColumnNames(silo.pk), ['a'])
+
+        silo.columns = json.dumps([{'name': 'b', 'type': 'string'},
+                                   {'name': 'c', 'type': 'string'}])
+        silo.hidden_columns = '[]'
+        silo.save()
+        silo = Silo.objects.get(pk=silo.pk)
+        self.assertEqual(getSiloColumnNames(silo.pk), ['b', 'c'])
+        self.assertEqual(json.loads(silo.hidden_columns), [])
+
+    def test_columns_json_prefetched(self):
+        addColsToSilo(self.silo, ['a', 'b'], {'b': 'int'})
+        hideSiloColumns(self.silo, ['b'])
+        silo = Silo.objects.prefetch_related('silo_columns').get(
+            pk=self.silo.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(json.loads(silo.columns),
+                             [{'name': 'a', 'type': 'string'},
+                              {'name': 'b', 'type': 'int'}])
+            self.assertEqual(json.loads(silo.hidden_columns), ['b'])
+
+        silo.columns = json.dumps([{'name': 'c', 'type': 'string'}])
+        silo.save()
+        self.assertEqual(json.loads(silo.columns),
+                         [{'name': 'c', 'type': 'string'}])
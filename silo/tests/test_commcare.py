@@ -0,0 +1,155 @@
+from django.test import TestCase, override_settings
+from mock import Mock, patch
+
+from commcare.tasks import (fetchCommCareData, storeCommCareData,
+                            mergeCommCareResults)
+from commcare.pager import (CommCarePager, CommCareFetchError, TokenBucket,
+                            URLNotFoundError, get_cursor_url, get_domain,
+                            get_retry_after, get_database,
+                            RATE_LIMIT_COLLECTION, METRICS_COLLECTION)
+from silo.models import LabelValueStore
+
+URL = 'https://www.commcarehq.org/a/test-domain/api/v0.5/case/?format=JSON' \
+      '&limit=50'
+
+
+def make_response(status_code, data='{"meta": {}, "objects": [{}]}',
+                  headers=None):
+    return Mock(status_code=status_code, content=data, text=data,
+                headers=headers or {})
+
+
+class CommCarePagerHelpersTest(TestCase):
+    def test_get_domain(self):
+        self.assertEqual(get_domain(URL), 'test-domain')
+
+    def test_get_retry_after(self):
+        self.assertEqual(get_retry_after(make_response(
+            429, headers={'Retry-After': '7'})), 7)
+        self.assertEqual(get_retry_after(make_response(
+            429, headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})), 0)
+        self.assertIsNone(get_retry_after(make_response(429)))
+
+    def test_get_cursor_url(self):
+        self.assertIsNone(get_cursor_url(URL, {'next': None}))
+        self.assertIsNone(get_cursor_url(
+            URL, {'next': '?format=JSON&limit=50&offset=50'}))
+        self.assertEqual(
+            get_cursor_url(URL, {'next': '?format=JSON&cursor=abc'}),
+            'https://www.commcarehq.org/a/test-domain/api/v0.5/case/'
+            '?format=JSON&cursor=abc')
+
+
+class TokenBucketTest(TestCase):
+    def tearDown(self):
+        get_database()[RATE_LIMIT_COLLECTION].delete_many(
+            {'_id': 'test:bucket'})
+
+    def test_token_bucket_burst(self):
+        bucket = TokenBucket('test:bucket', rate=10, burst=3)
+        waits = [bucket.reserve() for _ in range(5)]
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertGreater(waits[3], 0)
+        self.assertGreater(waits[4], waits[3])
+
+
+@override_settings(COMMCARE_RATE_LIMIT=1000, COMMCARE_RATE_BURST=1000,
+                   COMMCARE_MAX_RETRIES=2, COMMCARE_BACKOFF_BASE=0.01)
+class CommCarePagerTest(TestCase):
+    def tearDown(self):
+        get_database()[RATE_LIMIT_COLLECTION].delete_many(
+            {'_id': 'commcare:test-domain'})
+        get_database()[METRICS_COLLECTION].delete_many(
+            {'domain': 'test-domain'})
+
+    @patch('commcare.pager.time.sleep')
+    def test_get_page_retry_after(self, mock_sleep):
+        pager = CommCarePager(URL, {'Authorization': 'ApiKey a:b'}, True)
+        pager.session.get = Mock(side_effect=[
+            make_response(429, headers={'Retry-After': '3'}),
+            make_response(200)])
+
+        data = pager.get_page(URL)
+        self.assertEqual(data['objects'], [{}])
+        mock_sleep.assert_called_with(3)
+        self.assertEqual(pager.metrics.throttled, 1)
+        self.assertEqual(pager.metrics.records, 1)
+
+    @patch('commcare.pager.time.sleep')
+    def test_get_page_gives_up(self, mock_sleep):
+        pager = CommCarePager(URL, {'u': 'user', 'p': 'pass'}, False)
+        pager.session.get = Mock(return_value=make_response(503))
+
+        with self.assertRaises(CommCareFetchError):
+            pager.get_page(URL)
+        self.assertEqual(pager.session.get.call_count, 3)
+
+    def test_get_page_not_found(self):
+        pager = CommCarePager(URL, {'u': 'user', 'p': 'pass'}, False)
+        pager.session.get = Mock(return_value=make_response(404))
+
+        with self.assertRaises(URLNotFoundError):
+            pager.get_page(URL)
+
+    def test_iter_pages_cursor(self):
+        pager = CommCarePager(URL, {'Authorization': 'ApiKey a:b'}, True)
+        pager.session.get = Mock(side_effect=[
+            make_response(200, '{"meta": {"next": "?cursor=2"}, '
+                               '"objects": [{}]}'),
+            make_response(200, '{"meta": {"next": null}, "objects": [{}]}')])
+
+        self.assertEqual(len(list(pager.iter_pages(URL))), 2)
+        pager.close()
+        self.assertEqual(pager.metrics.pages, 2)
+
+
+class FetchCommCareDataTest(TestCase):
+    @override_settings(COMMCARE_MAX_IN_FLIGHT=4)
+    @patch('commcare.tasks.CommCarePager')
+    def test_fetch_commcare_data_offsets(self, mock_pager):
+        tasks = fetchCommCareData(URL, {}, True, 0, 200, 50, -88, -98,
+                                  meta={'next': '?limit=50&offset=50'})
+        self.assertEqual(len(tasks.tasks), 4)
+        self.assertFalse(mock_pager.called)
+
+    @patch('commcare.tasks.CommCarePager')
+    def test_fetch_commcare_data_cursor(self, mock_pager):
+        tasks = fetchCommCareData(URL, {}, True, 0, 200, 50, -88, -98,
+                                  meta={'next': '?limit=1&cursor=abc'})
+        self.assertEqual(len(tasks.tasks), 1)
+        self.assertEqual(tasks.tasks[0].task,
+                         'commcare.tasks.requestCommCareCursor')
+        self.assertFalse(mock_pager.called)
+
+
+class StoreCommCareDataTest(TestCase):
+    def tearDown(self):
+        LabelValueStore.objects(silo_id=-88).delete()
+
+    def test_store_commcare_data_upsert(self):
+        counts = storeCommCareData(
+            [{'case_id': 1, 'a': 1}, {'case_id': 2, 'a': 2}], -88, -98, True)
+        self.assertEqual(counts, {'inserted': 0, 'matched': 0,
+                                  'modified': 0, 'upserted': 2})
+
+        counts = storeCommCareData(
+            [{'case_id': 1, 'a': 3}, {'case_id': 3, 'a': 4}], -88, -98, True)
+        self.assertEqual(counts['matched'], 1)
+        self.assertEqual(counts['modified'], 1)
+        self.assertEqual(counts['upserted'], 1)
+        self.assertEqual(LabelValueStore.objects(silo_id=-88).count(), 3)
+        self.assertEqual(LabelValueStore.objects.get(
+            silo_id=-88, case_id=1).a, 3)
+
+    def test_store_commcare_data_insert(self):
+        counts = storeCommCareData([{'case_id': 1}], -88, -98, False)
+        self.assertEqual(counts['inserted'], 1)
+
+    def test_merge_commcare_results(self):
+        result = mergeCommCareResults([
+            {'columns': ['a', 'b'], 'counts': {'inserted': 2}},
+            {'columns': ['b', 'c'], 'counts': {'inserted': 1, 'matched': 4}},
+        ])
+        self.assertEqual(result['columns'], {'a', 'b', 'c'})
+        self.assertEqual(result['counts'], {'inserted': 3, 'matched': 4,
+                                            'modified': 0, 'upserted': 0})
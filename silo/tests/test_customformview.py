@@ -514,7 +514,8 @@ class CustomFormSaveDataViewTest(TestCase):
         request.user = self.tola_user.user
         view = SiloViewSet.as_view({'get': 'data'})
         response = view(request, id=self.silo.id)
-        json_content = json.loads(response.content)
+        json_content = json.loads(
+            ''.join(response.streaming_content))
         data = json_content['data'][0]
 
         self.assertEqual(data['name'], 'John Lennon')
@@ -585,7 +586,8 @@ class CustomFormSaveDataViewTest(TestCase):
         request.user = self.tola_user.user
         view = SiloViewSet.as_view({'get': 'data'})
         response = view(request, id=self.silo.id)
-        json_content = json.loads(response.content)
+        json_content = json.loads(
+            ''.join(response.streaming_content))
         data = json_content['data'][0]
 
         self.assertEqual(data['name'], 'John Lennon')
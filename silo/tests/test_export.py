@@ -0,0 +1,77 @@
+import gzip
+import json
+import time
+from datetime import datetime
+from io import BytesIO
+
+from bson import ObjectId
+from django.test import TestCase
+
+import factories
+from silo.export import (format_export_value, get_sort, iter_csv,
+                         iter_bulk_export)
+from silo.models import LabelValueStore
+from silo.query_compiler import InvalidQuery
+from tola.util import save_data_to_silo
+
+
+class ExportTest(TestCase):
+    def test_format_export_value(self):
+        self.assertEqual(format_export_value(
+            ObjectId('5aaf820a58d8e7002c889905')), '5aaf820a58d8e7002c889905')
+        self.assertEqual(format_export_value(datetime(1970, 1, 1, 0, 0, 1)),
+                         time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(1)))
+        self.assertEqual(format_export_value(3.5), '3.5')
+        self.assertEqual(format_export_value('text'), 'text')
+
+    def test_get_sort(self):
+        self.assertIsNone(get_sort(''))
+        self.assertEqual(get_sort('name'), [('name', 1)])
+        self.assertEqual(get_sort('-name'), [('name', -1)])
+
+    def test_iter_csv(self):
+        rows = [{'a': i, 'b': 'x'} for i in range(5)]
+        chunks = list(iter_csv(iter(rows), ['b', 'a'], batch_size=2))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(''.join(chunks).splitlines(),
+                         ['b,a', 'x,0', 'x,1', 'x,2', 'x,3', 'x,4'])
+        self.assertEqual(list(iter_csv(iter([]), ['a'])), [])
+
+
+class BulkExportTest(TestCase):
+    def setUp(self):
+        self.silo = factories.Silo()
+        LabelValueStore.objects(silo_id=self.silo.id).delete()
+        save_data_to_silo(self.silo, [{'a': i, 'b': 'x'} for i in range(5)],
+                          self.silo.reads.first())
+
+    def tearDown(self):
+        LabelValueStore.objects(silo_id=self.silo.id).delete()
+
+    def _export(self, **kwargs):
+        data = ''.join(iter_bulk_export(self.silo, ['a'], **kwargs))
+        return gzip.GzipFile(fileobj=BytesIO(data)).read()
+
+    def test_bulk_export_ndjson(self):
+        rows = [json.loads(line) for line in self._export().splitlines()]
+        self.assertEqual([row['a'] for row in rows], range(5))
+        self.assertNotIn('b', rows[0])
+
+        rows = [json.loads(line) for line in self._export(
+            after=rows[2]['_id']['$oid']).splitlines()]
+        self.assertEqual([row['a'] for row in rows], [3, 4])
+
+    def test_bulk_export_csv_query(self):
+        lines = self._export(output='csv',
+                             query={'a': {'$gte': 3}}).splitlines()
+        self.assertEqual(lines[0], '_id,a')
+        self.assertEqual([line.split(',')[1] for line in lines[1:]],
+                         ['3', '4'])
+
+    def test_bulk_export_invalid(self):
+        with self.assertRaises(ValueError):
+            iter_bulk_export(self.silo, ['a'], output='xml')
+        with self.assertRaises(ValueError):
+            iter_bulk_export(self.silo, ['a'], after='abc')
+        with self.assertRaises(InvalidQuery):
+            iter_bulk_export(self.silo, ['a'], query={'$where': 'true'})
@@ -221,3 +221,22 @@ class SiloFormTest(TestCase):
         form = forms.SiloForm(user=self.user, data=data, instance=silo)
 
         self.assertFalse(form.is_valid())
+
+
+class EditColumnFormTest(TestCase):
+    def test_form_rename(self):
+        form = forms.EditColumnForm(data={'a': 'c', 'b': 'b'},
+                                    extra=['a', 'b'])
+        self.assertTrue(form.is_valid())
+
+    def test_form_rename_to_existing_column(self):
+        form = forms.EditColumnForm(data={'a': 'b', 'b': 'b'},
+                                    extra=['a', 'b'])
+        self.assertFalse(form.is_valid())
+        self.assertIn('A column named b already exists',
+                      form.non_field_errors())
+
+    def test_form_rename_two_columns_to_same_name(self):
+        form = forms.EditColumnForm(data={'a': 'c', 'b': 'c'},
+                                    extra=['a', 'b'])
+        self.assertFalse(form.is_valid())
@@ -0,0 +1,60 @@
+from django.test import TestCase
+
+import factories
+from silo.indexes import (get_index_name, get_managed_indexes,
+                          ensure_silo_indexes, sync_silo_indexes,
+                          reconcile_indexes, get_collection)
+
+
+class SiloIndexesTest(TestCase):
+    def setUp(self):
+        self.user = factories.User()
+        self.silo = factories.Silo(owner=self.user)
+
+    def tearDown(self):
+        reconcile_indexes()
+
+    def test_sync_silo_indexes_base(self):
+        sync_silo_indexes(self.silo)
+        indexes = get_collection().index_information()
+        self.assertIn('silo_id_1__id_1', indexes)
+        self.assertIn('silo_id_1_create_date_-1', indexes)
+
+    def test_sync_silo_indexes_unique_fields(self):
+        factories.UniqueFields(name='E-mail', silo=self.silo)
+        names = sync_silo_indexes(self.silo)
+
+        name = get_index_name(('E-mail',))
+        self.assertEqual(names, [name])
+        self.assertEqual(get_managed_indexes().get(name), ('E-mail',))
+
+    def test_sync_silo_indexes_drops_unused(self):
+        unique_field = factories.UniqueFields(name='E-mail', silo=self.silo)
+        sync_silo_indexes(self.silo)
+        unique_field.delete()
+        factories.UniqueFields(name='Name', silo=self.silo)
+        sync_silo_indexes(self.silo)
+
+        managed = get_managed_indexes()
+        self.assertNotIn(get_index_name(('E-mail',)), managed)
+        self.assertIn(get_index_name(('Name',)), managed)
+
+    def test_sync_silo_indexes_shared(self):
+        other_silo = factories.Silo(owner=self.user)
+        factories.UniqueFields(name='E-mail', silo=other_silo)
+        unique_field = factories.UniqueFields(name='E-mail', silo=self.silo)
+        sync_silo_indexes(self.silo)
+        unique_field.delete()
+        sync_silo_indexes(self.silo)
+
+        # the other silo still relies on the index
+        self.assertIn(get_index_name(('E-mail',)), get_managed_indexes())
+
+    def test_ensure_silo_indexes_keeps_unused(self):
+        unique_field = factories.UniqueFields(name='E-mail', silo=self.silo)
+        sync_silo_indexes(self.silo)
+        unique_field.delete()
+
+        # an import creates the indexes of its silo and drops none
+        self.assertEqual(ensure_silo_indexes(self.silo), [])
+        self.assertIn(get_index_name(('E-mail',)), get_managed_indexes())
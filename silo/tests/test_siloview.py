@@ -1,15 +1,25 @@
 import os
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
 
 from rest_framework.test import APIRequestFactory
 
 import factories
 import json
 import random
+from bson import ObjectId
+from silo import query_cache
 from silo.api import SiloViewSet
-from silo.models import LabelValueStore, Silo
+from silo.query_compiler import (InvalidQuery, compile_match, compile_group,
+                                 compile_sort, parse_json_param)
+from silo.models import (LabelValueStore, Silo, bump_silo_version,
+                         count_silo_rows, delete_silo_rows, get_row_silo_id)
+from silo.pagination import (InvalidCursor, get_keyset_sort, get_keyset_match,
+                             encode_cursor, decode_cursor)
 from tola.util import save_data_to_silo
-from silo.views import merge_two_silos
+from silo.views import appendTwoSilos, merge_two_silos
+from silo.merge import MappingError, RowMapping
+from silo.merge_pipeline import compile_mapping, get_copy_fields
 
 
 class SiloListViewTest(TestCase):
@@ -118,7 +128,7 @@ class SiloDataViewTest(TestCase):
         response = view(request, id=self.silo.id)
 
         self.assertEqual(response.status_code, 200)
-        json_content = json.loads(response.content)
+        json_content = json.loads(''.join(response.streaming_content))
         self.assertEqual(json_content['recordsTotal'], 20)
         self.assertEqual(json_content['recordsFiltered'], 20)
 
@@ -128,7 +138,7 @@ class SiloDataViewTest(TestCase):
         view = SiloViewSet.as_view({'get': 'data'})
         response = view(request, id=self.silo.id)
         self.assertEqual(response.status_code, 200)
-        json_content = json.loads(response.content)
+        json_content = json.loads(''.join(response.streaming_content))
         self.assertEqual(json_content['recordsTotal'], 20)
         self.assertEqual(json_content['recordsFiltered'], 20)
 
@@ -142,7 +152,7 @@ class SiloDataViewTest(TestCase):
         view = SiloViewSet.as_view({'get': 'data'})
         response = view(request, id=silo.id)
         self.assertEqual(response.status_code, 200)
-        json_content = json.loads(response.content)
+        json_content = json.loads(''.join(response.streaming_content))
         self.assertEqual(json_content['recordsTotal'], 0)
         self.assertEqual(json_content['recordsFiltered'], 0)
 
@@ -154,7 +164,7 @@ class SiloDataViewTest(TestCase):
         view = SiloViewSet.as_view({'get': 'data'})
         response = view(request, id=self.silo.id)
         self.assertEqual(response.status_code, 200)
-        json_content = json.loads(response.content)
+        json_content = json.loads(''.join(response.streaming_content))
 
         self.assertEqual(json_content['recordsTotal'], 3)
         self.assertEqual(json_content['recordsFiltered'], 3)
@@ -167,7 +177,7 @@ class SiloDataViewTest(TestCase):
         view = SiloViewSet.as_view({'get': 'data'})
         response = view(request, id=self.silo.id)
         self.assertEqual(response.status_code, 200)
-        json_content = json.loads(response.content)
+        json_content = json.loads(''.join(response.streaming_content))
 
         self.assertEqual(json_content['recordsTotal'], 1)
         self.assertEqual(json_content['recordsFiltered'], 1)
@@ -183,7 +193,7 @@ class SiloDataViewTest(TestCase):
         view = SiloViewSet.as_view({'get': 'data'})
         response = view(request, id=self.silo.id)
         self.assertEqual(response.status_code, 200)
-        json_content = json.loads(response.content)
+        json_content = json.loads(''.join(response.streaming_content))
 
         self.assertEqual(json_content['recordsTotal'], 1)
         self.assertEqual(json_content['recordsFiltered'], 1)
@@ -198,7 +208,7 @@ class SiloDataViewTest(TestCase):
         view = SiloViewSet.as_view({'get': 'data'})
         response = view(request, id=self.silo.id)
         self.assertEqual(response.status_code, 200)
-        json_content = json.loads(response.content)
+        json_content = json.loads(''.join(response.streaming_content))
 
         data = json_content['data']
         last_rank = int(data[0]['rank'])
@@ -207,6 +217,268 @@ class SiloDataViewTest(TestCase):
             self.assertTrue(last_rank < current_rank)
             last_rank = current_rank
 
+    def test_data_silo_offset(self):
+        request = self.factory.get('/api/silo/{}/data?start=15&length=10&'
+                                   'sort={{"rank": 1}}'.format(self.silo.id))
+        request.user = self.tola_user.user
+        view = SiloViewSet.as_view({'get': 'data'})
+        response = view(request, id=self.silo.id)
+        self.assertEqual(response.status_code, 200)
+        json_content = json.loads(''.join(response.streaming_content))
+
+        ranks = [int(d['rank']) for d in json_content['data']]
+        self.assertEqual(ranks, [16, 17, 18, 19, 20])
+        self.assertNotIn('next', json_content)
+
+    def test_data_silo_cursor(self):
+        view = SiloViewSet.as_view({'get': 'data'})
+        url = '/api/silo/{}/data?length=7&sort={{"rank": -1}}&cursor='.format(
+            self.silo.id)
+        ranks = []
+        cursor = ''
+        while cursor is not None:
+            request = self.factory.get(url + cursor)
+            request.user = self.tola_user.user
+            response = view(request, id=self.silo.id)
+            self.assertEqual(response.status_code, 200)
+            json_content = json.loads(''.join(response.streaming_content))
+            self.assertLessEqual(len(json_content['data']), 7)
+            self.assertEqual(json_content['recordsTotal'], 20)
+            ranks += [int(d['rank']) for d in json_content['data']]
+            cursor = json_content['next']
+
+        self.assertEqual(ranks, range(20, 0, -1))
+
+    def test_data_silo_cursor_hidden_sort_key(self):
+        # create_date is not part of the rows returned, the cursor still
+        # has to hold it
+        view = SiloViewSet.as_view({'get': 'data'})
+        url = '/api/silo/{}/data?length=7&sort={{"create_date": 1}}' \
+              '&cursor='.format(self.silo.id)
+        ranks = []
+        cursor = ''
+        while cursor is not None:
+            request = self.factory.get(url + cursor)
+            request.user = self.tola_user.user
+            response = view(request, id=self.silo.id)
+            self.assertEqual(response.status_code, 200)
+            json_content = json.loads(''.join(response.streaming_content))
+            for d in json_content['data']:
+                self.assertNotIn('create_date', d)
+                ranks.append(int(d['rank']))
+            cursor = json_content['next']
+            if cursor is not None:
+                position = decode_cursor(cursor,
+                                         get_keyset_sort({'create_date': 1}))
+                self.assertIsNotNone(position[0])
+
+        self.assertEqual(sorted(ranks), range(1, 21))
+
+    def test_data_silo_cursor_invalid(self):
+        view = SiloViewSet.as_view({'get': 'data'})
+        request = self.factory.get('/api/silo/{}/data?cursor=abc'.format(
+            self.silo.id))
+        request.user = self.tola_user.user
+        response = view(request, id=self.silo.id)
+        self.assertEqual(response.status_code, 400)
+
+    def test_data_silo_cache(self):
+        query_cache.reset_stats()
+        view = SiloViewSet.as_view({'get': 'data'})
+        url = '/api/silo/{}/data?sort={{"rank": 1}}&draw={}'
+        contents = []
+        for draw in (1, 2):
+            request = self.factory.get(url.format(self.silo.id, draw))
+            request.user = self.tola_user.user
+            response = view(request, id=self.silo.id)
+            contents.append(json.loads(''.join(response.streaming_content)))
+        self.assertEqual(contents[1]['draw'], 2)
+        self.assertEqual(contents[1]['data'], contents[0]['data'])
+        self.assertEqual(query_cache.get_stats(),
+                         {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+        # a write bumps the version of the silo and misses the cache
+        save_data_to_silo(self.silo, [{'rank': 0}], self.read)
+        request = self.factory.get(url.format(self.silo.id, 3))
+        request.user = self.tola_user.user
+        response = view(request, id=self.silo.id)
+        json_content = json.loads(''.join(response.streaming_content))
+        self.assertEqual(json_content['recordsTotal'], 21)
+        self.assertEqual(json_content['data'][0]['rank'], 0)
+        self.assertEqual(query_cache.get_stats()['misses'], 2)
+
+    def test_data_silo_cache_stats(self):
+        view = SiloViewSet.as_view({'get': 'cache_stats'})
+        request = self.factory.get('/api/silo/cache_stats')
+        request.user = self.tola_user.user
+        response = view(request)
+        self.assertEqual(response.status_code, 403)
+
+        request.user = factories.User(first_name='Homer',
+                                      last_name='Simpson', is_superuser=True)
+        response = view(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hit_rate', response.data)
+
+    def test_data_silo_query_invalid(self):
+        view = SiloViewSet.as_view({'get': 'data'})
+        for params in ('query={"$where": "true"}',
+                       'query={"opn": {"$regex": "^2015"}}',
+                       'query={"silo_id": 1}',
+                       'group={"_id": null, "all": {"$push": "$$ROOT"}}',
+                       'sort={"rank": "up"}'):
+            request = self.factory.get('/api/silo/{}/data?{}'.format(
+                self.silo.id, params))
+            request.user = self.tola_user.user
+            response = view(request, id=self.silo.id)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_export_silo_invalid(self):
+        view = SiloViewSet.as_view({'get': 'export'})
+        for params in ('query={"rank":', 'shown_cols=["rank"',
+                       'shown_cols={"rank": 1}', 'query={"$where": "true"}',
+                       'query={"opn": {"$regex": "^2015"}}',
+                       'query={"$expr": {"$gt": ["$rank", 1]}}'):
+            request = self.factory.get('/api/silo/{}/export?{}'.format(
+                self.silo.id, params))
+            request.user = self.tola_user.user
+            response = view(request, id=self.silo.id)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_data_silo_explain(self):
+        request = self.factory.get('/api/silo/{}/data?explain=1&query='
+                                   '{{"opn": "2015-11"}}'.format(self.silo.id))
+        request.user = self.tola_user.user
+        view = SiloViewSet.as_view({'get': 'data'})
+        response = view(request, id=self.silo.id)
+        self.assertEqual(response.status_code, 200)
+        plan = json.loads(response.content)
+        self.assertEqual(plan['query'], {'silo_id': self.silo.id,
+                                         'opn': '2015-11'})
+        self.assertEqual(plan['nReturned'], 3)
+        self.assertIn('winningPlan', plan)
+        self.assertGreaterEqual(plan['docsExaminedRatio'], 1)
+
+
+class QueryCompilerTest(TestCase):
+    def test_compile_match(self):
+        match = compile_match(3, {
+            'a': {'$in': [1]},
+            'b': {'$eq': 'x'},
+            '$and': [{'c': {'$gt': 1}}, {'c': {'$lt': 5}}, {'a': 2}],
+            '$or': [{'d': 1}, {'d': {'$in': [2, 3]}}],
+        })
+        self.assertEqual(match.keys()[0], 'silo_id')
+        self.assertEqual(dict(match), {
+            'silo_id': 3, 'a': 1, 'b': 'x', 'c': {'$gt': 1, '$lt': 5},
+            'd': {'$in': [1, 2, 3]}, '$and': [{'a': 2}]})
+
+        self.assertEqual(dict(compile_match(3, {'a': {'$not': {'$eq': 1}}})),
+                         {'silo_id': 3, 'a': {'$not': {'$eq': 1}}})
+        for query in ({'$where': 'true'}, {'a': {'$regex': 'x'}},
+                      {'a': {'$gt': 1, 'b': 2}}, {'$or': {}}):
+            with self.assertRaises(InvalidQuery):
+                compile_match(3, query)
+
+    def test_compile_group_sort(self):
+        group = {'_id': '$a', 'total': {'$sum': {'$multiply': ['$b', 2]}}}
+        self.assertEqual(compile_group(group), group)
+        for group in ({'total': {'$sum': 1}}, {'_id': None, 'x': 1},
+                      {'_id': {'$function': {}}}):
+            with self.assertRaises(InvalidQuery):
+                compile_group(group)
+
+        sort = parse_json_param('{"b": 1, "a": -1}', 'sort', ordered=True)
+        self.assertEqual(compile_sort(sort).keys(), ['b', 'a'])
+        with self.assertRaises(InvalidQuery):
+            compile_sort({'$natural': 1})
+        with self.assertRaises(InvalidQuery):
+            parse_json_param('[1]', 'sort')
+
+
+class KeysetPaginationTest(TestCase):
+    def test_get_keyset_sort(self):
+        self.assertEqual(get_keyset_sort({}), [('_id', 1)])
+        self.assertEqual(get_keyset_sort({'rank': -1}),
+                         [('rank', -1), ('_id', -1)])
+        with self.assertRaises(InvalidCursor):
+            get_keyset_sort({'rank': 1, 'tit': 1})
+
+    def test_cursor_round_trip(self):
+        sort = get_keyset_sort({'rank': 1})
+        _id = ObjectId()
+        token = encode_cursor(sort, {'_id': _id, 'rank': 3})
+        self.assertEqual(decode_cursor(token, sort), [3, _id])
+        with self.assertRaises(InvalidCursor):
+            decode_cursor(token, get_keyset_sort({'rank': -1}))
+
+    def test_get_keyset_match_types(self):
+        sort = get_keyset_sort({'rank': 1})
+        _id = ObjectId()
+        match = get_keyset_match(sort, [3, _id])
+        self.assertIn({'rank': {'$gt': 3}}, match['$or'])
+        self.assertIn({'rank': {'$type': 'string'}}, match['$or'])
+        self.assertNotIn({'rank': None}, match['$or'])
+
+        match = get_keyset_match(get_keyset_sort({'rank': -1}), [3, _id])
+        self.assertIn({'rank': {'$lt': 3}}, match['$or'])
+        self.assertIn({'rank': None}, match['$or'])
+        self.assertNotIn({'rank': {'$type': 'string'}}, match['$or'])
+
+
+class MergePipelineTest(TestCase):
+    def test_get_copy_fields(self):
+        self.assertEqual(get_copy_fields(['a', 'silo_id', 'b']),
+                         {'a': '$a', 'b': '$b'})
+        self.assertIsNone(get_copy_fields(['a.b']))
+        self.assertIsNone(get_copy_fields(['_id']))
+
+    def test_compile_mapping(self):
+        mappings = {
+            '0': {'left_table_cols': ['x', 'y'], 'right_table_col': 'avg',
+                  'merge_type': 'Avg'},
+            '1': {'left_table_cols': ['x', 'y'], 'right_table_col': 'text',
+                  'merge_type': 'Concatenate'},
+            '2': {'left_table_cols': ['silo_id'], 'right_table_col': 'id',
+                  'merge_type': ''},
+        }
+        fields, checks = compile_mapping(mappings, ['text'])
+        self.assertEqual(sorted(fields), ['avg', 'text'])
+        self.assertEqual(fields['avg']['$divide'][1], 2)
+        # an unmapped column only replaces the mapped value if present
+        self.assertEqual(fields['text']['$cond'][2], '$text')
+        self.assertEqual(fields['text']['$cond'][1],
+                         {'$concat': [' ', '$x', ' ', '$y']})
+        self.assertEqual(len(checks), 4)
+
+        mappings['3'] = {'left_table_cols': ['$x'], 'right_table_col': 'z',
+                         'merge_type': ''}
+        self.assertEqual(compile_mapping(mappings, []), (None, None))
+
+
+class RowMappingTest(TestCase):
+    def test_row_mapping(self):
+        mappings = {
+            '0': {'left_table_cols': ['x', 'y'], 'right_table_col': 'avg',
+                  'merge_type': 'Avg'},
+            '1': {'left_table_cols': ['x', 'y'], 'right_table_col': 'text',
+                  'merge_type': 'Concatenate'},
+            '2': {'left_table_cols': ['silo_id'], 'right_table_col': 'id',
+                  'merge_type': ''},
+            '3': {'left_table_cols': ['gone'], 'right_table_col': 'old',
+                  'merge_type': ''},
+        }
+        row_mapping = RowMapping(mappings, ['z'])
+        self.assertEqual(row_mapping.columns,
+                         set(['x', 'y', 'z', 'silo_id', 'gone']))
+        merged_row = row_mapping({'x': '1', 'y': 2, 'z': 'a', 'silo_id': 5})
+        self.assertEqual(dict(merged_row),
+                         {'avg': 1.5, 'text': ' 1 2', 'z': 'a'})
+
+        with self.assertRaises(MappingError) as cm:
+            row_mapping({'x': 'one', 'y': 2})
+        self.assertIn('Avg', str(cm.exception))
+
 
 class MergeTwoSilosTest(TestCase):
     def setUp(self):
@@ -261,6 +533,119 @@ class MergeTwoSilosTest(TestCase):
         self.assertEqual(merged_silo_row['first name'], 'Bob')
         self.assertEqual(merged_silo_row['last name'], 'Marley')
 
+    @override_settings(SILO_MERGE_BATCH_SIZE=2)
+    def test_merge_silo_batched(self):
+        left_silo = self._create_silo('left_silo', 1, 'Bob', 'left')
+        factories.UniqueFields(silo=left_silo, name='number')
+        for number, name in ((2, 'Peter'), (3, 'Rita'), (2, 'Ziggy')):
+            factories.LabelValueStore(silo_id=left_silo.pk, number=number,
+                                      **{'first name': name})
+
+        right_silo = self._create_silo('right_silo', 1, 'Marley', 'right')
+        factories.UniqueFields(silo=right_silo, name='number')
+        factories.LabelValueStore(silo_id=right_silo.pk, number=3,
+                                  **{'last name': 'Tosh'})
+
+        merged_silo = factories.Silo(owner=self.user, name='merged_silo',
+                                     public=True)
+        response = merge_two_silos(self.mapping_data, left_silo.pk,
+                                   right_silo.pk, merged_silo.pk)
+        self.assertEqual(response['status'], 'success')
+
+        rows = {row['number']: row for row in
+                LabelValueStore.objects(silo_id=merged_silo.pk)}
+        self.assertEqual(sorted(rows), [1, 2, 3])
+        # the last left row with a duplicated key wins
+        self.assertEqual(rows[2]['first name'], 'Ziggy')
+        self.assertEqual(rows[3]['first name'], 'Rita')
+        self.assertEqual(rows[3]['last name'], 'Tosh')
+        self.assertEqual(merged_silo.data_count, 3)
+
+    def test_merge_silo_incremental(self):
+        left_silo = self._create_silo('left_silo', 1, 'Bob', 'left')
+        factories.UniqueFields(silo=left_silo, name='number')
+        for number, name in ((2, 'Peter'), (4, 'Rita')):
+            factories.LabelValueStore(silo_id=left_silo.pk, number=number,
+                                      **{'first name': name})
+        right_silo = self._create_silo('right_silo', 1, 'Marley', 'right')
+        factories.UniqueFields(silo=right_silo, name='number')
+        merged_silo = factories.Silo(owner=self.user, name='merged_silo',
+                                     public=True)
+
+        marks = {}
+        merge_two_silos(self.mapping_data, left_silo.pk, right_silo.pk,
+                        merged_silo.pk, marks)
+        self.assertEqual(sorted(marks),
+                         sorted([str(left_silo.pk), str(right_silo.pk)]))
+
+        collection = LabelValueStore._get_collection()
+        # a change that doesn't stamp the row is not merged again
+        collection.update_one({'silo_id': left_silo.pk, 'number': 2},
+                              {'$set': {'first name': 'Paul'}})
+        collection.update_one({'silo_id': right_silo.pk, 'number': 1},
+                              {'$set': {'last name': 'Dylan',
+                                        'edit_date': timezone.now()}})
+        factories.LabelValueStore(silo_id=right_silo.pk, number=3,
+                                  **{'last name': 'Tosh'})
+        delete_silo_rows(left_silo.pk, number=4)
+
+        response = merge_two_silos(self.mapping_data, left_silo.pk,
+                                   right_silo.pk, merged_silo.pk, marks)
+        self.assertEqual(response['status'], 'success')
+        rows = {row['number']: row for row in
+                LabelValueStore.objects(silo_id=merged_silo.pk)}
+        self.assertEqual(sorted(rows), [1, 2, 3])
+        self.assertEqual(rows[1]['first name'], 'Bob')
+        self.assertEqual(rows[1]['last name'], 'Dylan')
+        self.assertEqual(rows[2]['first name'], 'Peter')
+        self.assertEqual(rows[3]['last name'], 'Tosh')
+        self.assertEqual(merged_silo.data_count, 3)
+
+        # a rewrite of the silo makes the next merge read all its rows
+        bump_silo_version(left_silo.pk)
+        merge_two_silos(self.mapping_data, left_silo.pk, right_silo.pk,
+                        merged_silo.pk, marks)
+        self.assertEqual(LabelValueStore.objects.get(
+            silo_id=merged_silo.pk, number=2)['first name'], 'Paul')
+
+    def test_append_silo_rebuild(self):
+        left_silo = self._create_silo('left_silo', 1, 'Bob', 'left')
+        right_silo = self._create_silo('right_silo', 2, 'Marley', 'right')
+        merged_silo = factories.Silo(owner=self.user, name='merged_silo',
+                                     public=True)
+        generations = [merged_silo.pk, -2 * merged_silo.pk,
+                       -2 * merged_silo.pk - 1]
+        data_ids = []
+        for i in range(2):
+            response = appendTwoSilos(self.mapping_data, left_silo.pk,
+                                      right_silo.pk, merged_silo.pk)
+            self.assertEqual(response['status'], 'success')
+            data_ids.append(Silo.objects.get(pk=merged_silo.pk).data_id)
+        # every rebuild is published under the other negative id
+        self.assertEqual(data_ids, generations[1:])
+        self.assertEqual(sorted(row['number'] for row in
+                                LabelValueStore.objects(
+                                    silo_id=data_ids[-1])), [1, 2])
+        self.assertEqual(merged_silo.data_count, 2)
+        # the readers resolve the rows of the silo
+        self.assertEqual(count_silo_rows(merged_silo.pk), 2)
+        self.assertEqual(get_row_silo_id(data_ids[-1]), merged_silo.pk)
+        # the replaced rows are gone
+        self.assertEqual(LabelValueStore.objects(
+            silo_id__in=generations).count(), 2)
+
+        # a failed rebuild leaves the merged silo as it was
+        mapping_data = json.loads(self.mapping_data)
+        mapping_data['0']['merge_type'] = 'Sum'
+        mapping_data['0']['left_table_cols'] = ['number', 'first name']
+        response = appendTwoSilos(json.dumps(mapping_data), left_silo.pk,
+                                  right_silo.pk, merged_silo.pk)
+        self.assertEqual(response['status'], 'danger')
+        self.assertEqual(Silo.objects.get(pk=merged_silo.pk).data_id,
+                         data_ids[-1])
+        self.assertEqual(LabelValueStore.objects(
+            silo_id__in=generations).count(), 2)
+
     def test_merge_silos_without_unique_field_in_left_silo(self):
         left_silo = self._create_silo('left_silo', 1, 'Bob', 'left')
 
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 from django.test import TestCase, override_settings, Client, RequestFactory
+from django.http import Http404
 from django.urls import reverse
 
 from rest_framework.test import APIRequestFactory
 
 from silo.tests import MongoTestCase
 from silo.api import CustomFormViewSet, PublicSiloViewSet
-from silo.models import LabelValueStore, Silo, Tag, ReadType
+from silo.models import (CeleryTask, LabelValueStore,
+                         MergedSilosFieldMapping, Silo, Tag, ReadType)
 
 from mock import Mock, patch
 from pymongo.errors import WriteError
@@ -184,8 +186,9 @@ class ExportViewsTest(TestCase, MongoTestCase):
         request.user = self.tola_user.user
         response = views.export_silo(request, silo_id)
         self.assertEqual(response.status_code, 200)
-        self.assertIn('color,type', response.content)
-        self.assertIn('black,primary', response.content)
+        content = ''.join(response.streaming_content)
+        self.assertIn('color,type', content)
+        self.assertIn('black,primary', content)
 
 
 class SiloViewsTest(TestCase, MongoTestCase):
@@ -656,14 +659,10 @@ class DoMergeViewTest(TestCase):
         self.tola_user = factories.TolaUser(organization=self.org)
         self.factory = APIRequestFactory()
 
-    @patch('silo.views.merge_two_silos')
-    @patch('silo.views.MergedSilosFieldMapping')
-    def test_merge(self, mock_merged_silos_map, mock_merge_two_silos):
-        mock_merge_two_silos.return_value = {
-            'status': 'success',
-            'message': 'Merged data successfully'
-        }
-        mock_merged_silos_map.return_value = Mock()
+    @patch('silo.views.merge_silos')
+    def test_merge(self, mock_merge_silos):
+        signature = mock_merge_silos.si.return_value.on_error.return_value
+        signature.freeze.return_value.id = 'task-id'
 
         columns = [{'name': 'name', 'type': 'text'}]
         left_read = factories.Read(read_name='Read Left',
@@ -696,19 +695,24 @@ class DoMergeViewTest(TestCase):
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(content['status'], 'success')
-        self.assertEqual(content['message'], 'Merged data successfully')
+        self.assertEqual(content['message'], 'The tables are being merged')
         self.assertEqual(content['silo_url'], expected_silo_url)
+        self.assertEqual(content['progress_url'],
+                         reverse('silo_merge_progress', args=['task-id']))
         self.assertIn(left_read, silo.reads.all())
         self.assertIn(right_read, silo.reads.all())
-
-    @patch('silo.views.appendTwoSilos')
-    @patch('silo.views.MergedSilosFieldMapping')
-    def test_append(self, mock_merged_silos_map, mock_append_two_silos):
-        mock_append_two_silos.return_value = {
-            'status': 'success',
-            'message': 'Appended data successfully'
-        }
-        mock_merged_silos_map.return_value = Mock()
+        mapping = MergedSilosFieldMapping.objects.get(merged_silo=silo)
+        task = CeleryTask.objects.get(task_id='task-id')
+        self.assertEqual(task.content_object, self.tola_user.user)
+        self.assertEqual(task.task_status, CeleryTask.TASK_CREATED)
+        mock_merge_silos.si.assert_called_once_with(mapping.pk, task.pk,
+                                                    refresh=False)
+        signature.apply_async.assert_called_once_with()
+
+    @patch('silo.views.merge_silos')
+    def test_append(self, mock_merge_silos):
+        signature = mock_merge_silos.si.return_value.on_error.return_value
+        signature.freeze.return_value.id = 'task-id'
 
         columns = [{'name': 'name', 'type': 'text'}]
         left_read = factories.Read(read_name='Read Left',
@@ -741,44 +745,15 @@ class DoMergeViewTest(TestCase):
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(content['status'], 'success')
-        self.assertEqual(content['message'], 'Appended data successfully')
+        self.assertEqual(content['message'], 'The tables are being merged')
         self.assertEqual(content['silo_url'], expected_silo_url)
         self.assertIn(left_read, silo.reads.all())
         self.assertIn(right_read, silo.reads.all())
-
-    @patch('silo.views.merge_two_silos')
-    def test_status_danger(self, mock_merge_two_silos):
-        mock_merge_two_silos.return_value = {'status': 'danger'}
-
-        columns = [{'name': 'name', 'type': 'text'}]
-        left_read = factories.Read(read_name='Read Left',
-                                   owner=self.tola_user.user)
-        right_read = factories.Read(read_name='Read Right',
-                                    owner=self.tola_user.user)
-        left_silo = factories.Silo(owner=self.tola_user.user,
-                                   columns=json.dumps(columns),
-                                   reads=[left_read])
-        right_silo = factories.Silo(owner=self.tola_user.user,
-                                    columns=json.dumps(columns),
-                                    reads=[right_read])
-        merged_silo_name = '{}_{}'.format(left_silo.name, right_silo.name)
-
-        data = {
-            'left_table_id': left_silo.id,
-            'right_table_id': right_silo.id,
-            'tableMergeType': 'merge',
-            'columns_data': 'Test',
-            'merged_table_name': merged_silo_name
-        }
-
-        request = self.factory.post('', data=data)
-        request.user = self.tola_user.user
-        response = views.do_merge(request)
-        content = json.loads(response.content)
-
-        self.assertRaises(Silo.DoesNotExist,
-                          Silo.objects.get, name=merged_silo_name)
-        self.assertEqual(content['status'], 'danger')
+        mapping = MergedSilosFieldMapping.objects.get(merged_silo=silo)
+        self.assertEqual(mapping.merge_type, 'append')
+        task = CeleryTask.objects.get(task_id='task-id')
+        mock_merge_silos.si.assert_called_once_with(mapping.pk, task.pk,
+                                                    refresh=False)
 
     def test_no_columns_passed(self):
         read = factories.Read(read_name='Read Test', owner=self.tola_user.user)
@@ -839,14 +814,10 @@ class DoMergeViewTest(TestCase):
         self.assertEqual(content['message'],
                          'Could not find the right table with id=999')
 
-    @patch('silo.views.merge_two_silos')
-    @patch('silo.views.MergedSilosFieldMapping')
-    def test_no_merge_name(self, mock_merged_silos_map, mock_merge_two_silos):
-        mock_merge_two_silos.return_value = {
-            'status': 'success',
-            'message': 'Merged data successfully'
-        }
-        mock_merged_silos_map.return_value = Mock()
+    @patch('silo.views.merge_silos')
+    def test_no_merge_name(self, mock_merge_silos):
+        signature = mock_merge_silos.si.return_value.on_error.return_value
+        signature.freeze.return_value.id = 'task-id'
 
         columns = [{'name': 'name', 'type': 'text'}]
         left_read = factories.Read(read_name='Read Left',
@@ -880,10 +851,19 @@ class DoMergeViewTest(TestCase):
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(content['status'], 'success')
-        self.assertEqual(content['message'], 'Merged data successfully')
+        self.assertEqual(content['message'], 'The tables are being merged')
         self.assertEqual(content['silo_url'], expected_silo_url)
+        self.assertEqual(content['progress_url'],
+                         reverse('silo_merge_progress', args=['task-id']))
         self.assertIn(left_read, silo.reads.all())
         self.assertIn(right_read, silo.reads.all())
+        mapping = MergedSilosFieldMapping.objects.get(merged_silo=silo)
+        task = CeleryTask.objects.get(task_id='task-id')
+        self.assertEqual(task.content_object, self.tola_user.user)
+        self.assertEqual(task.task_status, CeleryTask.TASK_CREATED)
+        mock_merge_silos.si.assert_called_once_with(mapping.pk, task.pk,
+                                                    refresh=False)
+        signature.apply_async.assert_called_once_with()
 
 
 class OneDriveViewsTest(TestCase):
@@ -1097,6 +1077,7 @@ class SiloDetailViewTest(TestCase):
 
         request = self.factory.get(url)
         request.user = self.user
+        request.session = {}
         response = views.silo_detail(request, silo.pk)
 
         self.assertEqual(response.status_code, 200)
@@ -1115,7 +1096,7 @@ class SiloDetailViewTest(TestCase):
 
         request = self.factory.get(url)
         request.user = request_user
-        request.session = 'session'
+        request.session = {}
         message_storage = FallbackStorage(request)
         request._messages = message_storage
         views.silo_detail(request, silo.pk)
@@ -1140,6 +1121,7 @@ class SiloDetailViewTest(TestCase):
 
         request = self.factory.get(url)
         request.user = request_user
+        request.session = {}
         response = views.silo_detail(request, silo.pk)
 
         self.assertEqual(response.status_code, 200)
@@ -1159,6 +1141,7 @@ class SiloDetailViewTest(TestCase):
 
         request = self.factory.get(url)
         request.user = request_user
+        request.session = {}
         response = views.silo_detail(request, silo.pk)
 
         self.assertEqual(response.status_code, 200)
@@ -1177,6 +1160,7 @@ class SiloDetailViewTest(TestCase):
 
         request = self.factory.get(url)
         request.user = self.user
+        request.session = {}
         response = views.silo_detail(request, silo.pk)
 
         self.assertEqual(response.status_code, 200)
@@ -1191,6 +1175,7 @@ class SiloDetailViewTest(TestCase):
 
         request = self.factory.get(url)
         request.user = self.user
+        request.session = {}
         response = views.silo_detail(request, silo.pk)
         template_content = response.content
 
@@ -1211,6 +1196,7 @@ class SiloDetailViewTest(TestCase):
 
         request = self.factory.get(url)
         request.user = request_user
+        request.session = {}
         response = views.silo_detail(request, silo.pk)
         template_content = response.content
 
@@ -1236,6 +1222,7 @@ class SiloDetailViewTest(TestCase):
 
         request = self.factory.get(url)
         request.user = request_user
+        request.session = {}
         response = views.silo_detail(request, silo.pk)
 
         self.assertEqual(response.status_code, 200)
@@ -1258,7 +1245,7 @@ class SiloDetailViewTest(TestCase):
 
         request = self.factory.get(url)
         request.user = request_user
-        request.session = 'session'
+        request.session = {}
         message_storage = FallbackStorage(request)
         request._messages = message_storage
         views.silo_detail(request, silo.pk)
@@ -1287,7 +1274,7 @@ class SiloDetailViewTest(TestCase):
 
         request = self.factory.get(url)
         request.user = request_user
-        request.session = 'session'
+        request.session = {}
         message_storage = FallbackStorage(request)
         request._messages = message_storage
         views.silo_detail(request, silo.pk)
@@ -1318,6 +1305,7 @@ class SiloDetailViewTest(TestCase):
         mock_get_workflowlevel1s.return_value = user_wf1s
         request = self.factory.get('')
         request.user = request_user
+        request.session = {}
         response = views.silo_detail(request, silo.pk)
 
         self.assertEqual(response.status_code, 200)
@@ -1341,7 +1329,7 @@ class SiloDetailViewTest(TestCase):
         mock_get_workflowlevel1s.return_value = user_wf1s
         request = self.factory.get('')
         request.user = request_user
-        request.session = 'session'
+        request.session = {}
         message_storage = FallbackStorage(request)
         request._messages = message_storage
         views.silo_detail(request, silo.pk)
@@ -1395,6 +1383,163 @@ class SiloDetailViewTest(TestCase):
                          'You can not  change publicity of this table')
 
 
+class SiloImportProgressViewTest(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.user = factories.User()
+        self.silo = factories.Silo(owner=self.user, public=False, shared=[])
+
+    def _get(self, user):
+        request = self.factory.get(
+            reverse('silo_import_progress', args=[self.silo.pk]))
+        request.user = user
+        request.session = {}
+        return views.silo_import_progress(request, self.silo.pk)
+
+    def test_silo_import_progress_owner(self):
+        response = self._get(self.user)
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual(content['tasks_running'], 0)
+        self.assertFalse(content['refresh_running'])
+
+    @patch('silo.views.get_workflowlevel1s', return_value=[])
+    def test_silo_import_progress_unshared_user(self, mock_wfl1s):
+        request_user = factories.User(username='Another User')
+        self.assertEqual(self._get(request_user).status_code, 403)
+
+        self.silo.shared.add(request_user)
+        self.assertEqual(self._get(request_user).status_code, 200)
+
+
+class SiloMergeProgressViewTest(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.user = factories.User()
+        self.task = CeleryTask.objects.create(
+            task_id='task-id', task_status=CeleryTask.TASK_IN_PROGRESS,
+            content_object=self.user, rows_processed=5, rows_total=20)
+
+    def _get(self, user):
+        request = self.factory.get(
+            reverse('silo_merge_progress', args=['task-id']))
+        request.user = user
+        return views.silo_merge_progress(request, 'task-id')
+
+    def test_silo_merge_progress_running(self):
+        response = self._get(self.user)
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertFalse(content['done'])
+        self.assertEqual(content['rows_processed'], 5)
+        self.assertEqual(content['percent'], 25)
+
+    def test_silo_merge_progress_failed(self):
+        # the merged silo of a failed merge is gone, its result is not
+        self.task.task_status = CeleryTask.TASK_FAILED
+        self.task.result = json.dumps({'status': 'danger',
+                                       'message': 'The merge failed'})
+        self.task.save()
+
+        content = json.loads(self._get(self.user).content)
+        self.assertEqual(content, {'status': 'danger',
+                                   'message': 'The merge failed',
+                                   'done': True})
+
+    def test_silo_merge_progress_other_user(self):
+        request_user = factories.User(username='Another User')
+        with self.assertRaises(Http404):
+            self._get(request_user)
+
+
+class CheckSiloRefreshTest(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.request = self.factory.get('')
+        self.request.session = {'silo_refresh_tasks': {'1': ['chord-id']}}
+        self.message_storage = FallbackStorage(self.request)
+        self.request._messages = self.message_storage
+
+    @patch('silo.views.AsyncResult')
+    def test_check_silo_refresh(self, mock_async_result):
+        # the messages of the CommCare tasks come after those of the chord
+        results = {
+            'chord-id': Mock(result={'messages': [(25, 'Updated')],
+                                     'task_ids': ['commcare-id']}),
+            'commcare-id': Mock(result={'messages': [(25, 'CommCare')]}),
+        }
+        results['commcare-id'].ready.return_value = False
+        mock_async_result.side_effect = lambda task_id: results[task_id]
+
+        self.assertTrue(views.checkSiloRefresh(self.request, 1))
+        self.assertEqual(self.request.session['silo_refresh_tasks'],
+                         {'1': ['commcare-id']})
+
+        results['commcare-id'].ready.return_value = True
+        self.assertFalse(views.checkSiloRefresh(self.request, 1))
+        self.assertEqual(self.request.session['silo_refresh_tasks'], {})
+        self.assertEqual([m.message for m in self.message_storage],
+                         ['Updated', 'CommCare'])
+
+
+class UpdateSiloDataViewTest(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.user = factories.User()
+        self.silo = factories.Silo(owner=self.user)
+        self.mapping = MergedSilosFieldMapping.objects.create(
+            from_silo=factories.Silo(owner=self.user),
+            to_silo=factories.Silo(owner=self.user),
+            merged_silo=self.silo, mapping='{}',
+            merge_type=MergedSilosFieldMapping.MERGE)
+
+    def _request(self, session):
+        request = self.factory.get(
+            reverse('updateMergedTable', args=[self.silo.pk]))
+        request.user = self.user
+        request.session = session
+        message_storage = FallbackStorage(request)
+        request._messages = message_storage
+        return request, message_storage
+
+    @patch('silo.views.merge_silos')
+    def test_update_merged_silo(self, mock_merge_silos):
+        signature = mock_merge_silos.si.return_value.on_error.return_value
+        signature.freeze.return_value.id = 'task-id'
+        request, message_storage = self._request({})
+
+        response = views.updateSiloData(request, self.silo.pk)
+
+        self.assertEqual(response.status_code, 302)
+        task = CeleryTask.objects.get(task_id='task-id')
+        self.assertEqual(task.content_object, self.user)
+        mock_merge_silos.si.assert_called_once_with(self.mapping.pk, task.pk,
+                                                    refresh=True)
+        signature.apply_async.assert_called_once_with()
+        self.assertEqual(request.session['silo_merge_tasks'],
+                         {str(self.silo.pk): 'task-id'})
+        self.assertIn('The table is being merged again.',
+                      [m.message for m in message_storage])
+
+    def test_check_silo_merge(self):
+        task = CeleryTask.objects.create(
+            task_id='task-id', task_status=CeleryTask.TASK_IN_PROGRESS,
+            content_object=self.user)
+        session = {'silo_merge_tasks': {str(self.silo.pk): 'task-id'}}
+        request, message_storage = self._request(session)
+        self.assertEqual(views.checkSiloMerge(request, self.silo.pk),
+                         'task-id')
+
+        task.task_status = CeleryTask.TASK_FINISHED
+        task.result = json.dumps({'status': 'success',
+                                  'message': 'Merged data successfully'})
+        task.save()
+        self.assertIsNone(views.checkSiloMerge(request, self.silo.pk))
+        self.assertEqual(request.session['silo_merge_tasks'], {})
+        self.assertIn('Merged data successfully',
+                      [m.message for m in message_storage])
+
+
 class SiloListViewTest(TestCase):
     def setUp(self):
         self.factory = RequestFactory()
@@ -1985,3 +2130,24 @@ class PublicSiloViewTest(TestCase):
         response = view(request, id=silo.id)
 
         self.assertEqual(response.status_code, 302)
+
+    def test_public_silo_view_data(self):
+        silo = factories.Silo(name='test',
+                              public=True,
+                              organization=self.organizaton,
+                              owner=self.tola_user.user)
+        LabelValueStore.objects(silo_id=silo.id).delete()
+        util.save_data_to_silo(silo, [{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}])
+
+        request = self.factory.get(
+            '/api/public_tables/{}/data?sort=-a'.format(silo.pk))
+        request.user = self.user
+        view = PublicSiloViewSet.as_view({'get': 'data'})
+        response = view(request, id=silo.id)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(''.join(response.streaming_content))
+        LabelValueStore.objects(silo_id=silo.id).delete()
+
+        self.assertEqual([row['a'] for row in data], [2, 1])
+        self.assertIn('$oid', data[0]['_id'])
+        self.assertNotIn('silo_id', data[0])
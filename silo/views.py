@@ -1,7 +1,5 @@
 import datetime
-import time
 import requests
-import csv
 import base64
 import re
 import logging
@@ -12,16 +10,18 @@ import tempfile
 import uuid
 
 from pymongo import MongoClient
+from celery import chord
+from celery.result import AsyncResult
 
 from django.conf import settings
 from django.core import files
 from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.core.urlresolvers import reverse_lazy
-from django.http import HttpResponseBadRequest,\
-    HttpResponse, HttpResponseRedirect, JsonResponse
+from django.http import Http404, HttpResponseBadRequest, \
+    HttpResponseForbidden, HttpResponse, HttpResponseRedirect, JsonResponse, \
+    StreamingHttpResponse
 from django.shortcuts import render
 from django.utils import timezone
-from django.utils.encoding import smart_str, smart_text
 from django.db.models import Q
 from django.views.decorators.csrf import csrf_protect
 from django.contrib import messages
@@ -31,21 +31,30 @@ from django.contrib.auth import logout
 from django.views.generic import View
 from django.contrib.auth.mixins import LoginRequiredMixin
 
-from gviews_v4 import import_from_gsheet_helper
 from silo.custom_csv_dict_reader import CustomDictReader
 from tola.util import importJSON, save_data_to_silo, getSiloColumnNames, \
     parseMathInstruction, calculateFormulaColumn, makeQueryForHiddenRow, \
-    getNewestDataDate, addColsToSilo, deleteSiloColumns, hideSiloColumns,  \
-    getCompleteSiloColumnNames, setSiloColumnType, getColToTypeDict
+    addColsToSilo, deleteSiloColumns, getCompleteSiloColumnNames, \
+    setSiloColumnType, renameSiloColumn, reorderSiloColumns
 
-from commcare.tasks import fetchCommCareData
 from .serializers import *
 from .models import Silo, Read, ReadType, ThirdPartyTokens, LabelValueStore, \
     Tag, UniqueFields, MergedSilosFieldMapping, TolaSites, PIIColumn, \
-    DeletedSilos, FormulaColumn, CeleryTask
+    DeletedSilos, FormulaColumn, CeleryTask, add_silo_rows, set_silo_rows, \
+    bump_silo_version, get_data_silo_id, get_row_silo_id
 from .forms import get_read_form, UploadForm, SiloForm, MongoEditForm, \
     NewColumnForm, EditColumnForm, OnaLoginForm
-from .tasks import process_silo
+from .tasks import (process_silo, refresh_read, refresh_silo_done,
+                    read_needs_refresh, importDataFromRead, merge_silos,
+                    merge_silos_failed)
+from .indexes import ensure_silo_indexes, sync_silo_indexes
+from .export import get_export_cursor, iter_csv
+from .merge import (InsertBuffer, MappingError, RowMapping, UpsertBuffer,
+                    delete_orphan_rows, get_changes, get_insertions,
+                    get_staging_id, get_watermark, has_deletions, iter_keys,
+                    iter_rows_by_keys, iter_silo_rows, publish_silo_rows)
+from .merge_pipeline import compile_mapping, get_copy_fields, merge_on_server
+from . import query_cache
 
 from django.contrib.contenttypes.models import ContentType
 from social_django.models import UserSocialAuth
@@ -101,13 +110,17 @@ def tablesLogin(request):
 
 
 # fix now that not all mongo rows need to have the same column
-def merge_two_silos(mapping_data, lsid, rsid, msid):
+def merge_two_silos(mapping_data, lsid, rsid, msid, marks=None, progress=None):
     """
     @params
     mapping_data: data that describes how mapping is done between two silos
     lsid: Left Silo ID
     rsid: Right Silo ID
     msid: Merge Silo ID
+    marks: the high-water marks of the silos at the last merge, only the rows
+        changed since are merged. Replaced by the marks of this merge when it
+        succeeds.
+    progress: called with the number of source rows of every batch written
     """
     mappings = json.loads(mapping_data)
 
@@ -115,10 +128,6 @@ def merge_two_silos(mapping_data, lsid, rsid, msid):
     r_unampped_cols = mappings.pop('right_unmapped_cols')
     merged_cols = []
 
-    l_silo_data = LabelValueStore.objects(silo_id=lsid)
-
-    r_silo_data = LabelValueStore.objects(silo_id=rsid)
-
     # Loop through the mapped cols and add them to the list of merged_cols
     for k, v in mappings.iteritems():
         col_name = v['right_table_col']
@@ -159,7 +168,7 @@ def merge_two_silos(mapping_data, lsid, rsid, msid):
         return {'status': "danger",  'message': msg}
 
     # retrieve the unique fields set for the right silo
-    r_unique_fields = rsilo.unique_fields.all()
+    r_unique_fields = list(rsilo.unique_fields.values_list('name', flat=True))
 
     if not r_unique_fields:
         msg = "The silo, [%s], must have a unique column and it should be " \
@@ -169,53 +178,21 @@ def merge_two_silos(mapping_data, lsid, rsid, msid):
         return {'status': "danger",  'message': msg}
 
     # retrieve the unique fields of the merged_silo
-    m_unique_fields = msilo.unique_fields.all()
+    m_unique_fields = set(msilo.unique_fields.values_list('name', flat=True))
 
     # make sure that the unique_fields from right table are in the merged_table
     # by adding them to the merged_cols array.
     for uf in r_unique_fields:
-        if uf.name not in merged_cols: merged_cols.append(uf.name)
+        if uf not in merged_cols: merged_cols.append(uf)
 
         # make sure to set the same unique_fields in the merged_table
-        if not m_unique_fields.filter(name=uf.name).exists():
+        if uf not in m_unique_fields:
             UniqueFields.objects.get_or_create(
-                name=uf.name, silo=msilo,
-                defaults={"name": uf.name, "silo": msilo})
-
-    # Get the correct set of data from the right table
-    for row in r_silo_data:
-        merged_row = OrderedDict()
-        for k in row:
-            # Skip over those columns in the right table that
-            # shouldn't be in the merged_table
-            if k not in merged_cols: continue
-            merged_row[k] = row[k]
-
-        # now set its silo_id to the merged_table id
-        merged_row["silo_id"] = msid
-        merged_row["create_date"] = timezone.now()
-
-        filter_criteria = {}
-        for uf in r_unique_fields:
-            try:
-                filter_criteria.update({str(uf.name): merged_row[uf.name]})
-            except KeyError as e:
-                # when this exception occurs, it means that the col identified
-                # as the unique_col is not present in
-                # all rows of the right_table
-                logger.warning("The field, %s, is not present in table id=%s"
-                               % (uf.name, rsid))
-
-        # adding the merged_table_id because the filter criteria should
-        # search the merged_table
-        filter_criteria.update({'silo_id': msid})
-
-        # this is an upsert operation.; note the upsert=True
-        db.label_value_store.update_one(filter_criteria,
-                                        {"$set": merged_row}, upsert=True)
+                name=uf, silo=msilo, defaults={"name": uf, "silo": msilo})
+    ensure_silo_indexes(msilo)
 
     # Retrieve the unique_fields set by left table
-    l_unique_fields = lsilo.unique_fields.all()
+    l_unique_fields = list(lsilo.unique_fields.values_list('name', flat=True))
     if not l_unique_fields:
         msg = "The silo, [%s], must have a unique column and it should be " \
               "the same as the one specified in [%s] silo."\
@@ -226,100 +203,146 @@ def merge_two_silos(mapping_data, lsid, rsid, msid):
     for uf in l_unique_fields:
         # if there are unique fields that are not in the right table
         # then show error
-        if not r_unique_fields.filter(name=uf.name).exists():
+        if uf not in r_unique_fields:
             msg = "Both silos (%s, %s) must have the same column set as " \
                   "unique fields" % (lsilo.name, rsilo.name)
             logger.error(msg)
             return {"status": "danger", "message": msg}
 
-    # now loop through left table and apply the mapping
-    for row in l_silo_data:
-        merged_row = OrderedDict()
-        # Loop through the column mappings for each row in left_table.
-        for k, v in mappings.iteritems():
-            merge_type = v['merge_type']
-            left_cols = v['left_table_cols']
-            right_col = v['right_table_col']
-
-            # if merge_type is specified then there must be multiple columns
-            # in the left_cols array
-            if merge_type:
-                mapped_value = ''
-                for col in left_cols:
-                    if merge_type == 'Sum' or merge_type == 'Avg':
-                        try:
-                            if mapped_value == '':
-                                mapped_value = float(row[col])
-                            else:
-                                mapped_value = float(mapped_value) \
-                                               + float(row[col])
-                        except Exception as e:
-                            msg = 'Failed to apply %s to column, %s : %s '\
-                                  % (merge_type, col, e.message)
-                            logger.error(msg)
-                            return {'status': "danger",  'message': msg}
-                    else:
-                        mapped_value += ' ' + smart_str(row[col])
-
-                # Now calculate avg if the merge_type was actually "Avg"
-                if merge_type == 'Avg':
-                    mapped_value = mapped_value / len(left_cols)
-            # only one col in left table is mapped to one col
-            #  in the right table.
-            else:
-                col = str(left_cols[0])
-                if col == "silo_id": continue
-                try:
-                    mapped_value = row[col]
-                except KeyError as e:
-                    # When updating data in merged_table at a later time, it is
-                    # possible the original source tables may have had some
-                    # columns removed in which we might get a KeyError so in
-                    # that case we just skip it.
-                    continue
+    collection = db.label_value_store
+    lsid = int(lsid)
+    rsid = int(rsid)
+    # the rows of the silos are read and written under their data ids
+    l_data_id, r_data_id, m_data_id = (lsilo.data_id, rsilo.data_id,
+                                       msilo.data_id)
+
+    # the marks are taken before reading the rows, the rows changed during
+    # the merge are merged again by the next one
+    new_marks = {str(sid): get_watermark(collection, sid)
+                 for sid in (lsid, rsid)}
+    old_marks = [(sid, (marks or {}).get(str(sid))) for sid in (lsid, rsid)]
+
+    # rows deleted from the sources are deleted from the merged table if no
+    # row of either source has their unique fields anymore
+    if any(mark and has_deletions(collection, sid, mark)
+           for sid, mark in old_marks):
+        deleted = delete_orphan_rows(collection, m_data_id, l_unique_fields,
+                                     (l_data_id, r_data_id))
+        add_silo_rows(msid, -deleted)
+
+    # only the rows of both tables sharing the unique fields of a row
+    # changed since the last merge are merged again
+    changes = [get_changes(sid, mark) for sid, mark in old_marks]
+    if None in changes:
+        changed_keys = None
+    else:
+        changed_keys = set()
+        for query in changes:
+            changed_keys.update(
+                iter_keys(collection, query, l_unique_fields))
+
+    # a full merge runs inside MongoDB if the mapping can be compiled
+    l_fields, l_checks = compile_mapping(mappings, l_unmapped_cols)
+    sources = [(r_data_id, get_copy_fields(merged_cols), [], r_unique_fields),
+               (l_data_id, l_fields, l_checks, l_unique_fields)]
+    if changed_keys is None and merge_on_server(collection, m_data_id,
+                                                sources, progress=progress):
+        set_silo_rows(msid, collection.count({'silo_id': m_data_id}))
+        if marks is not None:
+            marks.clear()
+            marks.update(new_marks)
+        return {'status': "success",  'message': "Merged data successfully"}
+
+    def iter_source_rows(silo_id, columns):
+        if changed_keys is None:
+            return iter_silo_rows(collection, silo_id, columns)
+        return iter_rows_by_keys(collection, silo_id, columns,
+                                 l_unique_fields, changed_keys)
+
+    # Get the correct set of data from the right table, only reading the
+    # columns that should be in the merged_table
+    upserts = UpsertBuffer(collection, progress=progress)
+    for row in iter_source_rows(r_data_id, merged_cols):
+        merged_row = OrderedDict(row)
 
-            # right_col is used as in index of merged_row because one or more
-            #  left cols map to one col in right table
-            merged_row[right_col] = mapped_value
+        # now set its silo_id to the merged_table id
+        merged_row["silo_id"] = m_data_id
+        merged_row["create_date"] = timezone.now()
 
-        # Get data from left unmapped columns:
-        for col in l_unmapped_cols:
-            if col in row:
-                merged_row[col] = row[col]
+        filter_criteria = {}
+        for uf in r_unique_fields:
+            try:
+                filter_criteria.update({str(uf): merged_row[uf]})
+            except KeyError as e:
+                # when this exception occurs, it means that the col identified
+                # as the unique_col is not present in
+                # all rows of the right_table
+                logger.warning("The field, %s, is not present in table id=%s"
+                               % (uf, rsid))
+
+        # adding the merged_table_id because the filter criteria should
+        # search the merged_table
+        filter_criteria.update({'silo_id': m_data_id})
+
+        # this is an upsert operation, buffered into bulk writes
+        upserts.upsert(filter_criteria, merged_row)
+    upserts.flush()
+    add_silo_rows(msid, upserts.upserted)
+
+    # now loop through left table and apply the mapping, compiled once
+    row_mapping = RowMapping(mappings, l_unmapped_cols)
+    upserts = UpsertBuffer(collection, progress=progress)
+    for row in iter_source_rows(l_data_id, row_mapping.columns):
+        try:
+            merged_row = row_mapping(row)
+        except MappingError as e:
+            msg = e.message
+            logger.error(msg)
+            upserts.flush()
+            add_silo_rows(msid, upserts.upserted)
+            return {'status': "danger",  'message': msg}
 
         filter_criteria = {}
         for uf in l_unique_fields:
             try:
-                filter_criteria.update({str(uf.name): merged_row[uf.name]})
+                filter_criteria.update({str(uf): merged_row[uf]})
             except KeyError:
                 # when this exception occurs, it means that the col identified
                 # as the unique_col is not present in all rows of the left_table
                 msg = "The field, %s, is not present in table id=%s"\
-                      % (uf.name, lsid)
+                      % (uf, lsid)
                 logger.warning(msg)
 
-        filter_criteria.update({'silo_id': msid})
+        filter_criteria.update({'silo_id': m_data_id})
 
         # override the silo_id and create_date columns values to make sure
         # they're not set to the values that are in left table or right table
-        merged_row["silo_id"] = msid
+        merged_row["silo_id"] = m_data_id
         merged_row["create_date"] = timezone.now()
 
         # Now update or insert a row if there is no matching record available
-        db.label_value_store.update_one(filter_criteria,
-                                        {"$set": merged_row}, upsert=True)
+        upserts.upsert(filter_criteria, merged_row)
+    upserts.flush()
+    add_silo_rows(msid, upserts.upserted)
 
+    if marks is not None:
+        marks.clear()
+        marks.update(new_marks)
     return {'status': "success",  'message': "Merged data successfully"}
 
 
 # fix now that not all mongo rows need to have the same column
-def appendTwoSilos(mapping_data, lsid, rsid, msid):
+def appendTwoSilos(mapping_data, lsid, rsid, msid, marks=None, progress=None):
     """
     @params
     mapping_data: data that describes how mapping is done between two silos
     lsid: Left Silo ID
     rsid: Right Silo ID
     msid: Merge Silo ID
+    marks: the high-water marks of the silos at the last append, if rows were
+        only inserted since then they are appended to the merged silo. Replaced
+        by the marks of this append when it succeeds.
+    progress: called with the number of source rows of every batch written
     """
     mappings = json.loads(mapping_data)
 
@@ -328,11 +351,6 @@ def appendTwoSilos(mapping_data, lsid, rsid, msid):
 
     merged_cols = []
 
-    #print("lsid:% rsid:%s msid:%s" % (lsid, rsid, msid))
-    l_silo_data = LabelValueStore.objects(silo_id=lsid)
-
-    r_silo_data = LabelValueStore.objects(silo_id=rsid)
-
     # Loop through the mapped cols and add them to the list of merged_cols
     for k, v in mappings.iteritems():
         col_name = v['right_table_col']
@@ -372,9 +390,48 @@ def appendTwoSilos(mapping_data, lsid, rsid, msid):
         logger.error(msg)
         return {'status': "danger",  'message': msg}
 
-
-    # Delete Any existing data from the merged_table
-    deleted_res = db.label_value_store.delete_many({"silo_id": msid})
+    collection = db.label_value_store
+    lsid = int(lsid)
+    rsid = int(rsid)
+    msid = int(msid)
+    # the rows of the silos are read and written under their data ids
+    l_data_id, r_data_id = lsilo.data_id, rsilo.data_id
+
+    # the marks are taken before reading the rows, the rows inserted during
+    # the append are appended by the next one
+    new_marks = {str(sid): get_watermark(collection, sid)
+                 for sid in (lsid, rsid)}
+    queries = [get_insertions(collection, sid, (marks or {}).get(str(sid)))
+               for sid in (rsid, lsid)]
+    if None in queries:
+        # the merged table is rebuilt under a staging id and keeps its rows
+        # until the new ones are published, dropping what a failed build
+        # left behind
+        target_id = get_staging_id(msilo)
+        collection.delete_many({"silo_id": target_id})
+        queries = [{'silo_id': r_data_id}, {'silo_id': l_data_id}]
+
+        # the rows are appended inside MongoDB if the mapping can be compiled
+        l_fields, l_checks = compile_mapping(mappings, l_unmapped_cols)
+        sources = [(r_data_id, get_copy_fields(merged_cols), [], None),
+                   (l_data_id, l_fields, l_checks, None)]
+        if merge_on_server(collection, target_id, sources, upsert=False,
+                           progress=progress):
+            publish_silo_rows(collection, msilo, target_id)
+            set_silo_rows(msid, collection.count({'silo_id': target_id}))
+            if marks is not None:
+                marks.clear()
+                marks.update(new_marks)
+            return {'status': "success",
+                    'message': "Appended data successfully"}
+        # drop the rows appended before the server failed
+        collection.delete_many({"silo_id": target_id})
+    else:
+        # only rows were inserted in the tables, they are appended
+        target_id = msilo.data_id
+    r_silo_data = collection.find(queries[0])
+    l_silo_data = collection.find(queries[1])
+    inserts = InsertBuffer(collection, progress=progress)
 
     # Get the correct set of data from the right table
     for row in r_silo_data:
@@ -385,64 +442,41 @@ def appendTwoSilos(mapping_data, lsid, rsid, msid):
             merged_row[k] = row[k]
 
         # now set its silo_id to the merged_table id
-        merged_row["silo_id"] = msid
+        merged_row["silo_id"] = target_id
         merged_row["create_date"] = timezone.now()
-        db.label_value_store.insert_one(merged_row)
+        inserts.insert(merged_row)
 
-
-    # now loop through left table and apply the mapping
+    # now loop through left table and apply the mapping, compiled once
+    row_mapping = RowMapping(mappings, l_unmapped_cols)
     for row in l_silo_data:
-        merged_row = OrderedDict()
-        # Loop through the column mappings for each row in left_table.
-        for k, v in mappings.iteritems():
-            merge_type = v['merge_type']
-            left_cols = v['left_table_cols']
-            right_col = v['right_table_col']
-
-            # if merge_type is specified then there must be multiple columns in the left_cols array
-            if merge_type:
-                mapped_value = ''
-                for col in left_cols:
-                    if merge_type == 'Sum' or merge_type == 'Avg':
-                        try:
-                            if mapped_value == '':
-                                mapped_value = float(row[col])
-                            else:
-                                mapped_value = float(mapped_value) + float(row[col])
-                        except Exception as e:
-                            msg = 'Failed to apply %s to column, %s : %s ' % (merge_type, col, e.message)
-                            logger.error(msg)
-                            return {'status': "danger",  'message': msg}
-                    else:
-                        mapped_value += ' ' + smart_str(row[col])
-
-                # Now calculate avg if the merge_type was actually "Avg"
-                if merge_type == 'Avg':
-                    mapped_value = mapped_value / len(left_cols)
-            # only one col in left table is mapped to one col in the right table.
+        try:
+            merged_row = row_mapping(row)
+        except MappingError as e:
+            msg = e.message
+            logger.error(msg)
+            if target_id == msilo.data_id:
+                inserts.flush()
+                add_silo_rows(msid, inserts.inserted)
             else:
-                col = str(left_cols[0])
-                if col == "silo_id": continue
-                try:
-                    mapped_value = row[col]
-                except KeyError as e:
-                    # When updating data in merged_table at a later time, it is possible
-                    # the origianl source tables may have had some columns removed in which
-                    # we might get a KeyError so in that case we just skip it.
-                    continue
-
-            #right_col is used as in index of merged_row because one or more left cols map to one col in right table
-            merged_row[right_col] = mapped_value
-
-        # Get data from left unmapped columns:
-        for col in l_unmapped_cols:
-            if col in row:
-                merged_row[col] = row[col]
+                # the merged table keeps its rows
+                collection.delete_many({"silo_id": target_id})
+            return {'status': "danger",  'message': msg}
 
-        merged_row["silo_id"] = msid
+        merged_row["silo_id"] = target_id
         merged_row["create_date"] = timezone.now()
 
-        db.label_value_store.insert_one(merged_row)
+        inserts.insert(merged_row)
+    inserts.flush()
+
+    if target_id == msilo.data_id:
+        add_silo_rows(msid, inserts.inserted)
+    else:
+        publish_silo_rows(collection, msilo, target_id)
+        # the merged table only holds the rows inserted above
+        set_silo_rows(msid, inserts.inserted)
+    if marks is not None:
+        marks.clear()
+        marks.update(new_marks)
     return {'status': "success",  'message': "Appended data successfully"}
 
 
@@ -676,7 +710,7 @@ def deleteSilo(request, id):
                                             deleted_time=timezone.now(),\
                                             silo_name_id=silo_name+" with id "+id,\
                                             silo_description=silo_to_be_deleted.description)
-            lvs = LabelValueStore.objects(silo_id=silo_to_be_deleted.id)
+            lvs = LabelValueStore.objects(silo_id=silo_to_be_deleted.data_id)
             num_rows_deleted = lvs.delete()
 
             #look through each of the reads and delete them if this was their only silo
@@ -705,7 +739,7 @@ def showRead(request, id):
     """
     excluded_fields = ['gsheet_id', 'resource_id', 'token', 'create_date',
                        'edit_date', 'token', 'autopush_expiration',
-                       'autopull_expiration']
+                       'autopull_expiration', 'json_path']
     initial = {'owner': request.user}
     data = None
     onedrive_redirect_uri = settings.ONEDRIVE_REDIRECT_URI
@@ -738,6 +772,7 @@ def showRead(request, id):
                                              'onedrive_access_token',
                                              'onedrive_file']
     elif read_type == "JSON":
+        excluded_fields.remove('json_path')
         excluded_fields = excluded_fields + ['file_data',
                                              'onedrive_access_token',
                                              'onedrive_file',
@@ -1008,15 +1043,10 @@ def addUniqueFiledsToSilo(request):
                 unique_field = UniqueFields(name=col, silo=silo)
                 unique_field.save()
 
-                # The partialFilterExpression flag is not available until MongoDB 3.2.
-                # The exception should probably eventually be made more specific (i.e. for maxed out indexes)
-                # try:
-                #     db.label_value_store.create_index(col, partialFilterExpression = {'silo_id' : silo.id})
-                # except Exception as e:
-                #     logger.warning("Failed to create a unique column index: %s" % (e))
-
             if not unique_cols:
                 silo.unique_fields.all().delete()
+            # create the index of the new unique fields, drop the old one
+            sync_silo_indexes(silo)
             return HttpResponse("Unique Fields saved")
     return HttpResponse("Only POST requests are processed.")
 
@@ -1029,17 +1059,145 @@ def updateEntireColumn(request):
     new_val = request.POST.get("new_val", None)
     if silo_id and colname and new_val:
         db.label_value_store.update_many(
-                {"silo_id": silo_id},
+                {"silo_id": get_data_silo_id(silo_id)},
                     {
                     "$set": {colname: new_val},
                     },
                 False
             )
+        bump_silo_version(silo_id)
         messages.success(request, "Successfully, changed the %s column value to %s" % (colname, new_val))
 
     return HttpResponseRedirect(reverse_lazy('silo_detail', kwargs={'silo_id': silo_id}))
 
 
+def getSiloImportTasks(silo_id):
+    """
+    Returns the import tasks of the reads of a silo with their progress
+    """
+    silo_read_ids = Read.objects.filter(silos=silo_id).values_list('id',
+                                                                   flat=True)
+
+    celery_tasks = CeleryTask.objects.filter(
+        object_id__in=silo_read_ids,
+        content_type=ContentType.objects.get_for_model(Read)
+    ).values_list('object_id', 'task_id', 'task_status', 'rows_processed',
+                  'bytes_processed', 'bytes_total', 'rows_per_second')
+
+    tasks = []
+    for t in celery_tasks:
+        percent = None
+        if t[5]:
+            percent = min(100, int(100 * t[4] / t[5]))
+        tasks.append({'read_id': t[0], 'task_id': t[1], 'task_status': t[2],
+                      'rows_processed': t[3], 'bytes_processed': t[4],
+                      'bytes_total': t[5], 'rows_per_second': t[6],
+                      'percent': percent})
+    return tasks
+
+
+def checkSiloRefresh(request, silo_id):
+    """
+    Checks the update of a silo started by updateSiloData in this session.
+    The messages of its tasks are added to the request as they are done,
+    the tasks they report as still writing are checked next.
+
+    returns True while the update is running
+    """
+    refreshes = request.session.get('silo_refresh_tasks', {})
+    task_ids = refreshes.get(str(silo_id))
+    if not task_ids:
+        return False
+
+    running = []
+    for task_id in task_ids:
+        result = AsyncResult(task_id)
+        if not result.ready():
+            running.append(task_id)
+        elif result.successful():
+            for msg in result.result.get('messages', []):
+                messages.add_message(request, msg[0], msg[1])
+            running.extend(result.result.get('task_ids', []))
+        else:
+            messages.error(request, "The update of the table did not "
+                                    "finish: %s" % result.result)
+    if running:
+        refreshes[str(silo_id)] = running
+    else:
+        del refreshes[str(silo_id)]
+    request.session['silo_refresh_tasks'] = refreshes
+    return bool(running)
+
+
+def checkSiloMerge(request, silo_id):
+    """
+    Checks the merge of a silo started by updateSiloData in this session.
+    Once it is done its message is added to the request.
+
+    returns the task id of the merge while it is running
+    """
+    merges = request.session.get('silo_merge_tasks', {})
+    task_id = merges.get(str(silo_id))
+    if not task_id:
+        return None
+    task = CeleryTask.objects.filter(task_id=task_id).first()
+    if task and task.task_status not in (CeleryTask.TASK_FINISHED,
+                                         CeleryTask.TASK_FAILED):
+        return task_id
+
+    if task:
+        res = json.loads(task.result)
+        if res['status'] == "success":
+            messages.success(request, res['message'])
+        else:
+            messages.error(request, res['message'])
+    del merges[str(silo_id)]
+    request.session['silo_merge_tasks'] = merges
+    return None
+
+
+def can_view_silo(user, silo):
+    """
+    Whether the user may see the data of the silo: its owner, the users it
+    is shared with directly, through a workflowlevel1 or their organization,
+    and anyone if it is public
+    """
+    if silo.owner == user or silo.public:
+        return True
+    user_wfl1s = get_workflowlevel1s(user)
+    if Silo.objects.filter(
+            Q(pk=silo.pk, shared__id=user.pk) |
+            Q(pk=silo.pk, workflowlevel1__level1_uuid__in=user_wfl1s)
+    ).exists():
+        return True
+    request_user_org = None
+    owner_user_org = None
+    if hasattr(user, 'tola_user') and hasattr(silo.owner, 'tola_user'):
+        request_user_org = user.tola_user.organization
+        owner_user_org = silo.owner.tola_user.organization
+    return silo.share_with_organization and request_user_org == owner_user_org
+
+
+@login_required
+def silo_import_progress(request, silo_id):
+    """
+    Progress of the running imports of a silo, polled by silo_detail
+    """
+    try:
+        silo = Silo.objects.get(pk=silo_id)
+    except Silo.DoesNotExist:
+        raise Http404("Table with id=%s does not exist." % silo_id)
+    if not can_view_silo(request.user, silo):
+        return HttpResponseForbidden()
+
+    tasks = getSiloImportTasks(silo_id)
+    tasks_running = len([t for t in tasks if t['task_status'] in (
+        CeleryTask.TASK_CREATED, CeleryTask.TASK_IN_PROGRESS)])
+    refresh_running = checkSiloRefresh(request, silo_id)
+    return JsonResponse({'tasks': tasks, 'tasks_running': tasks_running,
+                         'refresh_running': refresh_running})
+
+
 @login_required
 def silo_detail(request, silo_id):
     """
@@ -1047,7 +1205,6 @@ def silo_detail(request, silo_id):
     """
 
     silo = Silo.objects.get(pk=silo_id)
-    user_wfl1s = get_workflowlevel1s(request.user)
     cols = []
     query = makeQueryForHiddenRow(json.loads(silo.rows_to_hide))
 
@@ -1066,33 +1223,11 @@ def silo_detail(request, silo_id):
         silos=silo.id,
         tasks__task_status=CeleryTask.TASK_FAILED).count()
 
-    silo_read_ids = Read.objects.filter(silos=silo.id).values_list('id',
-                                                                   flat=True)
-
-    celery_tasks = CeleryTask.objects.filter(
-        object_id__in=silo_read_ids,
-        content_type=ContentType.objects.get_for_model(Read)
-    ).values_list('object_id', 'task_id', 'task_status')
-
-    tasks = map(
-        lambda t: {'read_id': t[0], 'task_id': t[1], 'task_status': t[2]},
-        celery_tasks
-    )
+    tasks = getSiloImportTasks(silo.id)
+    refresh_running = checkSiloRefresh(request, silo.id)
+    merge_task_id = checkSiloMerge(request, silo.id)
 
-    request_user_org = None
-    owner_user_org = None
-    if hasattr(request.user, 'tola_user') and hasattr(silo.owner, 'tola_user'):
-        request_user_org = request.user.tola_user.organization
-        owner_user_org = silo.owner.tola_user.organization
-
-    is_silo_shared_with_user = Silo.objects.filter(
-        Q(pk=silo_id, shared__id=request.user.pk) |
-        Q(pk=silo_id, workflowlevel1__level1_uuid__in=user_wfl1s)).exists()
-
-    if (silo.owner == request.user or silo.public
-            or is_silo_shared_with_user
-            or (silo.share_with_organization
-                and request_user_org == owner_user_org)):
+    if can_view_silo(request.user, silo):
         cols.append('_id')
         cols.append('id')
         cols.extend(getSiloColumnNames(silo_id))
@@ -1108,7 +1243,9 @@ def silo_detail(request, silo_id):
             "query": query,
             "tasks_running": tasks_running,
             "tasks_failed": tasks_failed,
-            "tasks": tasks
+            "tasks": tasks,
+            "refresh_running": refresh_running,
+            "merge_task_id": merge_task_id
         }
     )
 
@@ -1117,7 +1254,6 @@ def silo_detail(request, silo_id):
 def updateSiloData(request, pk):
     silo = None
     merged_silo_mapping = None
-    unique_field_exist = False
     try:
         silo = Silo.objects.get(pk=pk)
     except Silo.DoesNotExist as e:
@@ -1126,171 +1262,47 @@ def updateSiloData(request, pk):
     if silo:
         try:
             merged_silo_mapping = MergedSilosFieldMapping.objects.get(merged_silo = silo.pk)
-            #if the data table is merged then updating means trying to remerge to get updated data
-            left_table_id = merged_silo_mapping.from_silo.pk
-            right_table_id = merged_silo_mapping.to_silo.pk
-            merge_table_id = merged_silo_mapping.merged_silo.pk
-            mapping = merged_silo_mapping.mapping
-            mergeType = merged_silo_mapping.merge_type
-
-            if mergeType == "merge":
-                res = merge_two_silos(mapping, left_table_id, right_table_id, merge_table_id)
-            else:
-                res = appendTwoSilos(mapping, left_table_id, right_table_id, merge_table_id)
-            if res['status'] == "success":
-                messages.success(request, res['message'])
-            else:
-                messages.error(request, res['message'])
+            #if the data table is merged then updating means trying to remerge to get updated data.
+            #the merge runs in a task, whose progress silo_detail polls
+            task = start_merge(merged_silo_mapping, request.user,
+                               refresh=True)
+            merges = request.session.get('silo_merge_tasks', {})
+            merges[str(silo.pk)] = task.task_id
+            request.session['silo_merge_tasks'] = merges
+            messages.info(request, "The table is being merged again.")
         except MergedSilosFieldMapping.DoesNotExist as e:
-            #get a list of reads from the silo
-            reads = silo.reads.all()
-            data = [[],[]]
-            msgs = []
-            sources_to_delete = []
-
-            #Get data from each of the reads and store it as the appropriate array
-            for read in reads:
-                import_response = importDataFromRead(request,silo,read)
-                if import_response[2]:
-                    msgs.append(import_response[2])
-                if import_response[1] == 1:
-                    data[1].append(import_response[0])
-                    data[0].append(read)
-                    sources_to_delete.append(read.id)
-
-
-            #from ones where we got data delete those records
-            unique_field_exist = silo.unique_fields.exists()
-            #Unique field means keep the data and update as necessary (which is already implimented so its not necessary to delete anything)
-            if  unique_field_exist == False:
-                lvs = LabelValueStore.objects(silo_id=silo.pk,__raw__={"read_id" : { "$exists" : "true", "$in" : sources_to_delete }})
-                lvs.delete()
-
-            #put in the new records
-            for x in range(0,len(data[0])):
-                for entry in data[1][x]:
-                    save_data_to_silo(silo,entry,data[0][x],request.user)
-            for read in reads:
-                if read.type.read_type == "GSheet Import":
-                    greturn = import_from_gsheet_helper(request.user, silo.id, None, read.resource_id, None, True)
-                    if type(greturn) == tuple:
-                        greturn[1][:] = [d for d in greturn[1] if d.get('silo_id') == None]
-                        for ret in greturn[1]:
-                            msgs.append((ret.get('level'),ret.get('msg')))
-                        #delete data associated with old read if there's no unique column
-                        if unique_field_exist == False:
-                            lvss_to_delete = LabelValueStore.objects(silo_id=silo.pk,__raw__={"read_id" : { "$exists" : "true", "$in" : [read.id] }})
-                            lvss_to_delete.delete()
-                        #read the data
-                        for lvs in greturn[0]:
-                            lvs.save()
-                    else:
-                        greturn[:] = [d for d in greturn if d.get('silo_id') == None]
-                        for ret in greturn:
-                            if ret.get('level') == messages.SUCCESS:
-                                msgs.append((ret.get('level'),"Google spreadsheet has been successfully updated"))
-                            else:
-                                msgs.append((ret.get('level'),ret.get('msg')))
-            for msg in msgs:
-                messages.add_message(request, msg[0], msg[1])
-
-            #delete legacy objects
-            lvss = LabelValueStore.objects(silo_id=silo.pk,__raw__={ "$or" : [{"read_id" : {"$not" : { "$exists" : "true" }}}, {"read_id" : {"$in" : [-1,""]} } ]})
+            #every read that fetches remote data is refreshed in its own task
+            refresh_tasks = []
+            ctype = ContentType.objects.get_for_model(Read)
+            for read in silo.reads.all():
+                if not read_needs_refresh(read):
+                    import_response = importDataFromRead(silo, read,
+                                                         request.user)
+                    if import_response[2]:
+                        messages.add_message(request, *import_response[2])
+                    continue
+                signature = refresh_read.si(silo.pk, read.pk, request.user.pk)
+                CeleryTask.objects.update_or_create(
+                    content_type=ctype, object_id=read.pk,
+                    defaults={'task_id': signature.freeze().id,
+                              'task_status': CeleryTask.TASK_CREATED,
+                              'rows_processed': 0, 'bytes_processed': 0,
+                              'bytes_total': None, 'rows_per_second': None})
+                refresh_tasks.append(signature)
+
+            if refresh_tasks:
+                #the callback adds the columns and collects the messages
+                async_res = chord(refresh_tasks)(
+                    refresh_silo_done.s(silo.pk))
+                refreshes = request.session.get('silo_refresh_tasks', {})
+                refreshes[str(silo.pk)] = [async_res.id]
+                request.session['silo_refresh_tasks'] = refreshes
+                messages.info(request, "The table is being updated from its "
+                                       "sources.")
 
     return HttpResponseRedirect(reverse_lazy('silo_detail', kwargs={'silo_id': pk},))
 
 
-#return tuple: (list of list of dictionaries[[{}]] data, 0=falure 1=success 2=N/A, messages)
-def importDataFromRead(request, silo, read):
-    if read.type.read_type == "ONA":
-        ona_token = ThirdPartyTokens.objects.get(user=silo.owner.pk, name="ONA")
-        response = requests.get(read.read_url, headers={'Authorization': 'Token %s' % ona_token.token})
-        data = json.loads(response.content)
-        return ([data], 1, (messages.SUCCESS, "ONA has been successfully updated"))
-    elif read.type.read_type == "CSV":
-        return (None,2,(messages.INFO, "When updating data in a table, its CSV source is ignored."))
-    elif read.type.read_type == "JSON":
-        if read.read_url != "":
-            data = importJSON(read, request.user, None, None, silo.pk, None, True)
-            #messages.add_message(request, result[0], result[1])
-            if data:
-                return ([data],1,(messages.SUCCESS, "Your JSON feed has been successfully updated"))
-            return (None,0,(messages.ERROR, "Their was an error with updating yoru JSON feed data"))
-        else:
-            return (None,2,(messages.INFO, "When updating data in a table, its JSON file data is ignored."))
-    elif read.type.read_type == "GSheet Import":
-        #as the google sheet import already performs the update functionality so when its time to input the data again google spreadsheet update will be called
-        return (None,2,None)
-    elif read.type.read_type == "Google Spreadsheet":
-        #as the google sheet import already performs the update functionality so when its time to input the data again google spreadsheet update will be called
-        return (None,2,None)
-    elif read.type.read_type == "CommCare":
-        commcare_token = None
-        try:
-            commcare_token = ThirdPartyTokens.objects.get(user=silo.owner.pk, name="CommCare")
-        except Exception as e:
-            return (None,0,(messages.ERROR, "You need to login to commcare using an API Key to access this functionality"))
-        last_data_retrieved = str(getNewestDataDate(silo.id))[:10]
-        url = "/".join(read.read_url.split("/")[:8]) + "?date_modified_start=" + last_data_retrieved + "&" + "limit="
-        response = requests.get(url+ str(1), headers={'Authorization': 'ApiKey %(u)s:%(a)s' % {'u' : commcare_token.username, 'a' : commcare_token.token}})
-        if response.status_code == 401:
-            commcare_token.delete()
-            return (None,0,(messages.ERROR, "Your Commcare usernmane or API Key is incorrect"))
-        elif response.status_code != 200:
-            return (None,0,(messages.ERROR, "An error importing from commcare has occured: %s %s " % (response.status_code, response.text)))
-        metadata = json.loads(response.content)
-        if metadata['meta']['total_count'] == 0:
-            return (None, 2, (messages.SUCCESS, "Your commcare data was already up to date"))
-        #Now call the update data function in commcare tasks
-        auth = {'Authorization': 'ApiKey %(u)s:%(a)s' % {'u' : commcare_token.username, 'a' : commcare_token.token}}
-        url += "50"
-        data_raw = fetchCommCareData(url, auth, True, 0, metadata['meta']['total_count'], 50, silo.id, read.id, True)
-        data_collects = data_raw.apply_async()
-        data_retrieval = [v.get() for v in data_collects]
-        columns = set()
-        for data in data_retrieval:
-            columns = columns.union(data)
-        #correct the columns
-        try: columns.remove("")
-        except KeyError as e: pass
-        try: columns.remove("silo_id")
-        except KeyError as e: pass
-        try: columns.remove("read_id")
-        except KeyError as e: pass
-        for column in columns:
-            if "." in column:
-                columns.remove(column)
-                columns.add(column.replace(".", "_"))
-            if "$" in column:
-                columns.remove(column)
-                columns.add(column.replace("$", "USD"))
-        try:
-            columns.remove("id")
-            columns.add("user_assigned_id")
-        except KeyError as e: pass
-        try:
-            columns.remove("_id")
-            columns.add("user_assigned_id")
-        except KeyError as e: pass
-        try:
-            columns.remove("edit_date")
-            columns.add("editted_date")
-        except KeyError as e: pass
-        try:
-            columns.remove("create_date")
-            columns.add("created_date")
-        except KeyError as e: pass
-        #now mass update all the data in the database
-
-        columns = list(columns)
-        addColsToSilo(silo, columns)
-        hideSiloColumns(silo, columns)
-
-        return (None,2,(messages.SUCCESS, "%i commcare records were successfully updated" % metadata['meta']['total_count']))
-    else:
-        return (None,0,(messages.ERROR,"%s does not support update data functionality. You will have to reinport the data manually" % read.type.read_type))
-
-
 #Add a new column on to a silo
 @login_required
 def newColumn(request,id):
@@ -1308,12 +1320,13 @@ def newColumn(request,id):
             #insert a new column into the existing silo
             addColsToSilo(silo, [label])
             db.label_value_store.update_many(
-                {"silo_id": silo.id},
+                {"silo_id": silo.data_id},
                     {
                     "$set": {label: value},
                     },
                 False
             )
+            bump_silo_version(silo.id)
             messages.info(request, 'Your column has been added', fail_silently=False)
         else:
             messages.error(request, 'There was a problem adding your column', fail_silently=False)
@@ -1345,32 +1358,28 @@ def edit_columns(request, id):
                     # update a column in the existing silo
                     db.label_value_store.update_many(
                         {
-                            "silo_id": silo.id
+                            "silo_id": silo.data_id
                         },
                         {
                             "$rename": {label: value}
                         },
                         False
                     )
-                    column_obj = json.loads(silo.columns)
-                    for column in column_obj:
-                        if column['name'] == label:
-                            column['name'] = value
-                            break
-                    silo.columns = json.dumps(column_obj)
-                    silo.save()
+                    bump_silo_version(silo.id)
+                    renameSiloColumn(silo, label, value)
                 # if we see delete then it's a check box to delete that column
                 elif label.endswith('_delete') and value == 1:
                     column = label.replace("_delete", "")
                     db.label_value_store.update_many(
                         {
-                            "silo_id": silo.id
+                            "silo_id": silo.data_id
                         },
                         {
                             "$unset": {column: value},
                         },
                         False
                     )
+                    bump_silo_version(silo.id)
                     try:
                         silo.formulacolumns.filter(column).delete()
                     except Exception as e:
@@ -1386,6 +1395,8 @@ def edit_columns(request, id):
             messages.error(request,
                            'ERROR: There was a problem with your request',
                            fail_silently=False)
+            for error in form.non_field_errors():
+                messages.error(request, error, fail_silently=False)
 
     data = getSiloColumnNames(id)
     form = EditColumnForm(initial={'silo_id': silo.id}, extra=data)
@@ -1405,12 +1416,13 @@ def deleteColumn(request,id,column):
 
     #delete a column from the existing table silo
     db.label_value_store.update_many(
-        {"silo_id": silo.id},
+        {"silo_id": silo.data_id},
             {
             "$unset": {column: ""},
             },
         False
     )
+    bump_silo_version(silo.id)
 
     messages.info(request, "Column has been deleted")
     return HttpResponseRedirect(request.META['HTTP_REFERER'])
@@ -1440,6 +1452,24 @@ def mergeColumns(request):
     return render(request, "display/merge-column-form.html", {'getSourceFrom':getSourceFrom, 'getSourceTo':getSourceTo, 'from_silo_id':from_silo_id, 'to_silo_id':to_silo_id})
 
 
+def start_merge(mapping, user, refresh=False):
+    """
+    Starts the merge of the silos of a mapping in a merge_silos task. The
+    task is kept on the user, as the merged silo is deleted if a new merge
+    fails.
+
+    returns the CeleryTask of the merge
+    """
+    task = CeleryTask.objects.create(task_status=CeleryTask.TASK_CREATED,
+                                     content_object=user)
+    signature = merge_silos.si(mapping.pk, task.pk, refresh=refresh).on_error(
+        merge_silos_failed.s(task.pk))
+    task.task_id = signature.freeze().id
+    task.save(update_fields=['task_id'])
+    signature.apply_async()
+    return task
+
+
 def do_merge(request):
     # get the table_ids.
     left_table_id = request.POST['left_table_id']
@@ -1480,25 +1510,54 @@ def do_merge(request):
     new_silo.reads.add(*right_table_reads)
     merge_table_id = new_silo.pk
 
-    if merge_type == 'merge':
-        res = merge_two_silos(data, left_table_id,
-                            right_table_id, merge_table_id)
-    else:
-        res = appendTwoSilos(
-            data, left_table_id, right_table_id, merge_table_id
-        )
-
-    if res['status'] == 'danger':
-        new_silo.delete()
-        return JsonResponse(res)
-
     mapping = MergedSilosFieldMapping(
         from_silo=left_table, to_silo=right_table,
         merged_silo=new_silo, mapping=data, merge_type=merge_type)
     mapping.save()
-    res.update({'silo_url': reverse_lazy(
-        'silo_detail', kwargs={'silo_id': merge_table_id})})
-    return JsonResponse(res)
+
+    # the merge runs in a task, whose progress the merge form polls
+    task = start_merge(mapping, request.user)
+
+    return JsonResponse({
+        'status': 'success',
+        'message': 'The tables are being merged',
+        'silo_url': reverse_lazy(
+            'silo_detail', kwargs={'silo_id': merge_table_id}),
+        'progress_url': reverse_lazy(
+            'silo_merge_progress', kwargs={'task_id': task.task_id}),
+    })
+
+
+@login_required
+def silo_merge_progress(request, task_id):
+    """
+    Progress of a merge started by do_merge, polled by the merge form until
+    it is done, then the result of the merge. Only the user who started the
+    merge can see it.
+    """
+    try:
+        task = CeleryTask.objects.get(
+            task_id=task_id,
+            content_type=ContentType.objects.get_for_model(User),
+            object_id=request.user.pk)
+    except CeleryTask.DoesNotExist:
+        raise Http404("Merge with id=%s does not exist." % task_id)
+
+    if task.task_status in (CeleryTask.TASK_FINISHED,
+                            CeleryTask.TASK_FAILED):
+        res = json.loads(task.result)
+        res['done'] = True
+        return JsonResponse(res)
+
+    percent = None
+    if task.rows_total:
+        percent = min(100, int(100 * task.rows_processed / task.rows_total))
+    return JsonResponse({
+        'done': False,
+        'rows_processed': task.rows_processed,
+        'rows_total': task.rows_total,
+        'percent': percent,
+    })
 
 
 # EDIT A SINGLE VALUE STORE
@@ -1511,7 +1570,7 @@ def valueEdit(request,id):
     data = {}
     jsondoc = json.loads(doc)
     silo_id = None
-    silo = Silo.objects.get(pk=jsondoc[0].get('silo_id'))
+    silo = Silo.objects.get(pk=get_row_silo_id(jsondoc[0].get('silo_id')))
     cols = json.loads(silo.columns)
 
     for item in jsondoc:
@@ -1521,7 +1580,7 @@ def valueEdit(request,id):
                 #data[k] = item['_id']['$oid']
                 pass
             elif k == "silo_id":
-                silo_id = v
+                silo_id = get_row_silo_id(v)
             elif k == "edit_date":
                 if item['edit_date']:
                     edit_date = datetime.datetime.fromtimestamp(item['edit_date']['$date']/1000)
@@ -1574,12 +1633,11 @@ def valueDelete(request,id):
     """
     Delete a value
     """
-    silo_id = None
     lvs = LabelValueStore.objects(id=id)[0]
-    owner = Silo.objects.get(id = lvs.silo_id).owner
+    silo_id = get_row_silo_id(lvs.silo_id)
+    owner = Silo.objects.get(id = silo_id).owner
 
     if str(owner.username) == str(request.user):
-        silo_id = lvs.silo_id
         lvs.delete()
     else:
         messages.error(request, "You don't have the permission to delete records from this silo")
@@ -1592,58 +1650,35 @@ def valueDelete(request,id):
 def export_silo(request, id):
     silo_name = Silo.objects.get(id=id).name
 
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="%s.csv"' % silo_name
-    writer = csv.writer(response)
-
     # get the query and the columns to export
     query = json.loads(request.GET.get('query', "{}"))
     cols = json.loads(request.GET.get('shown_cols', json.dumps(
         getSiloColumnNames(id))))
+    sort = str(request.GET.get('sort', ''))
 
-    # Loads the data from mongo
-    data = LabelValueStore.objects(silo_id=int(id), **query).exclude(
-        'create_date', 'edit_date', 'silo_id', 'read_id')
+    cache_key = None
+    body = None
+    if query_cache.is_enabled():
+        cache_key = query_cache.get_cache_key(id, 'csv', query, cols, sort)
+        body = query_cache.get_cached(cache_key)
 
-    # Sort the data and convert it into JSON
-    sort = str(request.GET.get('sort', ''))
-    data = data.order_by(sort)
-    silo_data = json.loads(data.to_json())
-
-    data = []
-    num_cols = len(cols)
-    if silo_data:
-        num_rows = len(silo_data)
-
-        # Convert OrderedDict to Python list so that it can be written to CSV writer.
-        writer.writerow(cols)
-
-        # Populate a 2x2 list structure that corresponds to the number of rows and cols in silo_data
-        for i in xrange(num_rows):
-            data += [[0]*num_cols]
-
-        for r, row in enumerate(silo_data):
-            for col in cols:
-                # Map values to column names and place them in the correct position in the data array
-                val = row.get(col, '')
-                if isinstance(val, dict):
-                    try:
-                        val = smart_text(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(val['$date']/1000)))
-                    except KeyError as e:
-                        try:
-                            val = smart_text(val['$oid'])
-                        except KeyError as e:
-                            val = val.popitem()
-
-                val = smart_text(val).decode("latin-1").encode("utf8")
-                data[r][cols.index(col)] = val
-            writer.writerow(data[r])
+    if body is not None:
+        chunks = [body]
+    else:
+        # the rows are streamed from mongo straight to the response
+        rows = get_export_cursor(id, query, cols, sort)
+        chunks = iter_csv(rows, cols)
+        if cache_key is not None:
+            chunks = query_cache.cache_chunks(cache_key, chunks)
+    response = StreamingHttpResponse(chunks, content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="%s.csv"' % silo_name
     return response
 
 
 @login_required
 def anonymizeTable(request, id):
-    lvs = db.label_value_store.find({"silo_id": int(id)})
+    data_id = get_data_silo_id(id)
+    lvs = db.label_value_store.find({"silo_id": data_id})
     piif_cols = PIIColumn.objects.values_list("fieldname",flat=True).order_by('fieldname')
     fields_to_remove = {}
     for row in lvs:
@@ -1653,7 +1688,8 @@ def anonymizeTable(request, id):
                 fields_to_remove[str(k)] = ""
 
     if fields_to_remove:
-        res = db.label_value_store.update_many({"silo_id": int(id)}, { "$unset": fields_to_remove})
+        res = db.label_value_store.update_many({"silo_id": data_id}, { "$unset": fields_to_remove})
+        bump_silo_version(int(id))
         messages.success(request, "Table has been annonymized! But do review it again.")
     else:
         messages.info(request, "No PIIF columns were found.")
@@ -1668,7 +1704,7 @@ def identifyPII(request, silo_id):
     """
     if request.method == 'GET':
         columns = []
-        lvs = db.label_value_store.find({"silo_id": int(silo_id)})
+        lvs = db.label_value_store.find({"silo_id": get_data_silo_id(silo_id)})
         for d in lvs:
             columns.extend([k for k in d.keys() if k not in columns])
         return render(request, 'display/annonymize_columns.html', {"silo_id": silo_id, "columns": columns})
@@ -1718,8 +1754,7 @@ def newFormulaColumn(request, pk):
             column_name = operation
 
         #now add the resutls to the mongodb database
-        lvs = LabelValueStore.objects(silo_id=silo.pk)
-        calc_result = calculateFormulaColumn(lvs,operation,cols,column_name)
+        calc_result = calculateFormulaColumn(silo.pk,operation,cols,column_name)
         messages.add_message(request,calc_result[0],calc_result[1])
 
         if calc_result[0] == messages.ERROR:
@@ -1745,18 +1780,8 @@ def newFormulaColumn(request, pk):
 def editColumnOrder(request, pk):
     if request.method == 'POST':
         try:
-            #this is not done using utility functions since it is a complete replacement
             silo = Silo.objects.get(pk=pk)
-            cols = []
-            cols_list = request.POST.getlist("columns")
-            col_types = getColToTypeDict(silo)
-            for col in cols_list:
-                cols.append({'name' : col, 'type': col_types.get(col,'string')})
-            visible_cols_set = set(cols_list)
-
-            cols.extend([x for x in json.loads(silo.columns) if (x if isinstance(x, basestring) else x['name']) not in visible_cols_set])
-            silo.columns = json.dumps(cols)
-            silo.save()
+            reorderSiloColumns(silo, request.POST.getlist("columns"))
 
         except Silo.DoesNotExist as e:
             messages.error(request, "silo not found")
@@ -0,0 +1,171 @@
+"""
+Incremental parsing and writing of JSON feeds and files.
+
+Only the element being decoded is held in memory, so a feed of any size can
+be imported while the rows are written to the silo chunk by chunk. The other
+way around, rows read from a cursor are encoded a few at a time so that a
+response can be streamed without holding the whole table in memory.
+"""
+import codecs
+import json
+
+WHITESPACE = u' \t\n\r'
+
+
+class JSONStreamError(ValueError):
+    pass
+
+
+class JSONStreamReader(object):
+    """
+    Reads JSON values one by one from a file-like object
+    """
+
+    def __init__(self, f, buffer_size=65536):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        """
+        Reads more data into the buffer, returns False at the end of the file
+        """
+        if self.eof:
+            return False
+        # drop what was already consumed so the buffer stays small
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        data = self.f.read(size or self.buffer_size)
+        if not data:
+            self.eof = True
+            self.buf += self.text_decoder.decode(b'', final=True)
+            return False
+        if isinstance(data, unicode):
+            self.buf += data
+        else:
+            self.buf += self.text_decoder.decode(data)
+        return True
+
+    def _peek(self):
+        """
+        Skips the whitespaces and returns the next character, '' at the end
+        """
+        while True:
+            while self.pos < len(self.buf) and \
+                    self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return u''
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise JSONStreamError("Expected %s at position %s, got %r"
+                                  % (" or ".join(chars), self.pos, char))
+        self.pos += 1
+        return char
+
+    def decode_value(self):
+        """
+        Decodes the next complete JSON value
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError as e:
+                # the value is probably cut off by the end of the buffer;
+                # read at least as much again to keep the retries linear
+                if not self._fill(max(self.buffer_size,
+                                      len(self.buf) - self.pos)):
+                    raise JSONStreamError(e)
+                continue
+            # a number at the end of the buffer may continue in the next read
+            if end == len(self.buf) and not self.eof:
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+    def enter_key(self, key):
+        """
+        Moves the reader to the value of `key` in the object that follows
+        """
+        self._expect(u'{')
+        if self._peek() == u'}':
+            raise JSONStreamError("Key %r not found" % key)
+        while True:
+            name = self.decode_value()
+            self._expect(u':')
+            if name == key:
+                return
+            # skip the value of any other key
+            self.decode_value()
+            if self._expect(u',}') == u'}':
+                raise JSONStreamError("Key %r not found" % key)
+
+    def iter_values(self):
+        """
+        Yields the elements of the array that follows, one at a time. Any
+        other value is yielded as a single element.
+        """
+        char = self._peek()
+        if char != u'[':
+            if char:
+                yield self.decode_value()
+            return
+        self.pos += 1
+        if self._peek() == u']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode_value()
+            if self._expect(u',]') == u']':
+                return
+
+
+def iter_json_records(f, path=None, buffer_size=65536):
+    """
+    Yields the records of a JSON document one at a time
+
+    f -- a file-like object with the JSON document
+    path -- dot separated keys leading to the array of records for documents
+            that wrap it, e.g. "data.results". The document itself is the
+            array if no path is given.
+    buffer_size -- number of bytes read from f at a time
+    """
+    reader = JSONStreamReader(f, buffer_size)
+    if path:
+        for key in path.split('.'):
+            if key:
+                reader.enter_key(key)
+    for record in reader.iter_values():
+        yield record
+
+
+def iter_json_array(rows, encoder, batch_size=100):
+    """
+    Yields the JSON array of the rows in pieces of batch_size rows
+
+    rows -- any iterable, e.g. a pymongo cursor
+    encoder -- the json.JSONEncoder instance encoding every row
+    """
+    yield '['
+    batch = []
+    separator = ''
+    for row in rows:
+        batch.append(encoder.encode(row))
+        if len(batch) >= batch_size:
+            yield separator + ','.join(batch)
+            separator = ','
+            batch = []
+    if batch:
+        yield separator + ','.join(batch)
+    yield ']'
@@ -60,6 +60,22 @@ MONGO_URI = 'mongodb://{username}:{password}@{host}:{port}/{db}'.format(
     host=MONGODB_DATABASES['default']['host'],
     port=MONGODB_DATABASES['default']['port'],
 )
+
+# Number of rows written to the label_value_store per bulk write on imports
+SILO_IMPORT_CHUNK_SIZE = int(os.getenv('TOLATABLES_IMPORT_CHUNK_SIZE', 1000))
+# Number of rows upserted per bulk write when merging silos
+SILO_MERGE_BATCH_SIZE = int(os.getenv('TOLATABLES_MERGE_BATCH_SIZE', 1000))
+# Maximum number of unique field indexes created for a single silo
+SILO_MAX_INDEXES = int(os.getenv('TOLATABLES_SILO_MAX_INDEXES', 2))
+# Seconds the row count of a filtered query of the data API is cached
+SILO_FILTERED_COUNT_TIMEOUT = int(
+    os.getenv('TOLATABLES_FILTERED_COUNT_TIMEOUT', 30))
+# Seconds the results of the silo data reads are cached, 0 disables the cache
+SILO_QUERY_CACHE_TIMEOUT = int(
+    os.getenv('TOLATABLES_QUERY_CACHE_TIMEOUT', 600))
+# Results bigger than this many bytes are not cached
+SILO_QUERY_CACHE_MAX_BYTES = int(
+    os.getenv('TOLATABLES_QUERY_CACHE_MAX_BYTES', 1048576))
 ################ END OF MONGO DB #######################
 
 
@@ -347,3 +363,18 @@ GOOGLE_REDIRECT_URL = 'http://localhost:8000/oauth2callback/'
 ########## Celery CONFIGURATION
 CELERY_RESULT_BACKEND = 'amqp'
 CELERY_CACHE_BACKEND = 'django-cache'
+
+
+########## CommCare CONFIGURATION
+# Requests per second sent to CommCareHQ for a domain, shared by all workers
+COMMCARE_RATE_LIMIT = float(os.getenv('TOLATABLES_COMMCARE_RATE_LIMIT', 5))
+# Number of requests that may be sent at once after an idle period
+COMMCARE_RATE_BURST = int(os.getenv('TOLATABLES_COMMCARE_RATE_BURST', 10))
+# Number of page tasks of one fetch running at the same time
+COMMCARE_MAX_IN_FLIGHT = int(os.getenv('TOLATABLES_COMMCARE_MAX_IN_FLIGHT', 4))
+COMMCARE_MAX_RETRIES = int(os.getenv('TOLATABLES_COMMCARE_MAX_RETRIES', 6))
+# Seconds of the first backoff, doubled on every retry up to the maximum
+COMMCARE_BACKOFF_BASE = float(os.getenv('TOLATABLES_COMMCARE_BACKOFF_BASE', 1))
+COMMCARE_BACKOFF_MAX = float(os.getenv('TOLATABLES_COMMCARE_BACKOFF_MAX', 60))
+COMMCARE_REQUEST_TIMEOUT = int(os.getenv('TOLATABLES_COMMCARE_TIMEOUT', 60))
+########## END CommCare CONFIGURATION
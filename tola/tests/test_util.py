@@ -1,14 +1,20 @@
 from django.test import TestCase
 from bson import ObjectId
+from datetime import datetime
 
 import json
 import logging
 import factories
+from io import BytesIO
 from mock import patch, mock
-from silo.models import LabelValueStore
+from silo.models import (LabelValueStore, FormulaColumn,
+                         get_version_collection)
 from silo.custom_csv_dict_reader import CustomDictReader
 from tola.util import clean_data_obj, JSONEncoder, save_data_to_silo, \
-    ona_parse_type_group
+    ona_parse_type_group, calculateFormulaColumn, get_formula_plan, cleanKey
+from django.contrib import messages
+from tola.json_stream import (iter_json_records, iter_json_array,
+                              JSONStreamError)
 
 logger = logging.getLogger("tola")
 
@@ -91,6 +97,29 @@ class CleanDataObjTest(TestCase):
         result = clean_data_obj(row)
         self.assertEqual(result, expected_data)
 
+    def test_clean_data_obj_nested(self):
+        row = {
+            'id': ' 7 ',
+            'tags.list': ['a<b', 'null', {'$value': 'true'}],
+            'info': {'_code': 'x & y', 'empty': ''},
+            'count': 3
+        }
+        expected_data = {
+            'user_assigned_id': 7,
+            'tags_list': ['a&lt;b', None, {'USDvalue': True}],
+            'info': {'sys__code': 'x &amp; y', 'empty': ''},
+            'count': 3
+        }
+
+        result = clean_data_obj(row)
+        self.assertEqual(result, expected_data)
+
+    def test_clean_key_cached(self):
+        self.assertEqual(cleanKey('first  name.'), 'first name_')
+        with patch('tola.util._clean_key') as mock_clean_key:
+            self.assertEqual(cleanKey('first  name.'), 'first name_')
+            self.assertFalse(mock_clean_key.called)
+
 
 class save_data_to_siloTest(TestCase):
     """
@@ -250,6 +279,61 @@ class save_data_to_siloTest(TestCase):
         result = save_data_to_silo(self.silo, data, self.read)
         self.assertEqual(result, expected_response)
 
+    def test_save_data_to_silo_chunked(self):
+        read_file = open('silo/tests/sample_data/test.csv')
+        reader = CustomDictReader(read_file)
+        expected_response = {
+            'skipped_rows': set([]),
+            'num_rows': 4
+        }
+
+        result = save_data_to_silo(self.silo, reader, self.read, chunk_size=3)
+        self.assertEqual(result, expected_response)
+        self.assertEqual(self.silo.data_count, 4)
+
+    def test_save_data_to_silo_unique_field_same_chunk(self):
+        factories.UniqueFields(name='E-mail', silo=self.silo)
+        data = [{
+            'First.Name': 'John',
+            'E-mail': 'john@example.org',
+        }, {
+            'Last.Name': 'Lennon',
+            'E-mail': 'john@example.org',
+        }]
+        expected_response = {
+            'skipped_rows': set([]),
+            'num_rows': 2
+        }
+
+        result = save_data_to_silo(self.silo, data, self.read)
+        self.assertEqual(result, expected_response)
+        lvss = LabelValueStore.objects.filter(silo_id=self.silo.id)
+        self.assertEqual(lvss.count(), 1)
+        lvs_json = json.loads(lvss[0].to_json())
+        self.assertEqual(lvs_json.get('First_Name'), 'John')
+        self.assertEqual(lvs_json.get('Last_Name'), 'Lennon')
+
+    def test_save_data_to_silo_unique_fields_missing(self):
+        factories.UniqueFields(name='E-mail', silo=self.silo)
+        factories.UniqueFields(name='Phone', silo=self.silo)
+        save_data_to_silo(self.silo, [{
+            'First.Name': 'John',
+            'E-mail': 'john@example.org',
+            'Phone': '123',
+        }], self.read)
+
+        # the row without a phone updates the row with the same e-mail
+        result = save_data_to_silo(self.silo, [{
+            'Last.Name': 'Lennon',
+            'E-mail': 'john@example.org',
+        }], self.read)
+        self.assertEqual(result, {'skipped_rows': set([]), 'num_rows': 1})
+        lvss = LabelValueStore.objects.filter(silo_id=self.silo.id)
+        self.assertEqual(lvss.count(), 1)
+        lvs_json = json.loads(lvss[0].to_json())
+        self.assertEqual(lvs_json.get('First_Name'), 'John')
+        self.assertEqual(lvs_json.get('Last_Name'), 'Lennon')
+
     @patch('tola.util.ona_parse_type_repeat')
     def test_ona_parse_type_group_with_valid_data(self,
                                                   mock_ona_parse_type_repeat):
@@ -384,3 +468,132 @@ class save_data_to_siloTest(TestCase):
             ona_parse_type_group(data, form_data, '', silo, read)
             mock_logger.assert_called_once_with(
                 "Keyerror for silo 2, 'Number2'")
+
+
+class CalculateFormulaColumnTest(TestCase):
+    def setUp(self):
+        self.silo = factories.Silo()
+        for a, b in (("1", 2), ("4", "2.5"), ("x", 1), ("3", 3)):
+            lvs = LabelValueStore(a=a, b=b, silo_id=self.silo.id)
+            lvs.save()
+
+    def tearDown(self):
+        LabelValueStore.objects(silo_id=self.silo.id).delete()
+
+    def _values(self, name):
+        lvss = LabelValueStore.objects(silo_id=self.silo.id).order_by('id')
+        return [getattr(lvs, name) for lvs in lvss]
+
+    def test_calculate_formula_column(self):
+        result = calculateFormulaColumn(self.silo.id, 'sum', ['a', 'b'], 'sum')
+        self.assertEqual(result, (
+            messages.WARNING, "Non-numeric data detected in rows [2]"))
+        self.assertEqual(self._values('sum'), [3.0, 6.5, "Error", 6.0])
+
+    @patch('tola.util._can_calculate_on_server', return_value=False)
+    def test_calculate_formula_column_bulk(self, mock_server):
+        result = calculateFormulaColumn(self.silo.id, 'mean', ['a', 'b'],
+                                        'mean', chunk_size=3)
+        self.assertEqual(result, (
+            messages.WARNING, "Non-numeric data detected in rows [2]"))
+        self.assertEqual(self._values('mean'), [1.5, 3.25, "Error", 3.0])
+
+    def test_calculate_formula_column_no_columns(self):
+        result = calculateFormulaColumn(self.silo.id, 'sum', [], 'sum')
+        self.assertEqual(result[0], messages.ERROR)
+
+
+class FormulaPlanTest(TestCase):
+    def setUp(self):
+        self.silo = factories.Silo()
+        column = FormulaColumn.objects.create(
+            mapping='["a", "b"]', operation='sum', column_name='total')
+        self.silo.formulacolumns.add(column)
+
+    def test_formula_plan_apply(self):
+        plan = get_formula_plan(self.silo)
+        self.assertEqual(plan.column_names, ['total'])
+        rows = plan.apply_many([{'a': '1', 'b': 2}, {'a': 'x', 'b': 2}])
+        self.assertEqual([row['total'] for row in rows], [3.0, "Error"])
+
+    def test_formula_plan_cached(self):
+        get_formula_plan(self.silo)
+        with self.assertNumQueries(0):
+            plan = get_formula_plan(self.silo)
+        self.assertEqual(len(plan), 1)
+
+    def test_formula_plan_other_process(self):
+        get_formula_plan(self.silo)
+
+        # the formulas edited by another process are read once it bumps
+        # the version
+        FormulaColumn.objects.filter(silos=self.silo).update(
+            column_name='sum')
+        self.assertEqual(get_formula_plan(self.silo).column_names,
+                         ['total'])
+        get_version_collection().update_one(
+            {'_id': self.silo.pk}, {'$inc': {'formulas': 1}}, upsert=True)
+        self.assertEqual(get_formula_plan(self.silo).column_names, ['sum'])
+
+    def test_formula_plan_invalidated(self):
+        get_formula_plan(self.silo)
+        column = FormulaColumn.objects.create(
+            mapping='["a"]', operation='max', column_name='max')
+        self.silo.formulacolumns.add(column)
+        self.assertEqual(get_formula_plan(self.silo).column_names,
+                         ['total', 'max'])
+
+        column.column_name = 'maximum'
+        column.save()
+        self.assertEqual(get_formula_plan(self.silo).column_names,
+                         ['total', 'maximum'])
+
+        column.delete()
+        self.assertEqual(get_formula_plan(self.silo).column_names, ['total'])
+
+
+class IterJSONRecordsTest(TestCase):
+    data = [{'name': u'J\xfcrgen', 'values': [1, 2.5, None]},
+            {'name': 'Jane', 'nested': {'a': '[{,}]'}}]
+
+    def test_iter_json_records_list(self):
+        f = BytesIO(json.dumps(self.data, ensure_ascii=False).encode('utf-8'))
+        self.assertEqual(list(iter_json_records(f, buffer_size=3)),
+                         self.data)
+
+    def test_iter_json_records_path(self):
+        doc = {'meta': {'next': None}, 'data': {'results': self.data}}
+        f = BytesIO(json.dumps(doc))
+        self.assertEqual(list(iter_json_records(f, 'data.results', 5)),
+                         self.data)
+
+    def test_iter_json_records_single_object(self):
+        f = BytesIO(json.dumps(self.data[0]))
+        self.assertEqual(list(iter_json_records(f)), [self.data[0]])
+
+    def test_iter_json_records_empty(self):
+        self.assertEqual(list(iter_json_records(BytesIO(b'[ ]'))), [])
+
+    def test_iter_json_records_invalid(self):
+        with self.assertRaises(JSONStreamError):
+            list(iter_json_records(BytesIO(b'[{"a": 1}, {"a"')))
+        with self.assertRaises(JSONStreamError):
+            list(iter_json_records(BytesIO(b'{"data": []}'), 'results'))
+
+
+class IterJSONArrayTest(TestCase):
+    def test_iter_json_array(self):
+        rows = [{'_id': ObjectId('5aaf820a58d8e7002c889905'), 'a': i}
+                for i in range(5)]
+        chunks = list(iter_json_array(iter(rows), JSONEncoder(),
+                                      batch_size=2))
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(json.loads(''.join(chunks))[4],
+                         {'_id': {'$oid': '5aaf820a58d8e7002c889905'},
+                          'a': 4})
+        self.assertEqual(''.join(iter_json_array([], JSONEncoder())), '[]')
+
+    def test_json_encoder_datetime(self):
+        encoded = JSONEncoder().encode(
+            {'date': datetime(2018, 5, 9, 10, 30, 0, 123000)})
+        self.assertEqual(encoded, '{"date": {"$date": 1525861800123}}')
@@ -63,6 +63,8 @@ urlpatterns = [
     url(r'^silos', views.list_silos, name='list_silos'),
     url(r'^silo_detail/(?P<silo_id>\w+)/$', views.silo_detail,
         name='silo_detail'),
+    url(r'^silo_import_progress/(?P<silo_id>\w+)/$',
+        views.silo_import_progress, name='silo_import_progress'),
     url(r'^silo_edit/(?P<id>\w+)/$', views.edit_silo, name='edit_silo'),
     url(r'^silo_delete/(?P<id>\w+)/$', views.deleteSilo,
         name='deleteSilo'),
@@ -78,6 +80,8 @@ urlpatterns = [
     url(r'^merge/(?P<id>\w+)/$', views.mergeForm, name='mergeForm'),
     url(r'^merge_columns', views.mergeColumns, name='mergeColumns'),
     url(r'^do_merge', views.do_merge, name='do_merge'),
+    url(r'^silo_merge_progress/(?P<task_id>[\w-]+)/$',
+        views.silo_merge_progress, name='silo_merge_progress'),
     url(r'^updateMergedTable/(?P<pk>\w+)/$', views.updateSiloData,
         name='updateMergedTable'),
 
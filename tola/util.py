@@ -2,27 +2,51 @@ import urllib2
 import json
 import base64
 import requests
+import calendar
 import cgi
 from collections import OrderedDict
+from datetime import datetime
+from itertools import islice
 from bson import ObjectId
 import logging
 from django.utils import timezone
+from django.utils.encoding import force_text
 from django.conf import settings
-
-from silo.models import Silo, LabelValueStore, ThirdPartyTokens
+from django.db import transaction
+from django.db.models import Max
+
+from silo.models import (Silo, LabelValueStore, ThirdPartyTokens,
+                         add_silo_rows, bump_silo_version, get_data_silo_id,
+                         get_silo_columns_version, get_formula_plan_version,
+                         SiloColumn, invalidate_silo_columns)
+from tola.json_stream import iter_json_records
 from django.contrib import messages
-from pymongo import MongoClient
-
-from collections import deque
+from pymongo import MongoClient, InsertOne, UpdateOne, ASCENDING
+from pymongo.errors import OperationFailure
 
 
 logger = logging.getLogger("tola")
 
+# first characters of the strings json.loads may accept
+JSON_START_CHARS = frozenset(u'{["-0123456789tfnNI')
+
+CLEAN_KEY_CACHE_SIZE = 10000
+_clean_key_cache = {}
+
 
 class JSONEncoder(json.JSONEncoder):
+    """
+    Encodes ObjectIds and datetimes the way bson.json_util does
+    """
     def default(self, o):
         if isinstance(o, ObjectId):
             return {u'$oid': str(o)}
+        if isinstance(o, datetime):
+            if o.utcoffset() is not None:
+                o = o - o.utcoffset()
+            millis = calendar.timegm(o.timetuple()) * 1000 + \
+                o.microsecond // 1000
+            return {u'$date': millis}
         return json.JSONEncoder.default(self, o)
 
 
@@ -62,16 +86,79 @@ def parseMathInstruction(operation):
         raise TypeError(operation)
 
 
-def save_data_to_silo(silo, data, read=-1, user=None):
+def iter_chunks(iterable, size):
+    """
+    Yields lists of at most `size` items from any iterable without
+    materialising it, so readers and generators keep constant memory.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _unique_key(criteria):
+    """
+    Returns the key of the unique field values of a filter criteria, only
+    the fields it has are part of the key
+    """
+    return tuple(sorted((name, force_text(value))
+                        for name, value in criteria.iteritems()))
+
+
+def _find_unique_matches(collection, silo_id, uf_names, criterias, full_docs):
+    """
+    Resolves the unique field matches of a whole chunk with a single query
+
+    collection -- the label_value_store collection
+    silo_id -- the silo_id of the rows of the silo being written to
+    uf_names -- the names of the silo's unique fields
+    criterias -- list of filter criteria dicts (without silo_id)
+    full_docs -- fetch the whole documents instead of just the unique fields
+
+    returns a dict of unique key -> list of matching documents, a document
+    is listed under the key of every set of unique fields of the criterias,
+    as a row lacking some unique fields matches on the others only
+    """
+    if len(uf_names) == 1:
+        name = uf_names[0]
+        query = {name: {'$in': list(set(c[name] for c in criterias))}}
+    else:
+        query = {'$or': criterias}
+    query['silo_id'] = silo_id
+
+    projection = None if full_docs else dict.fromkeys(uf_names, 1)
+    field_sets = set(tuple(sorted(criteria)) for criteria in criterias)
+    matches = {}
+    for doc in collection.find(query, projection):
+        for names in field_sets:
+            if all(name in doc for name in names):
+                key = _unique_key({name: doc[name] for name in names})
+                matches.setdefault(key, []).append(doc)
+    return matches
+
+
+def save_data_to_silo(silo, data, read=-1, user=None, chunk_size=None,
+                      progress=None):
     """
     This saves data to the silo
 
+    Rows are written in chunks: the unique field matches of a whole chunk are
+    resolved with one query and the chunk is written with one unordered
+    bulk_write of InsertOne/UpdateOne operations.
+
     Keyword arguments:
     silo -- the silo object, which is meta data for its labe_value_store
     data -- a python list of dictionaries. stored in MONGODB
     read -- the read object, optional only for backwards compatability
     user -- an optional parameter to use if its necessary to retrieve
             from ThirdPartyTokens
+    chunk_size -- number of rows per bulk write, defaults to
+                  settings.SILO_IMPORT_CHUNK_SIZE
+    progress -- an optional callable, called with the number of rows read
+                after each chunk has been written
     """
     try:
         if read.type.read_type == "ONA" and user:
@@ -79,7 +166,11 @@ def save_data_to_silo(silo, data, read=-1, user=None):
         read_source_id = read.id
     except AttributeError:
         read_source_id = read
-    unique_fields = silo.unique_fields.all()
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'SILO_IMPORT_CHUNK_SIZE', 1000)
+    uf_names = [str(uf.name) for uf in silo.unique_fields.all()]
+    formula_plan = get_formula_plan(silo)
+    collection = LabelValueStore._get_collection()
     skipped_rows = set()
     counter = 0
     keys = []
@@ -89,43 +180,81 @@ def save_data_to_silo(silo, data, read=-1, user=None):
     except AttributeError as e:
         logger.warning(e)
 
-    for counter, row in enumerate(data):
-        # resetting filter_criteria for each row
+    for chunk in iter_chunks(data, chunk_size):
+        res = _save_chunk_to_silo(silo, chunk, read_source_id, uf_names,
+                                  formula_plan, collection, keys)
+        skipped_rows.update(res['skipped_rows'])
+        counter += res['num_rows']
+        if progress:
+            progress(len(chunk))
+
+    addColsToSilo(silo, keys)
+    res = {"skipped_rows": skipped_rows, "num_rows": counter}
+    return res
+
+
+def _save_chunk_to_silo(silo, rows, read_source_id, uf_names,
+                        formula_plan, collection, keys):
+    """
+    Writes one chunk of rows to the label_value_store of a silo
+
+    A row that matches exactly one document through the unique fields updates
+    it, a row matching none is inserted and a row matching several documents
+    is skipped. Rows of the same chunk sharing a unique key are folded into
+    one write in the order they were read.
+    """
+    # resolve the filter_criteria of every row of the chunk
+    criterias = []
+    for row in rows:
         filter_criteria = {}
-        for uf in unique_fields:
+        for name in uf_names:
             try:
-                filter_criteria.update({str(uf.name): str(row[uf.name])})
+                filter_criteria.update({name: str(row[name])})
             except KeyError as e:
                 # when this excpetion occurs, it means that the col identified
                 # as the unique_col is not present in the fetched dataset
                 logger.info(e)
+        criterias.append(filter_criteria)
 
-        # if filter_criteria is set, then update it with current silo_id
-        # else set filter_criteria to some non-existent key and value so
-        # that it triggers a DoesNotExist exception in order to create a new
-        # document instead of updating an existing one.
-        if filter_criteria:
-            filter_criteria.update({'silo_id': silo.id})
+    matches = {}
+    lookups = [c for c in criterias if c]
+    if lookups:
+        matches = _find_unique_matches(collection, silo.data_id, uf_names,
+                                       lookups, bool(formula_plan))
 
-            try:
-                lvs = LabelValueStore.objects.get(**filter_criteria)
-                setattr(lvs, "edit_date", timezone.now())
-                lvs.read_id = read_source_id
-            except LabelValueStore.DoesNotExist:
-                lvs = LabelValueStore()
-                lvs.silo_id = silo.pk
-                lvs.create_date = timezone.now()
-                lvs.read_id = read_source_id
-            except LabelValueStore.MultipleObjectsReturned:
+    skipped_rows = set()
+    num_rows = 0
+    # unique key -> [operation type, document, filter]
+    pending = OrderedDict()
+    inserts = []
+    for row, filter_criteria in zip(rows, criterias):
+        now = timezone.now()
+        if filter_criteria:
+            unique_key = _unique_key(filter_criteria)
+            found = matches.get(unique_key, [])
+            if len(found) > 1:
+                filter_criteria.update({'silo_id': silo.data_id})
                 for k, v in filter_criteria.iteritems():
                     skipped_rows.add("{}={}".format(str(k), str(v)))
                 continue
+            if unique_key in pending:
+                # a previous row of this chunk already wrote this key
+                op = pending[unique_key]
+                op[1]['edit_date'] = now
+            elif found:
+                op = ['update', {'edit_date': now}, {'_id': found[0]['_id']}]
+                pending[unique_key] = op
+            else:
+                op = ['insert', {'silo_id': silo.data_id, 'create_date': now},
+                      None]
+                pending[unique_key] = op
+            doc = op[1]
+            existing = found[0] if found else {}
         else:
-            lvs = LabelValueStore()
-
-            lvs.silo_id = silo.pk
-            lvs.create_date = timezone.now()
-            lvs.read_id = read_source_id
+            doc = {'silo_id': silo.data_id, 'create_date': now}
+            inserts.append(doc)
+            existing = {}
+        doc['read_id'] = read_source_id
 
         row = clean_data_obj(row)
 
@@ -133,15 +262,29 @@ def save_data_to_silo(silo, data, read=-1, user=None):
             if not isinstance(key, tuple):
                 if key not in keys:
                     keys.append(key)
-                setattr(lvs, key, val)
-
-        counter += 1
-        lvs = calculateFormulaCell(lvs, silo)
-        lvs.save()
+                doc[key] = val
+
+        num_rows += 1
+        if formula_plan:
+            # formulas may use columns of the stored document as well
+            entry = dict(existing)
+            entry.update(doc)
+            formula_plan.apply(entry)
+            doc['edit_date'] = entry['edit_date']
+            for name in formula_plan.column_names:
+                doc[name] = entry[name]
+
+    operations = [InsertOne(insert) for insert in inserts]
+    for op_type, doc, op_filter in pending.itervalues():
+        if op_type == 'insert':
+            operations.append(InsertOne(doc))
+        else:
+            operations.append(UpdateOne(op_filter, {'$set': doc}))
+    if operations:
+        result = collection.bulk_write(operations, ordered=False)
+        add_silo_rows(silo.pk, result.inserted_count)
 
-    addColsToSilo(silo, keys)
-    res = {"skipped_rows": skipped_rows, "num_rows": counter}
-    return res
+    return {"skipped_rows": skipped_rows, "num_rows": num_rows}
 
 
 def clean_data_obj(obj):
@@ -151,22 +294,58 @@ def clean_data_obj(obj):
     :param obj: dict | list | string
     :return: dict
     """
-    if not isinstance(obj, (dict, list, OrderedDict)):
-
-        try:
-            obj = json.loads(obj)
-        except (ValueError, TypeError):
-            if isinstance(obj, str) or isinstance(obj, unicode):
-                obj = cgi.escape(obj)
-        return obj
+    if isinstance(obj, dict):
+        # rows are mostly flat, so only nested values go through a recursion
+        cleaned = {}
+        for k, v in obj.iteritems():
+            if isinstance(v, (dict, list)):
+                cleaned[cleanKey(k)] = clean_data_obj(v)
+            else:
+                cleaned[cleanKey(k)] = clean_value(v)
+        return cleaned
 
     if isinstance(obj, list):
         return [clean_data_obj(v) for v in obj]
 
-    return {cleanKey(k): clean_data_obj(v) for k, v in obj.items()}
+    return clean_value(obj)
+
+
+def clean_value(value):
+    """
+    Cleans a scalar value: strings holding JSON are decoded and other strings
+    are html escaped
+    """
+    if not isinstance(value, basestring):
+        return value
+    # only try to decode strings that could be JSON at all
+    stripped = value.lstrip()
+    if stripped and stripped[0] in JSON_START_CHARS:
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    if '&' in value or '<' in value or '>' in value:
+        return cgi.escape(value)
+    return value
 
 
 def cleanKey(key):
+    """
+    Returns the name a key is stored under. The results are memoized since an
+    import cleans the same few headers for every row.
+    """
+    try:
+        return _clean_key_cache[key]
+    except KeyError:
+        pass
+    cleaned = _clean_key(key)
+    if len(_clean_key_cache) >= CLEAN_KEY_CACHE_SIZE:
+        _clean_key_cache.clear()
+    _clean_key_cache[key] = cleaned
+    return cleaned
+
+
+def _clean_key(key):
     if key == "" or key is None or key == "silo_id":
         return key
     elif key == "id" or key == "_id":
@@ -218,16 +397,18 @@ def importJSON(read_obj, user, remote_user=None, password=None, silo_id=None,
         silo.reads.add(read_obj)
         silo_id = silo.id
 
-        # create object from JSON String
-        data = json.load(json_file)
-        json_file.close()
+        # parse the records one at a time while they are written
+        data = iter_json_records(json_file, read_obj.json_path)
 
         # if the caller of this function does not want to the data to go into
         #  the silo yet
         if return_data:
+            data = list(data)
+            json_file.close()
             return data
 
         save_data_to_silo(silo, data, read_obj)
+        json_file.close()
         return messages.SUCCESS, "Data imported successfully.", str(silo_id)
     except Exception as e:
         if return_data:
@@ -235,24 +416,72 @@ def importJSON(read_obj, user, remote_user=None, password=None, silo_id=None,
         return messages.ERROR, "An error has occured: %s" % e, str(silo_id)
 
 
-def getSiloColumnNames(id):
+# columns that are never shown, whatever the silo says
+SYSTEM_COLUMNS = frozenset(['id', 'silo_id', 'read_id', 'create_date',
+                            'edit_date', 'editted_date'])
+
+SILO_COLUMNS_CACHE_SIZE = 1000
+_silo_columns_cache = {}
+
+
+class SiloColumns(object):
+    """
+    The column metadata of a silo
+
+    names -- all the column names in order
+    types -- the type of each column
+    hidden -- the names of the columns hidden by the user
+    shown -- the names of the columns to show in order
+    """
+
+    def __init__(self, columns):
+        """
+        columns -- (name, type, hidden) tuples in order
+        """
+        columns = list(columns)
+        self.names = tuple(name for name, type, hidden in columns)
+        self.types = {name: type for name, type, hidden in columns}
+        self.hidden = frozenset(name for name, type, hidden in columns
+                                if hidden)
+        not_shown = self.hidden.union(SYSTEM_COLUMNS)
+        self.shown = tuple(name for name in self.names
+                           if name not in not_shown)
+
+    @classmethod
+    def from_silo(cls, silo):
+        return cls(silo.silo_columns.values_list('name', 'type', 'hidden'))
+
+
+def get_silo_columns(silo_id):
     """
-    takes silo_id and returns the shown columns in order in O(n)
+    Returns the SiloColumns of a silo. They are kept in a cache local to the
+    process, stamped with the version of the columns that every write to
+    them bumps: addColsToSilo, deleteSiloColumns, hideSiloColumns,
+    unhideSiloColumns, reorderSiloColumns and the like invalidate it. The
+    version is read from MongoDB, so the columns written by a worker are
+    seen by the web processes and the other way around.
+
+    The returned object is shared, it must not be modified.
     """
-    silo = Silo.objects.get(pk=id)
-    cols_raw = json.loads(silo.columns)
-    hidden_cols = set(json.loads(silo.hidden_columns))
-    hidden_cols = hidden_cols.union(['id', 'silo_id', 'read_id', 'create_date',
-                                     'edit_date', 'editted_date'])
+    silo_id = int(silo_id)
+    version = get_silo_columns_version(silo_id)
+    cached = _silo_columns_cache.get(silo_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
 
-    cols_final = deque()
-    for col in cols_raw:
-        col_name = col if isinstance(col, basestring) else col.get('name')
+    silo = Silo.objects.only('id').get(pk=silo_id)
+    columns = SiloColumns.from_silo(silo)
+    if len(_silo_columns_cache) >= SILO_COLUMNS_CACHE_SIZE:
+        _silo_columns_cache.clear()
+    _silo_columns_cache[silo_id] = (version, columns)
+    return columns
 
-        if col_name not in hidden_cols:
-            cols_final.append(col_name)
 
-    return list(cols_final)
+def getSiloColumnNames(id):
+    """
+    takes silo_id and returns the shown columns in order
+    """
+    return list(get_silo_columns(id).shown)
 
 
 def getCompleteSiloColumnNames(id):
@@ -261,14 +490,13 @@ def getCompleteSiloColumnNames(id):
 
     id -- silo_id
     """
-    silo = Silo.objects.get(pk=id)
-    return [x if isinstance(x, basestring) else x.get('name')
-            for x in json.loads(silo.columns)]
+    return list(get_silo_columns(id).names)
 
 
 def addColsToSilo(silo, columns, col_types={}):
     """
-    This adds columns to a silo object while preserving order in O(n)
+    This adds columns to a silo object after its existing ones, only
+    writing the columns that are new
 
     silo -- a silo object
     columns -- an iterable containing columns to add
@@ -277,62 +505,90 @@ def addColsToSilo(silo, columns, col_types={}):
     columns_set = set(columns)
     if len(columns_set) != len(columns):
         raise ValueError('Duplicate columns are not allowed')
-    silo_cols = json.loads(silo.columns)
-    # this is done to decrease lookup time from n to 1
-    silo_cols_set = set([x['name'] for x in silo_cols])
-    silo_cols.extend([{'name': x, 'type': col_types.get(x, 'string')}
-                      for x in columns if x not in silo_cols_set])
-    silo.columns = json.dumps(silo_cols)
-    silo.save()
+    with transaction.atomic():
+        # the reads of a silo are imported concurrently, so the silo is
+        # locked to not give two new columns the same position
+        _lock_silo(silo)
+        existing = set(silo.silo_columns.filter(
+            name__in=columns_set).values_list('name', flat=True))
+        position = silo.silo_columns.aggregate(
+            position=Max('position'))['position']
+        position = -1 if position is None else position
+        new_columns = []
+        for name in columns:
+            if name not in existing:
+                position += 1
+                new_columns.append(SiloColumn(
+                    silo=silo, name=name, position=position,
+                    type=col_types.get(name, 'string')))
+        SiloColumn.objects.bulk_create(new_columns)
+    if new_columns:
+        invalidate_silo_columns(silo.pk)
+
+
+def _lock_silo(silo):
+    list(Silo.objects.select_for_update().filter(pk=silo.pk).values_list(
+        'pk', flat=True))
 
 
 def deleteSiloColumns(silo, columns):
     """
-    delete a list of columns from a silos column list in O(n)
+    delete a list of columns from a silo
     """
-    cols_old = json.loads(silo.columns)
-    columns = set(columns)
-
-    cols_final = deque()
-    for col in cols_old:
-        if col['name'] not in columns:
-            cols_final.append(col)
-
-    silo.columns = json.dumps(list(cols_final))
-    unhideSiloColumns(silo, columns)
-    silo.save()
+    silo.silo_columns.filter(name__in=set(columns)).delete()
+    invalidate_silo_columns(silo.pk)
 
 
 def hideSiloColumns(silo, cols):
     """
     take a list of columns and add it to be hidden
     """
-    hidden_cols = set(json.loads(silo.hidden_columns))
-    hidden_cols = hidden_cols.union(cols)
-    silo.hidden_columns = json.dumps(list(hidden_cols))
-    silo.save()
+    silo.silo_columns.filter(name__in=set(cols)).update(hidden=True)
+    invalidate_silo_columns(silo.pk)
 
 
 def unhideSiloColumns(silo, cols):
     """
     take a list of columns and unhides it
     """
-    hidden_cols = set(json.loads(silo.hidden_columns))
-    hidden_cols = hidden_cols.difference(cols)
-    silo.hidden_columns = json.dumps(list(hidden_cols))
-    silo.save()
+    silo.silo_columns.filter(name__in=set(cols)).update(hidden=False)
+    invalidate_silo_columns(silo.pk)
+
+
+def renameSiloColumn(silo, name, new_name):
+    silo.silo_columns.filter(name=name).update(name=new_name)
+    invalidate_silo_columns(silo.pk)
+
+
+def reorderSiloColumns(silo, cols):
+    """
+    Moves the given columns first, in the given order, the other columns
+    keeping their order after them. Only the columns whose position changes
+    are written.
+    """
+    cols = list(OrderedDict.fromkeys(cols))
+    order = {name: position for position, name in enumerate(cols)}
+    with transaction.atomic():
+        _lock_silo(silo)
+        current = list(silo.silo_columns.values_list('pk', 'name',
+                                                     'position'))
+        rest = [column for column in current if column[1] not in order]
+        positions = {name: order[name] for pk, name, position in current
+                     if name in order}
+        positions.update((name, len(cols) + i)
+                         for i, (pk, name, position) in enumerate(rest))
+        for pk, name, position in current:
+            if positions[name] != position:
+                SiloColumn.objects.filter(pk=pk).update(
+                    position=positions[name])
+    invalidate_silo_columns(silo.pk)
 
 
 def getColToTypeDict(silo):
     """
     Returns key value pairs of the name of a column to its type in O(n)
     """
-    columns = json.loads(silo.columns)
-    if len(columns) > 0 and not isinstance(columns[0], basestring):
-        column_types = {x['name']: x['type'] for x in columns}
-    else:
-        column_types = {x: 'string' for x in columns}
-    return column_types
+    return SiloColumns.from_silo(silo).types
 
 
 # gets the list of apps to import data
@@ -457,15 +713,187 @@ def saveOnaDataToSilo(silo, data, read, user):
         return
 
 
-def calculateFormulaColumn(lvs, operation, columns, formula_column_name):
+# the operations that can be computed inside MongoDB, with the minimum
+# server version they need on top of the update pipelines of 4.2
+SERVER_SIDE_OPERATIONS = {
+    'sum': (4, 2),
+    'mean': (4, 2),
+    'max': (4, 2),
+    'min': (4, 2),
+    'median': (5, 2),
+}
+
+# temporary field holding the converted values during the pipeline update,
+# cleanKey never lets a column start with an underscore
+FORMULA_VALUES_FIELD = '_formula_values'
+
+NUMERIC_TYPES = ['double', 'int', 'long', 'decimal', 'string', 'bool']
+
+
+def get_mongo_version(collection):
+    return tuple(collection.database.client.server_info()['versionArray'][:2])
+
+
+def _formula_expression(operation, values):
+    """
+    Returns the aggregation expression doing the math operation on an array
+    """
+    if operation == "sum":
+        return {'$sum': values}
+    elif operation == "mean":
+        return {'$avg': values}
+    elif operation == "max":
+        return {'$max': values}
+    elif operation == "min":
+        return {'$min': values}
+    elif operation == "median":
+        size = {'$size': values}
+        return {'$let': {
+            'vars': {
+                'sorted': {'$sortArray': {'input': values, 'sortBy': 1}},
+                'half': {'$toInt': {'$floor': {'$divide': [size, 2]}}},
+            },
+            'in': {'$cond': [
+                {'$eq': [{'$mod': [size, 2]}, 1]},
+                {'$arrayElemAt': ['$$sorted', '$$half']},
+                {'$divide': [{'$add': [
+                    {'$arrayElemAt': ['$$sorted',
+                                      {'$subtract': ['$$half', 1]}]},
+                    {'$arrayElemAt': ['$$sorted', '$$half']}]}, 2]},
+            ]},
+        }}
+    raise TypeError(operation)
+
+
+def _formula_pipeline(operation, columns, formula_column_name):
+    """
+    Returns the update pipeline computing a formula column for every document
+    """
+    values = []
+    for col in columns:
+        field = '$' + col
+        # anything float() would refuse becomes null and marks the row Error
+        values.append({'$cond': [
+            {'$in': [{'$type': field}, NUMERIC_TYPES]},
+            {'$convert': {'input': field, 'to': 'double',
+                          'onError': None, 'onNull': None}},
+            None]})
+    values_field = '$' + FORMULA_VALUES_FIELD
+    return [
+        {'$set': {FORMULA_VALUES_FIELD: values}},
+        {'$set': {
+            formula_column_name: {'$cond': [
+                {'$in': [None, values_field]},
+                "Error",
+                {'$round': [_formula_expression(operation, values_field), 4]},
+            ]},
+            'edit_date': timezone.now(),
+        }},
+        {'$unset': FORMULA_VALUES_FIELD},
+    ]
+
+
+def _can_calculate_on_server(collection, operation, columns,
+                             formula_column_name):
+    version = SERVER_SIDE_OPERATIONS.get(operation)
+    if version is None:
+        return False
+    # names with dots or a leading $ can't be used as field paths
+    for name in list(columns) + [formula_column_name]:
+        if '.' in name or name.startswith('$'):
+            return False
+    return get_mongo_version(collection) >= version
+
+
+def _calculate_formula_on_server(collection, silo_id, operation, columns,
+                                 formula_column_name):
+    """
+    Computes a formula column for the whole silo with one update command
+
+    returns the positions of the rows with non-numeric data, or None if the
+    server refused the pipeline update
+    """
+    # the command is sent as is since older pymongo versions only accept
+    # documents as the update of update_many
+    try:
+        result = collection.database.command(
+            'update', collection.name,
+            updates=[{
+                'q': {'silo_id': silo_id},
+                'u': _formula_pipeline(operation, columns,
+                                       formula_column_name),
+                'multi': True,
+            }])
+    except OperationFailure as e:
+        logger.warning("Pipeline update of %s failed: %s"
+                       % (formula_column_name, e))
+        return None
+    if result.get('writeErrors'):
+        logger.warning("Pipeline update of %s failed: %s"
+                       % (formula_column_name, result['writeErrors']))
+        return None
+
+    error_ids = collection.find(
+        {'silo_id': silo_id, formula_column_name: "Error"},
+        {'_id': 1}).sort('_id', ASCENDING)
+    calc_fails = []
+    next_error = next(error_ids, None)
+    if next_error is None:
+        return calc_fails
+    # walk the (silo_id, _id) index to turn the ids into row positions
+    row_ids = collection.find({'silo_id': silo_id}, {'_id': 1}).sort(
+        '_id', ASCENDING)
+    for i, row in enumerate(row_ids):
+        if row['_id'] == next_error['_id']:
+            calc_fails.append(i)
+            next_error = next(error_ids, None)
+            if next_error is None:
+                break
+    return calc_fails
+
+
+def _calculate_formula_in_bulk(collection, silo_id, calc, columns,
+                               formula_column_name, chunk_size):
+    """
+    Computes a formula column in Python, writing the results in chunks
+
+    returns the positions of the rows with non-numeric data
+    """
+    rows = collection.find({'silo_id': silo_id},
+                           dict.fromkeys(columns, 1)).sort('_id', ASCENDING)
+    calc_fails = []
+    i = 0
+    for chunk in iter_chunks(rows, chunk_size):
+        ops = []
+        for row in chunk:
+            row, success = calculateFormula(row, calc, columns,
+                                            formula_column_name)
+            if not success:
+                calc_fails.append(i)
+            ops.append(UpdateOne({'_id': row['_id']}, {'$set': {
+                formula_column_name: row[formula_column_name],
+                'edit_date': row['edit_date']}}))
+            i += 1
+        collection.bulk_write(ops, ordered=False)
+    return calc_fails
+
+
+def calculateFormulaColumn(silo_id, operation, columns, formula_column_name,
+                           chunk_size=None):
     """
-    This function calculates the math operation for a queryset of
-    abel_value_store using defined columns
+    This function calculates the math operation for all the rows of a silo
+    using defined columns
+
+    The column is computed inside MongoDB with a single pipeline update when
+    the server supports the operation, otherwise the rows are read in Python
+    and the results written back in bulk.
 
-    lvs -- a queryset of label_value_store objects
+    silo_id -- the id of the silo whose label_value_store rows are updated
     operation -- the math operation to perform
     columns -- a list of columns to use in the math operation
     formula_column_name -- name of the column that holds the math done
+    chunk_size -- number of rows per bulk write of the Python path, defaults
+                  to settings.SILO_IMPORT_CHUNK_SIZE
     """
 
     if not columns or len(columns) == 0:
@@ -475,14 +903,21 @@ def calculateFormulaColumn(lvs, operation, columns, formula_column_name):
     if type(calc) == tuple:
         return calc
 
-    calc_fails = []
-    for i, entry in enumerate(lvs):
-        entry = calculateFormula(entry, calc, columns, formula_column_name)
-        if entry[1]:
-            entry[0].save()
-        else:
-            entry[0].save()
-            calc_fails.append(i)
+    collection = LabelValueStore._get_collection()
+    data_id = get_data_silo_id(silo_id)
+    calc_fails = None
+    if _can_calculate_on_server(collection, operation, columns,
+                                formula_column_name):
+        calc_fails = _calculate_formula_on_server(
+            collection, data_id, operation, columns, formula_column_name)
+    if calc_fails is None:
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'SILO_IMPORT_CHUNK_SIZE', 1000)
+        calc_fails = _calculate_formula_in_bulk(
+            collection, data_id, calc, columns, formula_column_name,
+            chunk_size)
+    bump_silo_version(silo_id)
+
     if len(calc_fails) == 0:
         return messages.SUCCESS, "Successfully performed operations"
     return messages.WARNING, "Non-numeric data detected in rows {}".format(
@@ -493,7 +928,7 @@ def calculateFormula(entry, calc, columns, formula_column_name):
     """
     This function calculates a math operation for a single query
 
-    entry -- a query of label_value_store objects
+    entry -- a query of label_value_store objects or a plain dict
     calc -- a function pointer to the math operation to perform
     columns -- a list of columns to use in the math operation
     formula_column_name -- name of the column that holds the math done
@@ -503,34 +938,98 @@ def calculateFormula(entry, calc, columns, formula_column_name):
         for col in columns:
             values_to_calc.append(float(entry[col]))
         calculation = calc(values_to_calc)
-        setattr(entry, formula_column_name, round(calculation, 4))
-        entry.edit_date = timezone.now()
+        entry[formula_column_name] = round(calculation, 4)
+        entry['edit_date'] = timezone.now()
         success = True
-    except (ValueError, KeyError) as operation:
+    except (ValueError, KeyError, TypeError) as operation:
         logger.warning(operation)
-        setattr(entry, formula_column_name, "Error")
-        entry.edit_date = timezone.now()
+        entry[formula_column_name] = "Error"
+        entry['edit_date'] = timezone.now()
         success = False
     return entry, success
 
 
-def calculateFormulaCell(entry, silo):
+class FormulaPlan(object):
+    """
+    The formula columns of a silo with the math functions and the mapped
+    columns resolved once, so they can be applied to any number of rows
+    without database access
+    """
+
+    def __init__(self, formulas):
+        """
+        formulas -- a list of (operation, columns, column_name) tuples
+        """
+        self.formulas = [(parseMathInstruction(operation), list(columns),
+                          column_name)
+                         for operation, columns, column_name in formulas]
+        self.column_names = [formula[2] for formula in self.formulas]
+
+    @classmethod
+    def from_columns(cls, formula_columns):
+        return cls([(column.operation, json.loads(column.mapping),
+                     column.column_name) for column in formula_columns])
+
+    def __len__(self):
+        return len(self.formulas)
+
+    def apply(self, entry):
+        """
+        calculates all the formula for a given entry
+
+        entry -- a query of label_value_store objects or a plain dict
+
+        returns entry
+        """
+        for calc, columns, column_name in self.formulas:
+            entry = calculateFormula(entry, calc, columns, column_name)[0]
+        return entry
+
+    def apply_many(self, entries):
+        return [self.apply(entry) for entry in entries]
+
+
+FORMULA_PLAN_CACHE_SIZE = 1000
+_formula_plan_cache = {}
+
+
+def get_formula_plan(silo):
+    """
+    Returns the FormulaPlan of a silo. The plans are kept in a cache local
+    to the process, stamped with the version of the formulas of the silo
+    that the changes to its FormulaColumns bump. As for get_silo_columns,
+    the version is read from MongoDB, so the formulas edited in a web
+    process are seen by the workers.
+
+    The returned object is shared, it must not be modified.
+    """
+    version = get_formula_plan_version(silo.pk)
+    cached = _formula_plan_cache.get(silo.pk)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    plan = FormulaPlan.from_columns(silo.formulacolumns.all())
+    if len(_formula_plan_cache) >= FORMULA_PLAN_CACHE_SIZE:
+        _formula_plan_cache.clear()
+    _formula_plan_cache[silo.pk] = (version, plan)
+    return plan
+
+
+def calculateFormulaCell(entry, silo, formula_columns=None):
     """
     calculates all the formula for a given entry
 
-    entry -- a query of label_value_store objects
+    entry -- a query of label_value_store objects or a plain dict
     silo -- a silo object
+    formula_columns -- the silo's formula columns, if already fetched
 
     returns entry
     """
-    formula_columns = silo.formulacolumns.all()
-    for column in formula_columns:
-        calculation_to_do = parseMathInstruction(column.operation)
-        entry = calculateFormula(entry, calculation_to_do,
-                                 json.loads(column.mapping),
-                                 column.column_name)
-        entry = entry[0]
-    return entry
+    if formula_columns is None:
+        formula_plan = get_formula_plan(silo)
+    else:
+        formula_plan = FormulaPlan.from_columns(formula_columns)
+    return formula_plan.apply(entry)
 
 
 def makeQueryForHiddenRow(row_filter):
@@ -626,7 +1125,8 @@ def getNewestDataDate(silo_id):
     """
     client = MongoClient(settings.MONGO_URI)
     db = client.get_database(settings.MONGODB_DATABASES['default']['name'])
-    newest_record = db.label_value_store.find({'silo_id': silo_id}).sort(
+    newest_record = db.label_value_store.find(
+        {'silo_id': get_data_silo_id(silo_id)}).sort(
         [("create_date", -1)]).limit(1)
 
     return newest_record[0]['create_date']
@@ -655,8 +1155,9 @@ def setSiloColumnType(silo_pk, column, column_type):
     client = MongoClient(settings.MONGO_URI)
     db = client.get_database(settings.MONGODB_DATABASES['default']['name'])
     bulk = db.label_value_store.initialize_ordered_bulk_op()
+    data_id = get_data_silo_id(silo_pk)
 
-    if (db.label_value_store.find({'silo_id': silo_pk, column: {'$not': {
+    if (db.label_value_store.find({'silo_id': data_id, column: {'$not': {
             '$exists': True}}}).count() > 0):
         return messages.ERROR, 'Faluire to set column type due to not all ' \
                                'rows having designated column'
@@ -668,7 +1169,7 @@ def setSiloColumnType(silo_pk, column, column_type):
                 parse_cmd, column, column),
             "function(key, value) {return value.toString();}",
             {'inline': 1},
-            query={'silo_id': silo_pk}
+            query={'silo_id': data_id}
         )
         if len(res['results']) > 1:
             unparsed_rows = [x for x in res['results'] if x['_id']]
@@ -676,17 +1177,12 @@ def setSiloColumnType(silo_pk, column, column_type):
                 unparsed_rows[0]['value'], column_type)
 
     # change type in mysql database
-    silo = Silo.objects.get(pk=silo_pk)
-    silo_cols = json.loads(silo.columns)
-    for col in silo_cols:
-        if col['name'] == column:
-            col['type'] = column_type
-            break
-    silo.columns = json.dumps(silo_cols)
-    silo.save()
+    SiloColumn.objects.filter(silo_id=silo_pk, name=column).update(
+        type=column_type)
+    invalidate_silo_columns(silo_pk)
 
     counter = 0
-    for data in db.label_value_store.find({'silo_id': silo_pk}):
+    for data in db.label_value_store.find({'silo_id': data_id}):
         updoc = {
             "$set": {}
         }
@@ -702,5 +1198,6 @@ def setSiloColumnType(silo_pk, column, column_type):
     # Add the rest in the queue
     if counter % 1000 != 0:
         bulk.execute()
+    bump_silo_version(silo_pk)
 
     return messages.SUCCESS, 'All success columns parsed succesfully'